@@ -1,9 +1,63 @@
+import collections
+import hashlib
+import hmac
+import os
 import random
 import string
+import threading
+import time
 
 from passlib.apps import custom_app_context as pwd_context
 
 
+class VerifiedCredentialCache(object):
+    """
+    Remembers recent successful admin logins so that repeat requests skip the deliberately slow
+    password hash. Only an HMAC of each password, keyed with a secret drawn at start-up, is
+    kept, and it is compared in constant time. An entry is only valid for the password hash it
+    was verified against, so changing or removing an admin's hash invalidates it. Failed
+    logins are never cached.
+    """
+
+    def __init__(self, max_entries=64, ttl=300.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.secret = os.urandom(32)
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def make_digest(self, password):
+        if not isinstance(password, bytes):
+            password = password.encode("utf-8")
+        return hmac.new(self.secret, password, hashlib.sha256).digest()
+
+    def check(self, username, password, password_hash):
+        with self.lock:
+            entry = self.entries.get(username)
+            if entry is None:
+                return False
+            digest, verified_hash, expires_at = entry
+            if expires_at < time.time() or verified_hash != password_hash:
+                del self.entries[username]
+                return False
+        return hmac.compare_digest(digest, self.make_digest(password))
+
+    def add(self, username, password, password_hash):
+        entry = (self.make_digest(password), password_hash, time.time() + self.ttl)
+        with self.lock:
+            self.entries.pop(username, None)
+            self.entries[username] = entry
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+credential_cache = VerifiedCredentialCache()
+
+
 def generate_token():
     """
     Generates a random 32-character token. Tokens may only include lowercase letters, uppercase letters, and digits.
@@ -23,6 +77,18 @@ def get_password_hashes():
     }
 
 
+def verify_admin_password(username, password):
+    password_hash = get_password_hashes().get(username)
+    if password_hash is None:
+        return False
+    if credential_cache.check(username, password, password_hash):
+        return True
+    if pwd_context.verify(password, password_hash):
+        credential_cache.add(username, password, password_hash)
+        return True
+    return False
+
+
 def make_password_hash(password):
     return pwd_context.encrypt(password)
 
@@ -2,24 +2,71 @@ import admins
 import users
 import errors
 from model_bone_age import BoneAgePredictor
+from bone_age import metrics
+from batching import BatchingPredictor
+from prediction_cache import PredictionCache, CachingPredictor
+from prefork import PreforkServer
 
 import json
 import argparse
+import os
+import signal
+import sqlite3
+import sys
 import traceback
 
-from flask import Flask, jsonify, request, make_response
+from flask import Flask, Response, jsonify, request, make_response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_httpauth import HTTPBasicAuth
-from passlib.apps import custom_app_context as pwd_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
 
 
 app = Flask(__name__)
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:////tmp/test.db"
+app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("BONE_AGE_DATABASE_URI", "sqlite:////tmp/test.db")
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+    "poolclass": QueuePool,
+    "pool_size": int(os.environ.get("BONE_AGE_DB_POOL_SIZE", "5")),
+    "max_overflow": int(os.environ.get("BONE_AGE_DB_MAX_OVERFLOW", "10")),
+    "pool_timeout": float(os.environ.get("BONE_AGE_DB_POOL_TIMEOUT", "30")),
+    "pool_recycle": int(os.environ.get("BONE_AGE_DB_POOL_RECYCLE", "3600"))
+}
+# seconds a SQLite connection waits for another process's write lock before giving up
+app.config["SQLITE_BUSY_TIMEOUT"] = float(os.environ.get("BONE_AGE_SQLITE_BUSY_TIMEOUT", "10"))
+if app.config["SQLALCHEMY_DATABASE_URI"].startswith("sqlite"):
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"]["connect_args"] = {
+        "timeout": app.config["SQLITE_BUSY_TIMEOUT"],
+        "check_same_thread": False
+    }
+app.config["MAX_IMAGES_PER_REQUEST"] = 64
+app.config["CACHE_HITS_USE_QUOTA"] = True
+app.config["MAX_USERS_PER_REQUEST"] = 20000
 db = SQLAlchemy(app)
 auth = HTTPBasicAuth()
+# unicode on Python 2 and str on Python 3
+text_type = type(u"")
+
+
+@event.listens_for(Engine, "connect")
+def configure_sqlite_connection(dbapi_connection, connection_record):
+    """
+    Lets several processes share one SQLite file: WAL journaling so that readers never block
+    the writer, synchronous=NORMAL which is durable across application crashes in WAL mode, and
+    a busy timeout so that writers queue for the lock instead of failing with "database is locked".
+    """
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout={}".format(int(app.config["SQLITE_BUSY_TIMEOUT"] * 1000)))
+    cursor.close()
 
 classifier = None
+batching_predictor = None
+prediction_cache = None
 
 
 @app.route("/", methods=["GET"])
@@ -32,7 +79,8 @@ def show_index_page():
 def show_user_quota():
     try:
         token = get_token_from_request()
-        current_quotas = users.get_user_quotas(token=token)
+        with metrics.TOKEN_LOOKUP.time():
+            current_quotas = users.get_user_quotas(token=token)
     except errors.UserAuthenticationError as bad_token_error:
         return errors.unauthorized_response(message=str(bad_token_error))
     except errors.UserNotFoundError:
@@ -52,7 +100,8 @@ def show_user_quota():
 def show_echo():
     try:
         token = get_token_from_request()
-        users.get_user_by_token(token=token)
+        with metrics.TOKEN_LOOKUP.time():
+            users.check_token(token=token)
         image = parse_info_as_image(request.data)
     except errors.UserAuthenticationError as bad_token_error:
         return errors.unauthorized_response(message=str(bad_token_error))
@@ -68,10 +117,12 @@ def show_echo():
 def show_model_response():
     try:
         token = get_token_from_request()
-        current_quotas = users.get_user_quotas(token=token)
-        input_image=request.files.get("image")
+        with metrics.TOKEN_LOOKUP.time():
+            current_quotas = users.get_user_quotas(token=token)
+        with metrics.MULTIPART_PARSING.time():
+            input_image=request.files.get("image")
         image = parse_info_as_image(input_image)
-        gender= request.values.get("gender").encode('utf-8')
+        gender = to_native_string(request.values.get("gender"))
     except errors.UserAuthenticationError as bad_token_error:
         return errors.unauthorized_response(message=str(bad_token_error))
     except errors.UserNotFoundError:
@@ -79,15 +130,23 @@ def show_model_response():
     except errors.ImageNotFoundError:
         return errors.bad_request_response("Please include an image in your request body.")
 
-    if current_quotas["quota_left"] <= 0:
+    # with --free-cache-hits, a cached image costs nothing, so only the uncached ones need quota
+    cache_keys = make_cache_keys(images=[image])
+    charged = count_charged_images(images=[image], cache_keys=cache_keys)
+    if current_quotas["quota_left"] < charged:
         return errors.unauthorized_response(message="No more request quota.", dict={"quotas": current_quotas})
     try:
-        new_quotas = users.decrement_user_quota(token=token)
-        predictions = classifier.predict(img=image, gender=gender)
+        new_quotas = reserve_quota(token=token, amount=charged, current_quotas=current_quotas)
+    except errors.UserAuthenticationError as no_quota_error:
+        return quota_refused_response(token=token, message=str(no_quota_error))
+    except errors.UserNotFoundError:
+        return errors.not_found_response("No user associated with your token.")
+    try:
+        predictions = classifier.predict(img=image, gender=gender, **cache_options(cache_keys))
     except Exception:
         print('error from classification')
         traceback.print_exc()
-        return
+        return refund_quota_after_error(token=token, amount=charged)
 
     response_body = {
         "status": "ok",
@@ -97,18 +156,120 @@ def show_model_response():
     return jsonify(response_body)
 
 
-@app.route("/users", methods=["GET"])
+@app.route("/model/batch", methods=["POST"])
+def show_model_batch_response():
+    try:
+        token = get_token_from_request()
+        with metrics.TOKEN_LOOKUP.time():
+            current_quotas = users.get_user_quotas(token=token)
+        with metrics.MULTIPART_PARSING.time():
+            input_images = request.files.getlist("image")
+        images = [parse_info_as_image(input_image) for input_image in input_images]
+        genders = [to_native_string(gender) for gender in request.values.getlist("gender")]
+        if len(images) == 0:
+            raise errors.ImageNotFoundError("Please include at least one image in your request body.")
+    except errors.UserAuthenticationError as bad_token_error:
+        return errors.unauthorized_response(message=str(bad_token_error))
+    except errors.UserNotFoundError:
+        return errors.not_found_response("No user associated with your token.")
+    except errors.ImageNotFoundError:
+        return errors.bad_request_response("Please include at least one image in your request body.")
+
+    if len(images) > app.config["MAX_IMAGES_PER_REQUEST"]:
+        return errors.bad_request_response("At most {} images may be sent in one request."
+                                           .format(app.config["MAX_IMAGES_PER_REQUEST"]))
+    if len(genders) != len(images):
+        return errors.bad_request_response("Please include one gender for every image.")
+    if any(gender not in ("female", "male") for gender in genders):
+        return errors.bad_request_response("Every gender must be either female or male.")
+
+    cache_keys = make_cache_keys(images=images)
+    charged = count_charged_images(images=images, cache_keys=cache_keys)
+    if current_quotas["quota_left"] < charged:
+        return errors.unauthorized_response(message="Not enough request quota for {} images.".format(charged),
+                                            dict={"quotas": current_quotas})
+    try:
+        new_quotas = reserve_quota(token=token, amount=charged, current_quotas=current_quotas)
+    except errors.UserAuthenticationError as no_quota_error:
+        return quota_refused_response(token=token, message=str(no_quota_error))
+    except errors.UserNotFoundError:
+        return errors.not_found_response("No user associated with your token.")
+    try:
+        predictions = classifier.predict_batch(imgs=images, genders=genders, **cache_options(cache_keys))
+    except Exception:
+        print('error from classification')
+        traceback.print_exc()
+        return refund_quota_after_error(token=token, amount=charged)
+
+    response_body = {
+        "status": "ok",
+        "quotas": new_quotas,
+        "results": predictions
+    }
+    return jsonify(response_body)
+
+
+@app.route("/cache", methods=["GET"])
 @auth.login_required
-def show_all_users():
-    all_users = users.get_all_users_info()
+def show_cache_stats():
+    response_data = {
+        "status": "ok",
+        "cache": prediction_cache.stats() if prediction_cache is not None else None
+    }
+    return jsonify(response_data)
 
+
+@app.route("/pipeline", methods=["GET"])
+@auth.login_required
+def show_pipeline_stats():
+    pipeline_stats = None
+    if batching_predictor is not None:
+        pipeline_stats = batching_predictor.stats.as_dict()
+        pipeline_stats["queue_depth"] = batching_predictor.queue_depth()
     response_data = {
         "status": "ok",
-        "users": all_users
+        "pipeline": pipeline_stats
     }
     return jsonify(response_data)
 
 
+@app.route("/metrics", methods=["GET"])
+@auth.login_required
+def show_metrics():
+    if not metrics.enabled:
+        return errors.not_found_response("Metrics are disabled; start the app with --metrics.")
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/users", methods=["GET"])
+@auth.login_required
+def show_all_users():
+    try:
+        limit = parse_positive_int_arg("limit")
+        after_id = parse_positive_int_arg("cursor")
+    except ValueError:
+        return errors.bad_request_response("The limit and cursor parameters must be positive integers.")
+
+    users_page = users.iter_users_info(after_id=after_id, limit=limit)
+    return Response(stream_with_context(generate_users_json(users_page, limit)), mimetype="application/json")
+
+
+def generate_users_json(users_page, limit):
+    """
+    Streams {"status", "users", "next_cursor"} one user at a time. next_cursor is the cursor for
+    the following page, or null once the last page has been sent.
+    """
+    yield '{"status": "ok", "users": ['
+    last_id = None
+    count = 0
+    for user_id, user_info in users_page:
+        yield (", " if count > 0 else "") + json.dumps(user_info)
+        last_id = user_id
+        count += 1
+    next_cursor = last_id if limit is not None and count == limit else None
+    yield '], "next_cursor": {}}}'.format(json.dumps(next_cursor))
+
+
 @app.route("/users/<string:name>", methods=["GET"])
 @auth.login_required
 def show_single_user(name):
@@ -127,6 +288,8 @@ def show_single_user(name):
 @app.route("/users", methods=["POST"])
 @auth.login_required
 def show_add_user_response():
+    if is_json_list(request.data):
+        return show_add_users_response()
     try:
         clean_info = parse_info_as_json(request.data)
         new_user_info = users.add_user_from_info(info=clean_info)
@@ -144,6 +307,77 @@ def show_add_user_response():
     return make_response(jsonify(response_data), 201)
 
 
+def show_add_users_response():
+    try:
+        clean_infos = parse_info_list_as_json(request.data)
+        new_users_info = users.add_users_from_info(infos=clean_infos)
+    except errors.JSONNotFoundError as json_error:
+        return errors.bad_request_response(message=str(json_error))
+    except errors.UserBatchError as user_batch_error:
+        return make_batch_error_response(user_batch_error)
+    except errors.UserConflictError as user_conflict_error:
+        return errors.conflict_response(message=str(user_conflict_error))
+
+    response_data = {
+        "status": "ok",
+        "users": new_users_info
+    }
+    return make_response(jsonify(response_data), 201)
+
+
+@app.route("/users", methods=["PATCH"])
+@auth.login_required
+def show_update_users_response():
+    try:
+        clean_infos = parse_info_list_as_json(request.data)
+        updates = []
+        for clean_info in clean_infos:
+            name = clean_info.pop("name")
+            clean_info["name"] = clean_info.pop("new_name")
+            updates.append((name, clean_info))
+        updated_users_info, old_users_info = users.update_users_from_info(updates=updates)
+    except errors.JSONNotFoundError as json_error:
+        return errors.bad_request_response(message=str(json_error))
+    except errors.UserBatchError as user_batch_error:
+        return make_batch_error_response(user_batch_error)
+    except errors.UserConflictError as user_conflict_error:
+        return errors.conflict_response(message=str(user_conflict_error))
+
+    response_data = {
+        "status": "ok",
+        "users": updated_users_info,
+        "old_info": old_users_info
+    }
+    return jsonify(response_data)
+
+
+@app.route("/users", methods=["DELETE"])
+@auth.login_required
+def show_delete_users_response():
+    try:
+        names = [clean_info["name"] for clean_info in parse_info_list_as_json(request.data)]
+        deleted_users_info = users.delete_users_by_name(names=names)
+    except errors.JSONNotFoundError as json_error:
+        return errors.bad_request_response(message=str(json_error))
+    except errors.UserBatchError as user_batch_error:
+        return make_batch_error_response(user_batch_error)
+    except errors.UserConflictError as user_conflict_error:
+        return errors.conflict_response(message=str(user_conflict_error))
+
+    response_data = {
+        "status": "ok",
+        "users": deleted_users_info
+    }
+    return jsonify(response_data)
+
+
+def make_batch_error_response(user_batch_error):
+    details = {"errors": user_batch_error.row_errors}
+    if user_batch_error.conflict:
+        return errors.conflict_response(message=str(user_batch_error), dict=details)
+    return errors.bad_request_response(message=str(user_batch_error), dict=details)
+
+
 @app.route("/users/<string:name>", methods=["PUT"])
 @auth.login_required
 def show_update_user_response(name):
@@ -193,9 +427,56 @@ def get_token_from_request():
     if token_detected is None:
         raise errors.UserAuthenticationError(
             "No token detected in your request.")
-    elif not isinstance(token_detected, str) and not isinstance(token_detected, unicode):
+    elif not isinstance(token_detected, (str, text_type)):
         raise errors.UserAuthenticationError("Your token must be a string.")
-    return token_detected.encode('utf-8')
+    return to_native_string(token_detected)
+
+
+def make_cache_keys(images):
+    """
+    Hashes the images once per request, for both the quota check and the prediction; returns
+    None without a prediction cache.
+    """
+    if prediction_cache is None:
+        return None
+    return classifier.make_keys(images)
+
+
+def count_charged_images(images, cache_keys):
+    if cache_keys is not None and not app.config["CACHE_HITS_USE_QUOTA"]:
+        return classifier.count_uncached(cache_keys)
+    return len(images)
+
+
+def cache_options(cache_keys):
+    """ The options that pass cache keys on to the CachingPredictor, if there is one. """
+    if cache_keys is None:
+        return {}
+    return {"keys": cache_keys}
+
+
+def reserve_quota(token, amount, current_quotas):
+    if amount == 0:
+        return current_quotas
+    with metrics.QUOTA_UPDATE.time():
+        return users.reserve_user_quota(token=token, amount=amount)
+
+
+def quota_refused_response(token, message):
+    """ The 401 for a reservation refused for lack of quota, with the user's quotas as they are now. """
+    try:
+        quotas = users.get_user_quotas(token=token)
+    except errors.UserNotFoundError:
+        # deleted since the reservation was refused
+        return errors.not_found_response("No user associated with your token.")
+    return errors.unauthorized_response(message=message, dict={"quotas": quotas})
+
+
+def refund_quota_after_error(token, amount):
+    if amount > 0:
+        with metrics.QUOTA_UPDATE.time():
+            users.refund_user_quota(token=token, amount=amount)
+    return errors.internal_server_error_response("The prediction failed. Your quota has not been used.")
 
 
 def parse_info_as_image(raw_data):
@@ -216,25 +497,75 @@ def parse_info_as_json(raw_data):
         raise errors.JSONNotFoundError(
             message="Decoded JSON is not a Python dictionary.")
 
-    clean_info_dict = {
-        "name": raw_info_dict.get("name").encode('utf-8'),
+    return clean_info_dict(raw_info_dict)
+
+
+def parse_info_list_as_json(raw_data):
+    """
+    Parses a bulk request body: a JSON list of user objects, or of plain names.
+    """
+    try:
+        raw_info_list = json.loads(raw_data)
+    except ValueError:
+        raise errors.JSONNotFoundError(message="Raw data not readable.")
+
+    if not isinstance(raw_info_list, list) or len(raw_info_list) == 0:
+        raise errors.JSONNotFoundError(message="A non-empty JSON list of users is required.")
+    if len(raw_info_list) > app.config["MAX_USERS_PER_REQUEST"]:
+        raise errors.JSONNotFoundError(message="At most {} users may be sent in one request."
+                                       .format(app.config["MAX_USERS_PER_REQUEST"]))
+
+    clean_info_list = []
+    for raw_info in raw_info_list:
+        if not isinstance(raw_info, dict):
+            raw_info = {"name": raw_info}
+        clean_info_list.append(clean_info_dict(raw_info))
+    return clean_info_list
+
+
+def clean_info_dict(raw_info_dict):
+    clean_info = {
+        "name": raw_info_dict.get("name"),
+        "new_name": raw_info_dict.get("new_name"),
         "token": raw_info_dict.get("token"),
         "total_quota": raw_info_dict.get("total_quota"),
         "quota_left": raw_info_dict.get("quota_left")
     }
-    if clean_info_dict.get("token") is not None:
-        clean_info_dict["token"] = raw_info_dict.get("token").encode('utf-8')
-    return clean_info_dict
+    for key in ("name", "new_name", "token"):
+        clean_info[key] = to_native_string(clean_info[key])
+    return clean_info
+
+
+def to_native_string(value):
+    """
+    Returns text as the native str type, which is what users.py checks names and tokens against:
+    UTF-8 bytes on Python 2, and the text unchanged on Python 3, where asgi_app.py runs.
+    """
+    if sys.version_info[0] == 2 and isinstance(value, text_type):
+        return value.encode('utf-8')
+    return value
+
+
+def is_json_list(raw_data):
+    return raw_data is not None and raw_data.lstrip()[:1] == b'['
+
+
+def parse_positive_int_arg(key):
+    raw_value = request.args.get(key)
+    if raw_value is None:
+        return None
+    value = int(raw_value)
+    if value < 1:
+        raise ValueError("{} must be positive.".format(key))
+    return value
 
 
 @auth.verify_password
 def is_admin(username, password):
     try:
-        all_admins = admins.get_password_hashes()
-        password_hash = all_admins[username]
+        return admins.verify_admin_password(username, password)
     except:
         return False
-    return pwd_context.verify(password, password_hash)
 
 
 @auth.error_handler
@@ -267,14 +598,122 @@ def send_error_internal_server_error(error):
     return errors.internal_server_error_response()
 
 
-if __name__ == "__main__":
+def make_argument_parser():
     parser = argparse.ArgumentParser(description='model prediction')
 
     parser.add_argument('--params','-p', type=str, default='',
                         help='path to the file which stores network parameters.')
+    parser.add_argument('--backend', type=str, default='singa', choices=['singa', 'numpy'],
+                        help='inference engine: singa, or numpy for CPU-only machines without SINGA.')
+    parser.add_argument('--device', type=str, default=None,
+                        help='device to run inference on: cpu, cuda or cuda:N (default cuda:0 for singa, cpu for numpy).')
+    parser.add_argument('--fold-bn', action='store_true',
+                        help='fold BatchNorm layers into the preceding convolutions when loading the model.')
+    parser.add_argument('--precision', type=str, default=None, choices=['fp32', 'fp16', 'bf16'],
+                        help='precision to hold convolution and Linear weights in (numpy backend; default as stored).')
+    parser.add_argument('--static-plan', action='store_true',
+                        help='run the numpy backend through an execution plan compiled for --max-batch-size images.')
+    parser.add_argument('--max-batch-size', type=int, default=8,
+                        help='most /model requests to run in one forward pass; 1 disables batching.')
+    parser.add_argument('--max-batch-wait-ms', type=float, default=5.0,
+                        help='longest time a /model request waits for others to share its batch.')
+    parser.add_argument('--preprocess-workers', type=int, default=0,
+                        help='processes that decode and preprocess images; 0 preprocesses on the request thread.')
+    parser.add_argument('--preprocess-timeout', type=float, default=30.0,
+                        help='seconds to wait for a --preprocess-workers process before failing the request.')
+    parser.add_argument('--queue-depth', type=int, default=64,
+                        help='most images queued for inference before new requests block.')
+    parser.add_argument('--write-behind', action='store_true',
+                        help='keep quota spending in memory and write it to the database in batches.')
+    parser.add_argument('--flush-interval', type=float, default=1.0,
+                        help='seconds between write-behind quota flushes.')
+    parser.add_argument('--flush-every', type=int, default=100,
+                        help='quota changes after which write-behind flushes straight away.')
+    parser.add_argument('--cache-size', type=int, default=4096,
+                        help='most predictions to keep in the image-hash cache; 0 disables the cache.')
+    parser.add_argument('--cache-ttl', type=float, default=3600.0,
+                        help='seconds a cached prediction stays valid.')
+    parser.add_argument('--free-cache-hits', action='store_true',
+                        help='do not charge quota for predictions answered from the cache.')
+    parser.add_argument('--metrics', action='store_true',
+                        help='record per-stage latencies, batch sizes and queue depth for GET /metrics.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='server processes forked after the model is loaded, sharing its weights; '
+                             '1 serves from this process.')
+    parser.add_argument('--threads-per-worker', type=int, default=0,
+                        help='BLAS threads for each worker; 0 divides the CPUs evenly between the workers.')
+    parser.add_argument('--pin-cpus', action='store_true',
+                        help='bind each worker to its own --threads-per-worker CPUs.')
+    return parser
+
+
+def check_worker_arguments(parser, args):
+    """ Exits with a usage error if --workers is combined with an option that only works in one process. """
+    if args.workers > 1 and args.write_behind:
+        parser.error("--write-behind cannot be used with --workers: every worker would check quota against "
+                     "its own ledger, so a user could spend up to --workers times their quota.")
+
+
+def start_serving(args, predictor):
+    """
+    Wraps the loaded predictor and starts the background threads. Threads do not survive a
+    fork, so with --workers this runs in every worker after it has been forked; asgi_app.py
+    runs it too.
+    """
+    global classifier, batching_predictor, prediction_cache
+    if args.metrics:
+        metrics.enable()
+    classifier = predictor
+    if args.max_batch_size > 1 or args.preprocess_workers > 0:
+        batching_predictor = BatchingPredictor(classifier, max_batch_size=args.max_batch_size,
+                                               max_wait=args.max_batch_wait_ms / 1000.0,
+                                               preprocess_workers=args.preprocess_workers,
+                                               queue_depth=args.queue_depth,
+                                               preprocess_timeout=args.preprocess_timeout)
+        classifier = batching_predictor
+        metrics.QUEUE_DEPTH.read_value = batching_predictor.queue_depth
+    if args.cache_size > 0:
+        prediction_cache = PredictionCache(max_entries=args.cache_size, ttl=args.cache_ttl)
+        classifier = CachingPredictor(classifier, prediction_cache)
+    if args.write_behind:
+        users.enable_write_behind(flush_interval=args.flush_interval, flush_every=args.flush_every)
+
+
+def run_server(args, predictor, port=5000):
+    """ Serves on port until stopped, forking args.workers processes if there is more than one. """
+    if args.workers > 1:
+        # forked workers must open their own database connections
+        users.dispose_connections()
+        if args.metrics:
+            metrics.enable_multiprocess(args.workers)
+
+        def setup_worker(worker_index):
+            metrics.set_worker(worker_index)
+            start_serving(args, predictor)
+        server = PreforkServer(app, host="0.0.0.0", port=port, workers=args.workers,
+                               setup_worker=setup_worker,
+                               threads_per_worker=args.threads_per_worker, pin_cpus=args.pin_cpus)
+        server.serve_forever()
+    else:
+        start_serving(args, predictor)
+        if args.write_behind:
+            # exit normally on SIGTERM so that pending quota is flushed
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        app.run(host="0.0.0.0", port=port, threaded=True)
+
+
+if __name__ == "__main__":
+    parser = make_argument_parser()
     args = parser.parse_args()
 
-    classifier = BoneAgePredictor(args)
+    device_spec = args.device or ('cuda:0' if args.backend == 'singa' else 'cpu')
+    if args.workers > 1 and device_spec.startswith('cuda'):
+        parser.error("--workers needs --device cpu: a CUDA context cannot be shared with forked processes, "
+                     "so run one server per GPU instead.")
+    check_worker_arguments(parser, args)
 
+    predictor = BoneAgePredictor(args)
+    app.config["CACHE_HITS_USE_QUOTA"] = not args.free_cache_hits
     users.initialize()
-    app.run(host="0.0.0.0", port=5000)
+
+    run_server(args, predictor)
@@ -0,0 +1,414 @@
+"""
+Asyncio serving mode, for Python 3 only. Takes the same arguments as app.py:
+
+    python asgi_app.py --backend numpy -p /root/params/PARAMS_FILE_NAME
+
+Request bodies are received on the event loop, so a slow upload holds a coroutine rather than a
+thread; multipart bodies are then parsed on the blocking pool. The prediction routes (/, /check-quota, /echo, /model and /model/batch) are handled
+natively: the token and quota lookups use the in-memory token index, and only database writes
+and the model itself run on thread pools, the model on one of its own. Every other route,
+such as /users, is passed to the Flask app on the blocking pool once its body has arrived.
+"""
+import asyncio
+import io
+import json
+import sys
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+from werkzeug.formparser import parse_form_data
+
+import users
+import app
+import errors
+from model_bone_age import BoneAgePredictor
+from bone_age import metrics
+
+
+# largest request body accepted, so that a client cannot make the server buffer without limit
+MAX_REQUEST_BYTES = 64 * 1024 * 1024
+
+
+class RequestTooLargeError(ValueError):
+    def __init__(self, message):
+        super(RequestTooLargeError, self).__init__(message)
+
+
+class ClientDisconnectedError(IOError):
+    def __init__(self, message):
+        super(ClientDisconnectedError, self).__init__(message)
+
+
+class AsgiRequest(object):
+    """
+    The parts of an ASGI request that the prediction routes read, with the body already received.
+    """
+
+    def __init__(self, scope, body):
+        self.scope = scope
+        self.body = body
+        self.headers = dict((name.decode("latin-1").lower(), value.decode("latin-1"))
+                            for name, value in scope["headers"])
+        self.args = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+        self.form = None
+        self.files = None
+
+    def parse_form(self):
+        """ Parses the multipart body, which can be large, so it is called on the blocking pool. """
+        if self.form is None:
+            with metrics.MULTIPART_PARSING.time():
+                _, self.form, self.files = parse_form_data(make_environ(self.scope, self.body))
+        return self.form, self.files
+
+    def get_values(self, key):
+        """ Query string and form values for key; parse_form must have been called first. """
+        return self.args.get(key, []) + self.form.getlist(key)
+
+
+class AsgiFrontend(object):
+    """
+    ASGI application serving the routes of app.py. Prediction runs on inference_threads
+    threads; database writes and the routes passed to the Flask app share blocking_threads.
+    """
+
+    def __init__(self, flask_app, inference_threads=8, blocking_threads=16, max_request_bytes=MAX_REQUEST_BYTES):
+        self.flask_app = flask_app
+        self.max_request_bytes = max_request_bytes
+        self.inference_executor = ThreadPoolExecutor(inference_threads, thread_name_prefix="inference")
+        self.blocking_executor = ThreadPoolExecutor(blocking_threads, thread_name_prefix="blocking")
+        self.routes = {
+            ("GET", "/"): self.show_index_page,
+            ("GET", "/check-quota"): self.show_user_quota,
+            ("POST", "/echo"): self.show_echo,
+            ("POST", "/model"): self.show_model_response,
+            ("POST", "/model/batch"): self.show_model_batch_response
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.run_lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+
+        try:
+            body = await read_body(scope, receive, self.max_request_bytes)
+        except RequestTooLargeError as too_large_error:
+            await send_response(send, *error_response(413, "Payload Too Large", str(too_large_error)))
+            return
+        except ClientDisconnectedError:
+            return
+
+        handler = self.routes.get((scope["method"], scope["path"]))
+        if handler is None:
+            await self.call_flask_app(scope, body, send)
+            return
+        try:
+            response = await handler(AsgiRequest(scope, body))
+        except Exception:
+            print('error handling {}'.format(scope["path"]))
+            traceback.print_exc()
+            response = error_response(500, "Internal Server Error")
+        await send_response(send, *response)
+
+    async def show_index_page(self, request):
+        return 200, {"status": "ok"}
+
+    async def show_user_quota(self, request):
+        try:
+            token = get_token_from_request(request)
+            current_quotas = await self.get_user_quotas(token)
+        except errors.UserAuthenticationError as bad_token_error:
+            return error_response(401, "Unauthorized", str(bad_token_error))
+        except errors.UserNotFoundError:
+            return error_response(404, "Not Found", "No user associated with your token.")
+
+        if current_quotas["quota_left"] <= 0:
+            return error_response(401, "Unauthorized", "No more request quota.", {"quotas": current_quotas})
+        return 200, {"status": "ok", "quotas": current_quotas}
+
+    async def show_echo(self, request):
+        try:
+            token = get_token_from_request(request)
+            await self.get_user_quotas(token)
+            image = app.parse_info_as_image(request.body)
+        except errors.UserAuthenticationError as bad_token_error:
+            return error_response(401, "Unauthorized", str(bad_token_error))
+        except errors.UserNotFoundError:
+            return error_response(404, "Not Found", "No user associated with your token.")
+        except errors.ImageNotFoundError:
+            return error_response(400, "Bad Request", "Please include an image in your request body.")
+        return 200, image
+
+    async def show_model_response(self, request):
+        try:
+            token = get_token_from_request(request)
+            current_quotas = await self.get_user_quotas(token)
+            _, files = await self.run_blocking(request.parse_form)
+            image = app.parse_info_as_image(files.get("image"))
+            genders = request.get_values("gender")
+            gender = genders[0] if len(genders) > 0 else None
+        except errors.UserAuthenticationError as bad_token_error:
+            return error_response(401, "Unauthorized", str(bad_token_error))
+        except errors.UserNotFoundError:
+            return error_response(404, "Not Found", "No user associated with your token.")
+        except errors.ImageNotFoundError:
+            return error_response(400, "Bad Request", "Please include an image in your request body.")
+
+        cache_keys = await self.run_blocking(app.make_cache_keys, [image])
+        charged = app.count_charged_images(images=[image], cache_keys=cache_keys)
+        if current_quotas["quota_left"] < charged:
+            return error_response(401, "Unauthorized", "No more request quota.", {"quotas": current_quotas})
+        return await self.charge_and_predict(token, current_quotas, charged,
+                                             lambda: app.classifier.predict(img=image, gender=gender,
+                                                                            **app.cache_options(cache_keys)))
+
+    async def show_model_batch_response(self, request):
+        try:
+            token = get_token_from_request(request)
+            current_quotas = await self.get_user_quotas(token)
+            _, files = await self.run_blocking(request.parse_form)
+            images = [app.parse_info_as_image(input_image) for input_image in files.getlist("image")]
+            genders = request.get_values("gender")
+            if len(images) == 0:
+                raise errors.ImageNotFoundError("Please include at least one image in your request body.")
+        except errors.UserAuthenticationError as bad_token_error:
+            return error_response(401, "Unauthorized", str(bad_token_error))
+        except errors.UserNotFoundError:
+            return error_response(404, "Not Found", "No user associated with your token.")
+        except errors.ImageNotFoundError:
+            return error_response(400, "Bad Request", "Please include at least one image in your request body.")
+
+        if len(images) > app.app.config["MAX_IMAGES_PER_REQUEST"]:
+            return error_response(400, "Bad Request", "At most {} images may be sent in one request."
+                                  .format(app.app.config["MAX_IMAGES_PER_REQUEST"]))
+        if len(genders) != len(images):
+            return error_response(400, "Bad Request", "Please include one gender for every image.")
+        if any(gender not in ("female", "male") for gender in genders):
+            return error_response(400, "Bad Request", "Every gender must be either female or male.")
+
+        cache_keys = await self.run_blocking(app.make_cache_keys, images)
+        charged = app.count_charged_images(images=images, cache_keys=cache_keys)
+        if current_quotas["quota_left"] < charged:
+            return error_response(401, "Unauthorized", "Not enough request quota for {} images.".format(charged),
+                                  {"quotas": current_quotas})
+        return await self.charge_and_predict(token, current_quotas, charged,
+                                             lambda: app.classifier.predict_batch(imgs=images, genders=genders,
+                                                                                  **app.cache_options(cache_keys)))
+
+    async def charge_and_predict(self, token, current_quotas, charged, predict):
+        try:
+            new_quotas = await self.run_blocking(app.reserve_quota, token, charged, current_quotas)
+        except errors.UserAuthenticationError as no_quota_error:
+            try:
+                quotas = await self.get_user_quotas(token)
+            except errors.UserNotFoundError:
+                # deleted since the reservation was refused
+                return error_response(404, "Not Found", "No user associated with your token.")
+            return error_response(401, "Unauthorized", str(no_quota_error), {"quotas": quotas})
+        except errors.UserNotFoundError:
+            return error_response(404, "Not Found", "No user associated with your token.")
+
+        try:
+            predictions = await asyncio.get_event_loop().run_in_executor(self.inference_executor, predict)
+        except Exception:
+            print('error from classification')
+            traceback.print_exc()
+            if charged > 0:
+                with metrics.QUOTA_UPDATE.time():
+                    await self.run_blocking(users.refund_user_quota, token, charged)
+            return error_response(500, "Internal Server Error", "The prediction failed. Your quota has not been used.")
+        return 200, {"status": "ok", "quotas": new_quotas, "results": predictions}
+
+    async def get_user_quotas(self, token):
+        # the token index is in memory, except when it is due to be checked against the database
+        # or does not know the token
+        with metrics.TOKEN_LOOKUP.time():
+            if users.token_index_needs_database(token):
+                return await self.run_blocking(users.get_user_quotas, token)
+            return users.get_user_quotas(token)
+
+    async def run_blocking(self, function, *args):
+        def call():
+            with app.app.app_context():
+                return function(*args)
+        return await asyncio.get_event_loop().run_in_executor(self.blocking_executor, call)
+
+    async def call_flask_app(self, scope, body, send):
+        """
+        Runs the Flask app on the blocking pool and relays its response, chunk by chunk, so that
+        streamed responses such as GET /users stay streamed.
+        """
+        loop = asyncio.get_event_loop()
+        messages = asyncio.Queue()
+
+        def put(kind, value=None):
+            loop.call_soon_threadsafe(messages.put_nowait, (kind, value))
+
+        def run():
+            started = {}
+
+            def start_response(status, headers, exc_info=None):
+                started["status"] = int(status.split(" ", 1)[0])
+                started["headers"] = headers
+
+            try:
+                result = self.flask_app(make_environ(scope, body), start_response)
+                try:
+                    put("start", started)
+                    for chunk in result:
+                        if chunk:
+                            put("body", chunk)
+                finally:
+                    if hasattr(result, "close"):
+                        result.close()
+                put("end")
+            except Exception:
+                traceback.print_exc()
+                put("error")
+
+        self.blocking_executor.submit(run)
+        started = False
+        while True:
+            kind, value = await messages.get()
+            if kind == "start":
+                await send({
+                    "type": "http.response.start",
+                    "status": value["status"],
+                    "headers": [(name.encode("latin-1"), header_value.encode("latin-1"))
+                                for name, header_value in value["headers"]]
+                })
+                started = True
+            elif kind == "body":
+                await send({"type": "http.response.body", "body": value, "more_body": True})
+            elif kind == "error" and not started:
+                await send_response(send, *error_response(500, "Internal Server Error"))
+                return
+            else:
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+                return
+
+    async def run_lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def close(self):
+        self.inference_executor.shutdown(wait=True)
+        self.blocking_executor.shutdown(wait=True)
+
+
+async def read_body(scope, receive, max_request_bytes):
+    for name, value in scope["headers"]:
+        if name.lower() == b"content-length" and value.isdigit() and int(value) > max_request_bytes:
+            raise RequestTooLargeError("Request bodies may be at most {} bytes.".format(max_request_bytes))
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise ClientDisconnectedError("The client disconnected before sending its request body.")
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > max_request_bytes:
+            raise RequestTooLargeError("Request bodies may be at most {} bytes.".format(max_request_bytes))
+        chunks.append(chunk)
+        if not message.get("more_body", False):
+            return b"".join(chunks)
+
+
+def get_token_from_request(request):
+    token_detected = ((request.args.get("token") or [None])[0] or
+                      request.headers.get("authorization") or
+                      request.headers.get("token"))
+    if token_detected is None:
+        raise errors.UserAuthenticationError("No token detected in your request.")
+    return token_detected
+
+
+def error_response(code, code_phrase, message=None, extra=None):
+    body = {"status": "error", "code": code_phrase}
+    if message is not None:
+        body["message"] = message
+    if extra is not None:
+        body.update(extra)
+    return code, body
+
+
+async def send_response(send, status, payload):
+    if isinstance(payload, bytes):
+        body = payload
+        content_type = b"application/octet-stream"
+    else:
+        body = json.dumps(payload).encode("utf-8")
+        content_type = b"application/json"
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type), (b"content-length", str(len(body)).encode("latin-1"))]
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+def make_environ(scope, body):
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/{}".format(scope.get("http_version", "1.1")),
+        "REMOTE_ADDR": client[0],
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+        elif name != "CONTENT_LENGTH":
+            key = "HTTP_" + name
+            environ[key] = environ[key] + "," + value if key in environ else value
+    return environ
+
+
+if __name__ == "__main__":
+    parser = app.make_argument_parser()
+    parser.description = 'model prediction, served with asyncio'
+    parser.add_argument('--inference-threads', type=int, default=0,
+                        help='threads that run the model; 0 uses --max-batch-size, so that a full batch can queue up.')
+    parser.add_argument('--blocking-threads', type=int, default=16,
+                        help='threads for database writes and the routes passed to the Flask app.')
+    args = parser.parse_args()
+    if args.workers > 1:
+        parser.error("--workers is only supported by app.py.")
+    try:
+        import uvicorn
+    except ImportError:
+        parser.error("asgi_app.py needs uvicorn; install it with pip install uvicorn.")
+
+    predictor = BoneAgePredictor(args)
+    app.app.config["CACHE_HITS_USE_QUOTA"] = not args.free_cache_hits
+    with app.app.app_context():
+        users.initialize()
+    app.start_serving(args, predictor)
+
+    frontend = AsgiFrontend(app.app, inference_threads=args.inference_threads or max(args.max_batch_size, 1),
+                            blocking_threads=args.blocking_threads)
+    uvicorn.run(frontend, host="0.0.0.0", port=5000, lifespan="on")
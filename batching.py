@@ -0,0 +1,370 @@
+import collections
+import ctypes
+import functools
+import io
+import multiprocessing
+import threading
+import time
+from multiprocessing import sharedctypes
+
+import numpy as np
+
+from bone_age import metrics
+from bone_age.utils import load_image, read_image_bytes
+from model_bone_age import DelegatingPredictor
+
+
+# the side of the square greyscale images the network takes
+IMAGE_SIZE = 299
+
+
+class PreprocessTimeoutError(RuntimeError):
+    def __init__(self, message):
+        super(PreprocessTimeoutError, self).__init__(message)
+
+
+class PredictionJob(object):
+
+    def __init__(self):
+        self.batch = None
+        self.row = None
+        self.ticket = None
+        self.claimed_at = None
+        self.queued_at = None
+        self.written = False
+        self.write_error = None
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def finish(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.done.set()
+
+
+class Batch(object):
+    """
+    One batch buffer and the jobs that have claimed its rows. Every job writes its image straight
+    into its own row, and once the batch is closed and all its rows are written it runs as a single
+    forward pass over buffer[:len(jobs)].
+    """
+
+    def __init__(self, index, buffer):
+        self.index = index
+        self.buffer = buffer
+        self.jobs = []
+        self.opened_at = time.time()
+
+    def unwritten(self):
+        return [job for job in self.jobs if not job.written]
+
+
+class SharedRows(object):
+    """
+    Batch buffers in shared memory, allocated before the preprocessing pool forks so that its
+    processes can write images straight into their rows. tickets[i] names the image allowed to
+    write row i; giving up on an image clears its ticket, so a late process cannot overwrite a row
+    that has since been claimed by another image.
+    """
+
+    def __init__(self, buffer_count, max_batch_size, size):
+        self.size = size
+        self.values = sharedctypes.RawArray(ctypes.c_float, buffer_count * max_batch_size * size * size)
+        self.tickets = sharedctypes.RawArray(ctypes.c_long, buffer_count * max_batch_size)
+        self.lock = multiprocessing.Lock()
+        self.buffers = np.frombuffer(self.values, dtype=np.float32).reshape(
+            buffer_count, max_batch_size, 1, size, size)
+
+    def row(self, index):
+        return self.buffers.reshape(-1, 1, self.size, self.size)[index]
+
+    def set_ticket(self, index, ticket):
+        with self.lock:
+            self.tickets[index] = ticket
+
+
+class PipelineStats(object):
+    """
+    Thread-safe timings of the batching pipeline's stages, plus its queue depth and batch sizes.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = collections.OrderedDict()
+        self.batch_sizes = collections.Counter()
+        self.max_queue_depth = 0
+
+    def record(self, stage, seconds):
+        with self.lock:
+            count, total, longest = self.stages.get(stage, (0, 0.0, 0.0))
+            self.stages[stage] = (count + 1, total + seconds, max(longest, seconds))
+
+    def record_batch(self, batch_size, queue_depth):
+        with self.lock:
+            self.batch_sizes[batch_size] += 1
+            self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+
+    def as_dict(self):
+        with self.lock:
+            stages = {}
+            for stage, (count, total, longest) in self.stages.items():
+                stages[stage] = {
+                    "count": count,
+                    "total_seconds": total,
+                    "mean_seconds": total / count,
+                    "max_seconds": longest
+                }
+            return {
+                "stages": stages,
+                "batch_sizes": dict(self.batch_sizes),
+                "max_queue_depth": self.max_queue_depth
+            }
+
+
+class BatchingPredictor(DelegatingPredictor):
+    """
+    Wraps a BoneAgePredictor so that concurrent predict() calls share forward passes.
+    Each image claims the next row of the batch being filled and is decoded straight into
+    it, on the request thread or, with preprocess_workers, by a pool of processes writing
+    into batch buffers in shared memory, so that decoding runs on other cores. Once
+    queue_depth images are waiting, further callers block until the worker catches up. A
+    single worker thread closes a batch when it has max_batch_size images or max_wait
+    seconds after its first one, waits until all its rows are written, runs them through the
+    network as one NCHW batch and hands every caller its own row of the output. A batch
+    runs only once its slowest image is decoded; an image that the pool has not written
+    within preprocess_timeout seconds, for instance because the process handling it died,
+    fails its request with PreprocessTimeoutError and no longer holds back its batch.
+    """
+
+    def __init__(self, predictor, max_batch_size=8, max_wait=0.005, preprocess_workers=0, queue_depth=0,
+                 preprocess_timeout=30.0):
+        global shared_rows
+
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1.")
+        super(BatchingPredictor, self).__init__(predictor)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.preprocess_timeout = preprocess_timeout
+        self.depth_limit = queue_depth
+        self.condition = threading.Condition()
+        self.filling = None
+        self.closed = collections.deque()
+        self.waiting = 0
+        self.next_ticket = 1
+        self.stopping = False
+        self.stats = PipelineStats()
+        if preprocess_workers > 0:
+            # the pool's processes only see shared memory that exists when they fork, so the queue
+            # is bounded by the buffers allocated here
+            buffer_count = max(1, -(-queue_depth // max_batch_size)) + 1
+            self.shared = SharedRows(buffer_count, max_batch_size, IMAGE_SIZE)
+            self.buffers = list(self.shared.buffers)
+            shared_rows = self.shared
+        else:
+            self.shared = None
+            self.buffers = []
+        self.free_buffers = list(range(len(self.buffers)))
+        # the pool forks before the worker thread starts, so no thread is copied into its processes
+        self.pool = multiprocessing.Pool(preprocess_workers) if preprocess_workers > 0 else None
+        self.worker = threading.Thread(target=self.run_worker, name="batching-predictor")
+        self.worker.daemon = True
+        self.worker.start()
+
+    def predict_outputs(self, imgs):
+        jobs = []
+        for img in imgs:
+            job = PredictionJob()
+            if self.pool is not None:
+                data = read_image_bytes(img)
+                self.claim_row(job)
+                self.pool.apply_async(preprocess_into_row, (data, self.shared_index(job), job.ticket),
+                                      callback=functools.partial(self.pool_row_written, job))
+            else:
+                self.claim_row(job)
+                start = time.time()
+                try:
+                    self.predictor.preprocess(img, out=job.batch.buffer[job.row])
+                except Exception as preprocess_error:
+                    # the row still runs with its batch, so give it defined contents
+                    job.batch.buffer[job.row] = 0
+                    self.row_written(job, preprocess_error)
+                    raise
+                self.stats.record("preprocess", time.time() - start)
+                self.row_written(job)
+            jobs.append(job)
+
+        y_np = []
+        for job in jobs:
+            job.done.wait()
+            if job.error is not None:
+                raise job.error
+            y_np.append(job.result)
+        return y_np
+
+    def claim_row(self, job):
+        """ Gives job the next row of the batch being filled, waiting while the queue or the buffers are full. """
+        with self.condition:
+            while True:
+                if self.stopping:
+                    raise RuntimeError("The batching predictor has been closed.")
+                if self.depth_limit <= 0 or self.waiting < self.depth_limit:
+                    if self.filling is not None:
+                        break
+                    if self.free_buffers:
+                        index = self.free_buffers.pop()
+                        self.filling = Batch(index, self.buffers[index])
+                        break
+                    if self.shared is None:
+                        self.buffers.append(np.empty((self.max_batch_size, 1, IMAGE_SIZE, IMAGE_SIZE),
+                                                     dtype=np.float32))
+                        self.free_buffers.append(len(self.buffers) - 1)
+                        continue
+                self.condition.wait()
+            batch = self.filling
+            job.batch = batch
+            job.row = len(batch.jobs)
+            job.claimed_at = time.time()
+            batch.jobs.append(job)
+            self.waiting += 1
+            if self.shared is not None:
+                job.ticket = self.next_ticket
+                self.next_ticket += 1
+                self.shared.set_ticket(self.shared_index(job), job.ticket)
+            if len(batch.jobs) == self.max_batch_size:
+                self.close_filling()
+            self.condition.notify_all()
+
+    def shared_index(self, job):
+        return job.batch.index * self.max_batch_size + job.row
+
+    def row_written(self, job, error=None):
+        with self.condition:
+            if job.written:
+                return
+            job.written = True
+            job.write_error = error
+            job.queued_at = time.time()
+            self.condition.notify_all()
+
+    def pool_row_written(self, job, outcome):
+        """ Runs on the pool's result thread once a process has written, or failed to write, job's row. """
+        seconds, error = outcome
+        if error is None:
+            # the pool's processes have their own metrics, so image2array is recorded here
+            metrics.IMAGE2ARRAY.observe(seconds)
+            self.stats.record("preprocess", seconds)
+        self.row_written(job, error)
+
+    def close_filling(self):
+        self.closed.append(self.filling)
+        self.filling = None
+
+    def close(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        self.worker.join()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+    def queue_depth(self):
+        with self.condition:
+            return self.waiting
+
+    def run_worker(self):
+        while True:
+            with self.condition:
+                batch = self.next_batch()
+                if batch is None:
+                    return
+                self.wait_for_rows(batch)
+                self.waiting -= len(batch.jobs)
+                self.condition.notify_all()
+            self.run_batch(batch)
+            with self.condition:
+                self.free_buffers.append(batch.index)
+                self.condition.notify_all()
+
+    def next_batch(self):
+        """ Waits for a closed batch, closing the one being filled max_wait seconds after it was opened. """
+        while True:
+            if self.closed:
+                return self.closed.popleft()
+            if self.filling is not None:
+                remaining = self.filling.opened_at + self.max_wait - time.time()
+                if remaining <= 0 or self.stopping:
+                    self.close_filling()
+                    continue
+                self.condition.wait(remaining)
+            elif self.stopping:
+                return None
+            else:
+                self.condition.wait()
+
+    def wait_for_rows(self, batch):
+        """
+        Waits until every row of batch is written. Rows left to the pool are given up
+        preprocess_timeout seconds after they were claimed: their tickets are cleared and their
+        jobs fail, while the rest of the batch runs.
+        """
+        while True:
+            unwritten = batch.unwritten()
+            if not unwritten:
+                return
+            if self.shared is None:
+                self.condition.wait()
+                continue
+            now = time.time()
+            expired = [job for job in unwritten if now >= job.claimed_at + self.preprocess_timeout]
+            for job in expired:
+                self.shared.set_ticket(self.shared_index(job), 0)
+                job.written = True
+                job.write_error = PreprocessTimeoutError("An image was not preprocessed within {} seconds."
+                                                         .format(self.preprocess_timeout))
+            if not expired:
+                self.condition.wait(min(job.claimed_at for job in unwritten) + self.preprocess_timeout - now)
+
+    def run_batch(self, batch):
+        start = time.time()
+        for job in batch.jobs:
+            if job.write_error is None:
+                self.stats.record("queue_wait", start - job.queued_at)
+        self.stats.record_batch(len(batch.jobs), self.queue_depth() + len(batch.jobs))
+        metrics.BATCH_SIZE.observe(len(batch.jobs))
+
+        try:
+            y_np = self.predictor.forward(batch.buffer[:len(batch.jobs)])
+        except Exception as forward_error:
+            for job in batch.jobs:
+                job.finish(error=job.write_error or forward_error)
+            return
+        self.stats.record("forward", time.time() - start)
+
+        for job, y_row in zip(batch.jobs, y_np):
+            if job.write_error is not None:
+                job.finish(error=job.write_error)
+            else:
+                job.finish(result=y_row)
+
+
+# the shared batch buffers of the most recently started pool, inherited by its processes
+shared_rows = None
+
+
+def preprocess_into_row(data, index, ticket):
+    """
+    Runs in a pool process: decodes the image into shared row index if ticket still holds it, and
+    returns the seconds this took and the error raised, if any, so that no exception crosses back.
+    """
+    start = time.time()
+    try:
+        im = load_image(io.BytesIO(data), shared_rows.size)
+        with shared_rows.lock:
+            if shared_rows.tickets[index] == ticket:
+                np.divide(np.asarray(im), np.float32(255), out=shared_rows.row(index)[0])
+    except Exception as preprocess_error:
+        return time.time() - start, preprocess_error
+    return time.time() - start, None
@@ -0,0 +1,244 @@
+"""
+Offline inference benchmark: preprocessing plus the forward pass, on synthetic radiographs.
+
+Every combination of thread count, batch size and source resolution runs in a fresh process, so
+that the BLAS thread count can be set before numpy loads and peak RSS is measured per
+combination. Without -p the model gets random weights of the real shapes.
+
+    python -m bone_age.benchmark --backend numpy --batch-sizes 1,8 --threads 1,4 --output results.json
+
+The results file holds the configuration, the machine and the git commit next to every
+measurement, so that runs from different commits can be compared.
+"""
+import argparse
+import datetime
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+
+# environment variables read by the BLAS and OpenMP runtimes when numpy or SINGA loads them
+THREAD_ENV_VARS = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"]
+
+
+def synthetic_radiograph(size, seed, image_format="PNG"):
+    """
+    Returns an encoded size x size greyscale image that looks enough like a hand radiograph
+    (soft tissue, brighter bones, noise) for its decoding cost to be realistic.
+    """
+    from PIL import Image
+
+    random_state = np.random.RandomState(seed)
+    y, x = np.mgrid[0:size, 0:size] / float(size)
+    image = 0.15 + 0.45 * np.exp(-((x - 0.5) ** 2 / 0.06 + (y - 0.6) ** 2 / 0.12))
+    for _ in range(20):
+        centre_x, centre_y = random_state.uniform(0.2, 0.8, 2)
+        radius_x, radius_y = random_state.uniform(0.01, 0.06), random_state.uniform(0.03, 0.15)
+        image += 0.25 * ((((x - centre_x) / radius_x) ** 2 + ((y - centre_y) / radius_y) ** 2) < 1)
+    image += random_state.normal(0.0, 0.03, image.shape)
+    pixels = np.clip(image * 255, 0, 255).astype(np.uint8)
+
+    encoded = io.BytesIO()
+    Image.fromarray(pixels, "L").save(encoded, image_format)
+    return encoded.getvalue()
+
+
+def run_configuration(args):
+    """ Runs one batch size and resolution in this process and returns its measurements. """
+    from model_bone_age import load_backend
+    from bone_age.utils import images2array
+
+    backend = load_backend(args.backend)
+    load_kwargs = {'fold_bn': args.fold_bn}
+    if args.device is not None:
+        load_kwargs['device_spec'] = args.device
+    if args.precision is not None:
+        load_kwargs['precision'] = args.precision
+    if args.static_plan:
+        load_kwargs['plan_batch_size'] = args.batch_size
+    load_start = time.time()
+    model = backend.load_model(args.params, **load_kwargs)
+    load_seconds = time.time() - load_start
+
+    images = [synthetic_radiograph(args.resolution, args.seed + index, args.image_format)
+              for index in range(args.batch_size)]
+    batch = np.empty((args.batch_size, 1, 299, 299), dtype=np.float32)
+
+    latencies = []
+    preprocess_times = []
+    forward_times = []
+    for iteration in range(args.warmup + args.iterations):
+        start = time.time()
+        img_array = images2array([io.BytesIO(image) for image in images], out=batch)
+        preprocessed = time.time()
+        backend.forward(model, img_array)
+        backend.synchronize(model)
+        end = time.time()
+        if iteration >= args.warmup:
+            latencies.append(end - start)
+            preprocess_times.append(preprocessed - start)
+            forward_times.append(end - preprocessed)
+
+    latencies_ms = np.array(latencies) * 1e3
+    return {
+        "threads": args.thread_count,
+        "batch_size": args.batch_size,
+        "resolution": args.resolution,
+        "iterations": args.iterations,
+        "load_seconds": load_seconds,
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p95_ms": float(np.percentile(latencies_ms, 95)),
+        "p99_ms": float(np.percentile(latencies_ms, 99)),
+        "mean_ms": float(latencies_ms.mean()),
+        "preprocess_mean_ms": float(np.mean(preprocess_times) * 1e3),
+        "forward_mean_ms": float(np.mean(forward_times) * 1e3),
+        "images_per_second": args.batch_size * len(latencies) / sum(latencies),
+        "plan_arena_mb": model.plan.arena_bytes() / 1e6 if getattr(model, "plan", None) is not None else None,
+        "peak_rss_mb": peak_rss_mb()
+    }
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    if sys.platform == "darwin":
+        return peak / (1024.0 * 1024.0)
+    return peak / 1024.0
+
+
+def run_sweep(args):
+    """ Runs every configuration in its own process and returns the results document. """
+    results = []
+    for thread_count in args.threads:
+        env = dict(os.environ)
+        for name in THREAD_ENV_VARS:
+            env[name] = str(thread_count)
+        for batch_size in args.batch_sizes:
+            for resolution in args.resolutions:
+                command = [sys.executable, "-m", "bone_age.benchmark", "--run-one",
+                           "--params", args.params, "--backend", args.backend,
+                           "--batch-sizes", str(batch_size), "--threads", str(thread_count),
+                           "--resolutions", str(resolution), "--iterations", str(args.iterations),
+                           "--warmup", str(args.warmup), "--seed", str(args.seed),
+                           "--image-format", args.image_format]
+                if args.device is not None:
+                    command += ["--device", args.device]
+                if args.fold_bn:
+                    command.append("--fold-bn")
+                if args.precision is not None:
+                    command += ["--precision", args.precision]
+                if args.static_plan:
+                    command.append("--static-plan")
+                output = subprocess.check_output(command, env=env)
+                result = json.loads(output.decode("utf-8").strip().splitlines()[-1])
+                print(format_result(result))
+                results.append(result)
+    return {
+        "benchmark": "bone_age.benchmark",
+        "created_at": datetime.datetime.utcnow().isoformat() + "Z",
+        "commit": git_commit(),
+        "machine": {
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": multiprocessing.cpu_count(),
+            "python": platform.python_version(),
+            "numpy": np.__version__
+        },
+        "config": {
+            "backend": args.backend,
+            "device": args.device,
+            "fold_bn": args.fold_bn,
+            "precision": args.precision,
+            "static_plan": args.static_plan,
+            "random_weights": args.random_weights,
+            "image_format": args.image_format,
+            "iterations": args.iterations,
+            "warmup": args.warmup,
+            "seed": args.seed
+        },
+        "results": results
+    }
+
+
+def format_result(result):
+    return ("threads {threads:>2}  batch {batch_size:>3}  source {resolution:>5}px  "
+            "p50 {p50_ms:9.1f} ms  p95 {p95_ms:9.1f} ms  p99 {p99_ms:9.1f} ms  "
+            "{images_per_second:8.2f} img/s  peak RSS {peak_rss_mb:8.1f} MB").format(**result)
+
+
+def git_commit():
+    try:
+        output = subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=open(os.devnull, "w"),
+                                         cwd=os.path.dirname(os.path.abspath(__file__)))
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode("utf-8").strip()
+
+
+def parse_int_list(text):
+    return [int(value) for value in text.split(",") if value.strip() != ""]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='benchmark preprocessing and inference on synthetic radiographs')
+    parser.add_argument('--params', '-p', type=str, default=None,
+                        help='path to the file which stores network parameters; random weights if omitted.')
+    parser.add_argument('--backend', type=str, default='singa', choices=['singa', 'numpy'],
+                        help='inference engine to benchmark.')
+    parser.add_argument('--device', type=str, default=None,
+                        help='device to run inference on: cpu, cuda or cuda:N.')
+    parser.add_argument('--fold-bn', action='store_true',
+                        help='fold BatchNorm layers into the preceding convolutions first.')
+    parser.add_argument('--precision', type=str, default=None, choices=['fp32', 'fp16', 'bf16'],
+                        help='precision to hold convolution and Linear weights in.')
+    parser.add_argument('--static-plan', action='store_true',
+                        help='run the numpy backend through an execution plan compiled for each batch size.')
+    parser.add_argument('--batch-sizes', type=parse_int_list, default=[1, 4, 8],
+                        help='comma-separated batch sizes to sweep.')
+    parser.add_argument('--threads', type=parse_int_list, default=sorted(set([1, multiprocessing.cpu_count()])),
+                        help='comma-separated BLAS thread counts to sweep.')
+    parser.add_argument('--resolutions', type=parse_int_list, default=[512, 1024, 2048],
+                        help='comma-separated side lengths, in pixels, of the synthetic source images.')
+    parser.add_argument('--image-format', type=str, default='PNG', choices=['PNG', 'JPEG'],
+                        help='encoding of the synthetic source images.')
+    parser.add_argument('--iterations', type=int, default=20, help='timed batches per configuration.')
+    parser.add_argument('--warmup', type=int, default=2, help='untimed batches run first.')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the random weights and images.')
+    parser.add_argument('--output', '-o', type=str, default=None, help='write the results as JSON to this file.')
+    parser.add_argument('--run-one', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        args.batch_size = args.batch_sizes[0]
+        args.thread_count = args.threads[0]
+        args.resolution = args.resolutions[0]
+        print(json.dumps(run_configuration(args)))
+        sys.exit(0)
+
+    args.random_weights = args.params is None
+    temporary_weights = None
+    if args.random_weights:
+        from bone_age import weights
+
+        handle, temporary_weights = tempfile.mkstemp(suffix=".weights")
+        os.close(handle)
+        weights.save_random_weights(temporary_weights, seed=args.seed)
+        args.params = temporary_weights
+    try:
+        document = run_sweep(args)
+    finally:
+        if temporary_weights is not None:
+            os.remove(temporary_weights)
+
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            json.dump(document, output_file, indent=2)
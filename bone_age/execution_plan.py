@@ -0,0 +1,429 @@
+"""
+Static execution plans for the numpy backend's Xception.
+
+compile_plan walks the network once, in the order Xception.__call__ runs it, and flattens it
+into a list of steps. Each step is a kernel with its weights and constants already resolved:
+BatchNorm factors computed, depthwise taps sliced, weight matrices reshaped. Every value a step
+produces has a slot, and running the plan is a loop over the steps, each writing into its slot
+with out= arguments, with no layer dispatch and no allocation of intermediates.
+
+The slots live in one arena, allocated once for max_batch_size images and reused by every run.
+Each slot is live from the step that writes it to the last step that reads it, and slots whose
+lifetimes do not overlap share memory: offsets are assigned best-fit in step order, and
+elementwise steps write over their input when nothing reads it afterwards. Peak activation
+memory is therefore the size of the arena, known when the plan is compiled.
+"""
+import threading
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from bone_age import numpy_xception as nx
+from bone_age.weights import upcast_half
+
+
+# arena offsets are rounded up to this many float32 elements, 64 bytes
+ALIGNMENT = 16
+
+
+class Step(object):
+    """
+    One kernel of a plan: run(views) reads the views of its input slots and fills its output slot,
+    using its scratch slots as temporaries. An inplace step may be given its input's memory as output.
+    """
+
+    def __init__(self, name, kind, run, inputs, output, scratch=(), inplace=False):
+        self.name = name
+        self.kind = kind
+        self.run = run
+        self.inputs = inputs
+        self.output = output
+        self.scratch = list(scratch)
+        self.inplace = inplace
+
+
+class Slot(object):
+    """
+    A value in the plan, of shape (batch,) + shape. An alias has no memory of its own: it is a view
+    of alias_of, set by the step that produces it.
+    """
+
+    def __init__(self, shape, alias_of=None):
+        self.shape = tuple(shape)
+        self.alias_of = alias_of
+
+    def size(self, batch_size):
+        return batch_size * int(np.prod(self.shape))
+
+
+class ExecutionPlan(object):
+    """
+    Runs the flattened network on batches of up to max_batch_size images. Larger batches run in
+    chunks. The arena is shared, so concurrent calls to run take turns.
+    """
+
+    def __init__(self, slots, steps, input_slot, output_slot, max_batch_size):
+        self.slots = slots
+        self.steps = steps
+        self.input_slot = input_slot
+        self.output_slot = output_slot
+        self.max_batch_size = max_batch_size
+        self.lock = threading.Lock()
+        self.offsets, arena_size = assign_offsets(slots, steps, input_slot, output_slot, max_batch_size)
+        self.arena = np.empty(arena_size, dtype=np.float32)
+        self.views_by_batch_size = {}
+
+    def run(self, img_array):
+        n = len(img_array)
+        if n > self.max_batch_size:
+            return np.concatenate([self.run(img_array[start:start + self.max_batch_size])
+                                   for start in range(0, n, self.max_batch_size)])
+        with self.lock:
+            views = list(self.get_views(n))
+            views[self.input_slot] = img_array
+            for step in self.steps:
+                step.run(views)
+            return views[self.output_slot].copy()
+
+    def get_views(self, batch_size):
+        """ Returns the arena view of every slot for a batch, with None for the input and aliases. """
+        views = self.views_by_batch_size.get(batch_size)
+        if views is None:
+            views = []
+            for slot, offset in zip(self.slots, self.offsets):
+                if offset is None:
+                    views.append(None)
+                else:
+                    views.append(self.arena[offset:offset + slot.size(batch_size)]
+                                 .reshape((batch_size,) + slot.shape))
+            self.views_by_batch_size[batch_size] = views
+        return views
+
+    def arena_bytes(self):
+        return self.arena.nbytes
+
+    def unshared_bytes(self):
+        """ Returns the memory the slots would take for max_batch_size images if none were shared. """
+        return sum(slot.size(self.max_batch_size) * 4 for slot, offset in zip(self.slots, self.offsets)
+                   if offset is not None)
+
+
+class ArenaAllocator(object):
+    """ Best-fit assignment of offsets in an arena that grows as needed, in float32 elements. """
+
+    def __init__(self):
+        self.free_blocks = []
+        self.size = 0
+
+    def allocate(self, size):
+        size = align(size)
+        fits = [index for index, (_, block_size) in enumerate(self.free_blocks) if block_size >= size]
+        if len(fits) == 0:
+            # grow the arena, starting from a free block at its end if there is one
+            if len(self.free_blocks) > 0 and sum(self.free_blocks[-1]) == self.size:
+                offset = self.free_blocks.pop()[0]
+            else:
+                offset = self.size
+            self.size = offset + size
+            return offset
+        best = min(fits, key=lambda index: self.free_blocks[index][1])
+        offset, block_size = self.free_blocks.pop(best)
+        if block_size > size:
+            self.release(offset + size, block_size - size)
+        return offset
+
+    def release(self, offset, size):
+        size = align(size)
+        blocks = sorted(self.free_blocks + [(offset, size)])
+        merged = []
+        for block_offset, block_size in blocks:
+            if len(merged) > 0 and sum(merged[-1]) == block_offset:
+                merged[-1] = (merged[-1][0], merged[-1][1] + block_size)
+            else:
+                merged.append((block_offset, block_size))
+        self.free_blocks = merged
+
+
+def align(size):
+    return (size + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def memory_owner(slots, slot):
+    while slots[slot].alias_of is not None:
+        slot = slots[slot].alias_of
+    return slot
+
+
+def assign_offsets(slots, steps, input_slot, output_slot, max_batch_size):
+    """
+    Returns the arena offset of every slot (None for the input and aliases) and the arena size.
+    A slot's memory is released after the last step that reads it or any alias of it.
+    """
+    last_use = {}
+    for index, step in enumerate(steps):
+        for slot in step.inputs:
+            last_use[memory_owner(slots, slot)] = index
+    last_use[memory_owner(slots, output_slot)] = len(steps)
+
+    allocator = ArenaAllocator()
+    offsets = [None] * len(slots)
+    for index, step in enumerate(steps):
+        dying = [slot for slot in sorted(set(memory_owner(slots, slot) for slot in step.inputs))
+                 if last_use[slot] == index and slot != input_slot]
+        if slots[step.output].alias_of is None:
+            output_size = slots[step.output].size(max_batch_size)
+            donors = [slot for slot in dying if slots[slot].size(max_batch_size) == output_size]
+            if step.inplace and len(donors) > 0:
+                offsets[step.output] = offsets[donors[0]]
+                dying.remove(donors[0])
+            else:
+                offsets[step.output] = allocator.allocate(output_size)
+        for slot in step.scratch:
+            offsets[slot] = allocator.allocate(slots[slot].size(max_batch_size))
+        for slot in step.scratch + dying:
+            allocator.release(offsets[slot], slots[slot].size(max_batch_size))
+    return offsets, allocator.size
+
+
+class PlanBuilder(object):
+
+    def __init__(self):
+        self.slots = []
+        self.steps = []
+
+    def new_slot(self, shape, alias_of=None):
+        self.slots.append(Slot(shape, alias_of))
+        return len(self.slots) - 1
+
+    def add_step(self, name, kind, run, inputs, output, scratch=(), inplace=False):
+        self.steps.append(Step(name, kind, run, inputs, output, scratch, inplace))
+        return output
+
+    def emit_layer(self, name, layer, x):
+        """ Appends the steps computing layer(x) and returns the slot holding the result. """
+        if isinstance(layer, nx.Identity):
+            return x
+        elif isinstance(layer, nx.ReLU):
+            return self.emit_relu(name, x)
+        elif isinstance(layer, nx.BatchNorm2d):
+            return self.emit_batchnorm(name, layer, x)
+        elif isinstance(layer, nx.SeparableConv2d):
+            x = self.emit_layer(name + '.spacial_conv', layer.spacial_conv, x)
+            return self.emit_layer(name + '.depth_conv', layer.depth_conv, x)
+        elif isinstance(layer, nx.Conv2d):
+            if layer.group == layer.in_channels == layer.out_channels and layer.group > 1:
+                return self.emit_depthwise_conv2d(name, layer, x)
+            elif layer.group != 1:
+                raise NotImplementedError('grouped convolutions are only supported as depthwise convolutions')
+            elif layer.kernel_size == 1:
+                return self.emit_pointwise_conv2d(name, layer, x)
+            return self.emit_conv2d(name, layer, x)
+        elif isinstance(layer, nx.MaxPool2d):
+            return self.emit_max_pool2d(name, layer, x)
+        elif isinstance(layer, nx.Linear):
+            return self.emit_linear(name, layer, x)
+        elif isinstance(layer, nx.Block):
+            return self.emit_block(name, layer, x)
+        raise NotImplementedError('cannot compile a {} layer'.format(type(layer).__name__))
+
+    def emit_relu(self, name, x):
+        y = self.new_slot(self.slots[x].shape)
+
+        def run(views):
+            np.maximum(views[x], 0, out=views[y])
+        return self.add_step(name, 'relu', run, [x], y, inplace=True)
+
+    def emit_batchnorm(self, name, bn, x):
+        factor = bn.scale / np.sqrt(bn.running_var + nx.BN_EPSILON)
+        shift = (bn.bias - bn.running_mean * factor).reshape(1, -1, 1, 1)
+        factor = factor.reshape(1, -1, 1, 1)
+        y = self.new_slot(self.slots[x].shape)
+
+        def run(views):
+            np.multiply(views[x], factor, out=views[y])
+            views[y] += shift
+        return self.add_step(name, 'batchnorm', run, [x], y, inplace=True)
+
+    def emit_pad(self, name, x, padding, fill):
+        if padding == 0:
+            return x
+        c, h, w = self.slots[x].shape
+        y = self.new_slot((c, h + 2 * padding, w + 2 * padding))
+
+        def run(views):
+            # the arena holds other slots' values between runs, so the border is written every time
+            padded = views[y]
+            padded[:, :, :padding, :] = fill
+            padded[:, :, padding + h:, :] = fill
+            padded[:, :, padding:padding + h, :padding] = fill
+            padded[:, :, padding:padding + h, padding + w:] = fill
+            padded[:, :, padding:padding + h, padding:padding + w] = views[x]
+        return self.add_step(name + '.pad', 'pad', run, [x], y)
+
+    def emit_subsample(self, name, x, stride):
+        """ Gathers every stride-th row and column into a contiguous slot, as strided 1x1 convolutions read. """
+        if stride == 1:
+            return x
+        c, h, w = self.slots[x].shape
+        y = self.new_slot((c, nx.output_size(h, 1, stride, 0), nx.output_size(w, 1, stride, 0)))
+
+        def run(views):
+            np.copyto(views[y], views[x][:, :, ::stride, ::stride])
+        return self.add_step(name + '.subsample', 'subsample', run, [x], y)
+
+    def emit_conv2d(self, name, conv, x):
+        c, h, w = self.slots[x].shape
+        k, stride, out_channels = conv.kernel_size, conv.stride, conv.out_channels
+        ho = nx.output_size(h, k, stride, conv.padding)
+        wo = nx.output_size(w, k, stride, conv.padding)
+        padded = self.emit_pad(name, x, conv.padding, 0.0)
+        cols = self.new_slot((c * k * k, ho * wo))
+        W = conv.W
+        b = conv.b.reshape(1, -1, 1) if conv.b is not None else None
+
+        def im2col(views):
+            xp = views[padded]
+            sn, sc, sh, sw = xp.strides
+            windows = as_strided(xp, shape=(len(xp), c, k, k, ho, wo),
+                                 strides=(sn, sc, sh, sw, sh * stride, sw * stride))
+            np.copyto(views[cols].reshape(len(xp), c, k, k, ho, wo), windows)
+        self.add_step(name + '.im2col', 'im2col', im2col, [padded], cols)
+
+        y = self.new_slot((out_channels, ho, wo))
+
+        def run(views):
+            out = views[y].reshape(len(views[y]), out_channels, ho * wo)
+            np.matmul(upcast_half(W).reshape(out_channels, -1), views[cols], out=out)
+            if b is not None:
+                out += b
+        return self.add_step(name, 'conv2d', run, [cols], y)
+
+    def emit_depthwise_conv2d(self, name, conv, x):
+        c, h, w = self.slots[x].shape
+        k, stride = conv.kernel_size, conv.stride
+        ho = nx.output_size(h, k, stride, conv.padding)
+        wo = nx.output_size(w, k, stride, conv.padding)
+        padded = self.emit_pad(name, x, conv.padding, 0.0)
+        W = upcast_half(conv.W)
+        taps = [(i, j, np.ascontiguousarray(W[:, 0, i, j], dtype=np.float32).reshape(1, c, 1, 1))
+                for i in range(k) for j in range(k)]
+        b = conv.b.reshape(1, -1, 1, 1) if conv.b is not None else None
+        product = self.new_slot((c, ho, wo))
+        y = self.new_slot((c, ho, wo))
+
+        def run(views):
+            xp = views[padded]
+            out = views[y]
+            for index, (i, j, tap) in enumerate(taps):
+                window = xp[:, :, i:i + stride * (ho - 1) + 1:stride, j:j + stride * (wo - 1) + 1:stride]
+                if index == 0:
+                    np.multiply(window, tap, out=out)
+                else:
+                    np.multiply(window, tap, out=views[product])
+                    out += views[product]
+            if b is not None:
+                out += b
+        return self.add_step(name, 'depthwise_conv2d', run, [padded], y, scratch=[product])
+
+    def emit_pointwise_conv2d(self, name, conv, x):
+        x = self.emit_subsample(name, self.emit_pad(name, x, conv.padding, 0.0), conv.stride)
+        c, ho, wo = self.slots[x].shape
+        out_channels = conv.out_channels
+        W = conv.W
+        b = conv.b.reshape(1, -1, 1) if conv.b is not None else None
+        y = self.new_slot((out_channels, ho, wo))
+
+        def run(views):
+            n = len(views[x])
+            out = views[y].reshape(n, out_channels, ho * wo)
+            np.matmul(upcast_half(W).reshape(out_channels, c), views[x].reshape(n, c, ho * wo), out=out)
+            if b is not None:
+                out += b
+        return self.add_step(name, 'pointwise_conv2d', run, [x], y)
+
+    def emit_max_pool2d(self, name, pool, x):
+        c, h, w = self.slots[x].shape
+        k, stride = pool.kernel_size, pool.stride
+        ho = nx.output_size(h, k, stride, pool.padding)
+        wo = nx.output_size(w, k, stride, pool.padding)
+        padded = self.emit_pad(name, x, pool.padding, -np.inf)
+        y = self.new_slot((c, ho, wo))
+
+        def run(views):
+            xp = views[padded]
+            out = views[y]
+            for i in range(k):
+                for j in range(k):
+                    window = xp[:, :, i:i + stride * (ho - 1) + 1:stride, j:j + stride * (wo - 1) + 1:stride]
+                    if i == 0 and j == 0:
+                        np.copyto(out, window)
+                    else:
+                        np.maximum(out, window, out=out)
+        return self.add_step(name, 'max_pool2d', run, [padded], y)
+
+    def emit_flatten(self, name, x):
+        y = self.new_slot((int(np.prod(self.slots[x].shape)),), alias_of=x)
+
+        def run(views):
+            views[y] = views[x].reshape(len(views[x]), -1)
+        return self.add_step(name, 'flatten', run, [x], y)
+
+    def emit_linear(self, name, linear, x):
+        W = linear.W
+        b = linear.b
+        y = self.new_slot((W.shape[1],))
+
+        def run(views):
+            np.matmul(views[x], upcast_half(W), out=views[y])
+            if b is not None:
+                views[y] += b
+        return self.add_step(name, 'linear', run, [x], y)
+
+    def emit_add(self, name, a, b):
+        y = self.new_slot(self.slots[a].shape)
+
+        def run(views):
+            np.add(views[a], views[b], out=views[y])
+        return self.add_step(name, 'add', run, [a, b], y, inplace=True)
+
+    def emit_block(self, name, block, x):
+        y = x
+        for index, layer in enumerate(block.layers):
+            y = self.emit_layer('{}.layers.{}'.format(name, index), layer, y)
+        if block.skip is not None:
+            skip = self.emit_layer(name + '.skip', block.skip, x)
+            skip = self.emit_layer(name + '.skipbn', block.skipbn, skip)
+        else:
+            skip = x
+        return self.emit_add(name + '.add', y, skip)
+
+
+def compile_plan(model, max_batch_size=8, size=299):
+    """ Flattens model, as Xception.__call__ runs it, into an ExecutionPlan for size x size images. """
+    builder = PlanBuilder()
+    input_slot = builder.new_slot((1, size, size))
+
+    x = input_slot
+    for name in ['conv1', 'bn1']:
+        x = builder.emit_layer(name, getattr(model, name), x)
+    x = builder.emit_relu('relu1', x)
+    for name in ['conv2', 'bn2']:
+        x = builder.emit_layer(name, getattr(model, name), x)
+    x = builder.emit_relu('relu2', x)
+    for name in ['block1', 'block2', 'block3', 'block4', 'block5', 'block6', 'block7', 'block8', 'conv3', 'bn3']:
+        x = builder.emit_layer(name, getattr(model, name), x)
+    x = builder.emit_relu('relu3', x)
+    for name in ['conv4', 'bn4']:
+        x = builder.emit_layer(name, getattr(model, name), x)
+
+    x = builder.emit_relu('relu4', x)
+    x = builder.emit_layer('globalpooling', model.globalpooling, x)
+    x = builder.emit_flatten('flatten', x)
+    x = builder.emit_layer('fc', model.fc, x)
+
+    x = builder.emit_relu('relu5', x)
+    x = builder.emit_layer('linear1', model.linear1, x)
+    x = builder.emit_relu('relu6', x)
+    x = builder.emit_layer('linear2', model.linear2, x)
+
+    return ExecutionPlan(builder.slots, builder.steps, input_slot, x, max_batch_size)
@@ -7,9 +7,12 @@ from singa import tensor
 from singa import autograd
 from singa import opt
 
+from bone_age import metrics
+from bone_age import weights
+from bone_age.utils import image2array, images2array, check_gender, make_prediction, checked_transform
+
 import pickle
 
-from PIL import Image
 import numpy as np
 
 
@@ -55,48 +58,42 @@ class Block(autograd.Layer):
         if strides != 1:
             self.layers.append(autograd.MaxPool2d(3, strides, padding + 1))
     
-    def dump_params(self, opened_file):
-        for layer in self.layers:
-            if isinstance(layer, autograd.ReLU) or isinstance(layer, autograd.MaxPool2d):
-                pass
-
-            elif isinstance(layer, autograd.BatchNorm2d):
-                dump_pytensor(layer.scale, opened_file)
-                dump_pytensor(layer.bias, opened_file)
-                dump_pytensor(layer.running_mean, opened_file)
-                dump_pytensor(layer.running_var, opened_file)
-
+    def named_params(self):
+        """ Returns (name, tensor) pairs for the block's parameters, in the order they are pickled. """
+        params = []
+        for i, layer in enumerate(self.layers):
+            if isinstance(layer, autograd.BatchNorm2d):
+                params.extend(batchnorm_params('layers.{}'.format(i), layer))
             elif isinstance(layer, autograd.SeparableConv2d):
-                dump_pytensor(layer.spacial_conv.W, opened_file)
-                dump_pytensor(layer.depth_conv.W, opened_file)
+                params.extend(separable_conv_params('layers.{}'.format(i), layer))
         if self.skip is not None:
-            dump_pytensor(self.skip.W, opened_file)
-            dump_pytensor(self.skipbn.scale, opened_file)
-            dump_pytensor(self.skipbn.bias, opened_file)
-            dump_pytensor(self.skipbn.running_mean, opened_file)
-            dump_pytensor(self.skipbn.running_var, opened_file)
+            params.extend(conv_params('skip', self.skip))
+            if not isinstance(self.skipbn, Identity):
+                params.extend(batchnorm_params('skipbn', self.skipbn))
+        return params
 
-    def load_params(self, opened_file):
-        for layer in self.layers:
-            if isinstance(layer, autograd.ReLU) or isinstance(layer, autograd.MaxPool2d):
-                pass
+    def params(self):
+        return [param for _, param in self.named_params()]
 
-            elif isinstance(layer, autograd.BatchNorm2d):
-                load_nptensor(layer.scale, opened_file)
-                load_nptensor(layer.bias, opened_file)
-                load_nptensor(layer.running_mean, opened_file)
-                load_nptensor(layer.running_var, opened_file)
+    def dump_params(self, opened_file):
+        for param in self.params():
+            dump_pytensor(param, opened_file)
 
-            elif isinstance(layer, autograd.SeparableConv2d):
-                load_nptensor(layer.spacial_conv.W, opened_file)
-                load_nptensor(layer.depth_conv.W, opened_file)
-        if self.skip is not None:
-            load_nptensor(self.skip.W, opened_file)
-            load_nptensor(self.skipbn.scale, opened_file)
-            load_nptensor(self.skipbn.bias, opened_file)
-            load_nptensor(self.skipbn.running_mean, opened_file)
-            load_nptensor(self.skipbn.running_var, opened_file)
+    def load_params(self, opened_file):
+        for param in self.params():
+            load_nptensor(param, opened_file)
 
+    def fold_batchnorm(self):
+        layers = []
+        for layer in self.layers:
+            if isinstance(layer, autograd.BatchNorm2d) and isinstance(layers[-1], autograd.SeparableConv2d):
+                layers[-1].depth_conv = fold_batchnorm_into_conv(layers[-1].depth_conv, layer)
+            else:
+                layers.append(layer)
+        self.layers = layers
+        if self.skip is not None:
+            self.skip = fold_batchnorm_into_conv(self.skip, self.skipbn)
+            self.skipbn = Identity()
 
     def __call__(self, x):
         y = self.layers[0](x)
@@ -113,6 +110,55 @@ class Block(autograd.Layer):
         y = autograd.add(y, skip)
         return y
 
+class Identity(autograd.Layer):
+    """ Stands in for a BatchNorm2d layer that has been folded into its convolution. """
+
+    def __call__(self, x):
+        return x
+
+# epsilon used by SINGA's BatchNorm2d kernels
+BN_EPSILON = 1e-5
+
+def fold_batchnorm_into_conv(conv, bn):
+    """
+    Returns a biased Conv2d that computes conv followed by bn in inference mode,
+    i.e. with bn's running statistics. The new tensors live on the same device as conv's.
+    """
+    W = tensor.to_numpy(conv.W)
+    if conv.bias is True:
+        b = tensor.to_numpy(conv.b).reshape(-1)
+    else:
+        b = np.zeros(W.shape[0], dtype=np.float32)
+    factor = tensor.to_numpy(bn.scale).reshape(-1) / np.sqrt(tensor.to_numpy(bn.running_var).reshape(-1) + BN_EPSILON)
+    fused_W = W * factor.reshape(-1, 1, 1, 1)
+    fused_b = (b - tensor.to_numpy(bn.running_mean).reshape(-1)) * factor + tensor.to_numpy(bn.bias).reshape(-1)
+
+    fused = autograd.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, stride=conv.stride,
+                            padding=conv.padding, group=conv.group, bias=True)
+    fused.W.copy_from_numpy(fused_W.astype(np.float32))
+    fused.b.copy_from_numpy(fused_b.astype(np.float32))
+    fused.W.to_device(conv.W.device)
+    fused.b.to_device(conv.W.device)
+    return fused
+
+def batchnorm_params(prefix, layer):
+    return [(prefix + '.scale', layer.scale), (prefix + '.bias', layer.bias),
+            (prefix + '.running_mean', layer.running_mean), (prefix + '.running_var', layer.running_var)]
+
+def conv_params(prefix, layer):
+    """ W, and b for a layer with a bias, such as a convolution that a BatchNorm2d was folded into. """
+    params = [(prefix + '.W', layer.W)]
+    if layer.bias is True:
+        params.append((prefix + '.b', layer.b))
+    return params
+
+def separable_conv_params(prefix, layer):
+    return conv_params(prefix + '.spacial_conv', layer.spacial_conv) + conv_params(prefix + '.depth_conv', layer.depth_conv)
+
+def check_not_folded(model):
+    if getattr(model, 'batchnorm_folded', False):
+        raise ValueError('a model with folded BatchNorm layers cannot be dumped')
+
 def dump_pytensor(pytensor, file):
     np_tensor=tensor.to_numpy(pytensor)
     pickle.dump(np_tensor, file)
@@ -175,66 +221,77 @@ class Xception(autograd.Layer):
         self.linear1 = autograd.Linear(1000,256)
         self.linear2 = autograd.Linear(256,2)
 
-        self.layers_with_params = [self.conv1, self.bn1, self.conv2, self.bn2, self.block1, self.block2, self.block3,
-                                   self.block4, self.block5, self.block6, self.block7, self.block8, self.conv3, self.bn3, 
-                                   self.conv4, self.bn4, self.fc, self.linear1, self.linear2]
+        self.layer_names = ['conv1', 'bn1', 'conv2', 'bn2', 'block1', 'block2', 'block3',
+                            'block4', 'block5', 'block6', 'block7', 'block8', 'conv3', 'bn3',
+                            'conv4', 'bn4', 'fc', 'linear1', 'linear2']
+        self.layers_with_params = [getattr(self, name) for name in self.layer_names]
+
+    def named_params(self):
+        """ Returns (name, tensor) pairs for every parameter of the network, in the order they are pickled. """
+        params = []
+        for name, layer in zip(self.layer_names, self.layers_with_params):
+            if isinstance(layer, (autograd.Conv2d, autograd.Linear)):
+                params.extend(conv_params(name, layer))
+            elif isinstance(layer, autograd.BatchNorm2d):
+                params.extend(batchnorm_params(name, layer))
+            elif isinstance(layer, autograd.SeparableConv2d):
+                params.extend(separable_conv_params(name, layer))
+            elif isinstance(layer, Block):
+                params.extend((name + '.' + param_name, param) for param_name, param in layer.named_params())
+            elif isinstance(layer, Identity):
+                pass
+            else:
+                raise ValueError
+        return params
+
+    def params(self):
+        return [param for _, param in self.named_params()]
+
     def dump_params(self, pickle_file):
+        check_not_folded(self)
         with open(pickle_file,'wb') as file:
-            for layer in self.layers_with_params:
-                if isinstance(layer, autograd.Conv2d):
-                    dump_pytensor(layer.W, file)
-                    if layer.bias is True:
-                        dump_pytensor(layer.b, file)
-                
-                elif isinstance(layer, autograd.BatchNorm2d):
-                    dump_pytensor(layer.scale, file)
-                    dump_pytensor(layer.bias, file)
-                    dump_pytensor(layer.running_mean, file)
-                    dump_pytensor(layer.running_var, file)
-
-                elif isinstance(layer, autograd.SeparableConv2d):
-                    dump_pytensor(layer.spacial_conv.W, file)
-                    dump_pytensor(layer.depth_conv.W, file)
-
-                elif isinstance(layer, autograd.Linear):
-                    dump_pytensor(layer.W, file)
-                    if layer.bias is True:
-                        dump_pytensor(layer.b, file)
-
-                elif isinstance(layer, Block):
-                    layer.dump_params(file)
-                else:
-                    raise ValueError
-        file.close()
+            for param in self.params():
+                dump_pytensor(param, file)
 
     def load_params(self, pickle_file):
-        file= open(pickle_file, 'rb')
-        for layer in self.layers_with_params:
-                if isinstance(layer, autograd.Conv2d):
-                    load_nptensor(layer.W, file)
-                    if layer.bias is True:
-                        load_nptensor(layer.b, file)
-                
-                elif isinstance(layer, autograd.BatchNorm2d):
-                    load_nptensor(layer.scale, file)
-                    load_nptensor(layer.bias, file)
-                    load_nptensor(layer.running_mean, file)
-                    load_nptensor(layer.running_var, file)
-
-                elif isinstance(layer, autograd.SeparableConv2d):
-                    load_nptensor(layer.spacial_conv.W, file)
-                    load_nptensor(layer.depth_conv.W, file)
-
-                elif isinstance(layer, autograd.Linear):
-                    load_nptensor(layer.W, file)
-                    if layer.bias is True:
-                        load_nptensor(layer.b, file)
-
-                elif isinstance(layer, Block):
-                    layer.load_params(file)
-                else:
-                    raise ValueError
-        file.close()
+        with open(pickle_file, 'rb') as file:
+            for param in self.params():
+                load_nptensor(param, file)
+
+    def dump_weights(self, weights_file, precision="fp32"):
+        check_not_folded(self)
+        weights.save_weights(weights_file, weights.with_precision(
+            [(name, tensor.to_numpy(param)) for name, param in self.named_params()], precision))
+
+    def load_weights(self, weights_file):
+        arrays = weights.load_weights(weights_file)
+        for name, param in self.named_params():
+            if name not in arrays:
+                raise ValueError('{} is missing from {}'.format(name, weights_file))
+            if arrays[name].shape != tuple(param.shape):
+                raise ValueError('{} has shape {} in {}, expected {}'
+                                 .format(name, arrays[name].shape, weights_file, tuple(param.shape)))
+            # SINGA computes in float32, so half-precision weights are widened on load
+            param.copy_from_numpy(np.ascontiguousarray(weights.upcast_half(arrays[name]), dtype=np.float32))
+
+    def fold_batchnorm(self):
+        """
+        Folds every BatchNorm2d into the convolution in front of it. The model is
+        inference-only afterwards and its params can no longer be dumped.
+        """
+        self.conv1 = fold_batchnorm_into_conv(self.conv1, self.bn1)
+        self.bn1 = Identity()
+        self.conv2 = fold_batchnorm_into_conv(self.conv2, self.bn2)
+        self.bn2 = Identity()
+        for block in [self.block1, self.block2, self.block3, self.block4,
+                      self.block5, self.block6, self.block7, self.block8]:
+            block.fold_batchnorm()
+        self.conv3.depth_conv = fold_batchnorm_into_conv(self.conv3.depth_conv, self.bn3)
+        self.bn3 = Identity()
+        self.conv4.depth_conv = fold_batchnorm_into_conv(self.conv4.depth_conv, self.bn4)
+        self.bn4 = Identity()
+        self.layers_with_params = [getattr(self, name) for name in self.layer_names]
+        self.batchnorm_folded = True
 
     def features(self, input):
         x = self.conv1(input)
@@ -281,44 +338,88 @@ class Xception(autograd.Layer):
 
         return x
 
-def load_model(params_file):
-	model = Xception()
-	model.load_params(params_file)
-	return model
+_devices = {}
 
-def image2array(file, size=299):
-    im=Image.open(file)
-    im=im.resize((size, size), Image.BILINEAR)
-    im=im.convert('L')
-    im_array = np.asarray(im).astype(np.float32)
-    im_array /= 255
-    im_array=np.expand_dims(im_array, 0)
-    im_array=np.expand_dims(im_array, 1)
-    return im_array
+def get_device(device_spec='cuda:0'):
+    """
+    Returns the SINGA device described by device_spec, creating it on first use.
+    Accepted specs are 'cpu', 'cuda' (GPU 0) and 'cuda:N' (GPU N).
+    """
+    device_spec = device_spec.strip().lower()
+    if device_spec not in _devices:
+        if device_spec == 'cpu':
+            _devices[device_spec] = device.get_default_device()
+        elif device_spec == 'cuda' or device_spec.startswith('cuda:'):
+            gpu_id = device_spec.partition(':')[2] or '0'
+            if not gpu_id.isdigit():
+                raise ValueError('invalid GPU id in device spec: {}'.format(device_spec))
+            _devices[device_spec] = device.create_cuda_gpu_on(int(gpu_id))
+        else:
+            raise ValueError('device must be cpu, cuda or cuda:N, got {}'.format(device_spec))
+    return _devices[device_spec]
+
+
+def load_model(params_file, device_spec='cuda:0', fold_bn=False, precision=None, plan_batch_size=None):
+    if precision not in (None, 'fp32'):
+        raise ValueError('the singa backend computes in float32 only; --precision {} needs --backend numpy'
+                         .format(precision))
+    if plan_batch_size is not None:
+        raise ValueError('static execution plans are only compiled for the numpy backend')
+    model = Xception()
+    if weights.is_weights_file(params_file):
+        model.load_weights(params_file)
+    else:
+        model.load_params(params_file)
+    model.device = get_device(device_spec)
+    for param in model.params():
+        param.to_device(model.device)
+    if fold_bn:
+        fold_batchnorm(model)
+    return model
+
+def fold_batchnorm(model, check_input=None, tolerance=1e-3):
+    """
+    Folds the model's BatchNorm layers into their convolutions and checks that the output
+    still matches the unfolded model. Returns the largest absolute difference.
+    """
+    return checked_transform(model, forward, Xception.fold_batchnorm, check_input, tolerance)
 
-dev = device.create_cuda_gpu()
+def forward(model, img_array):
+    """ Runs an NCHW float32 batch through the network and returns its (N, 2) output as a numpy array. """
+    autograd.training=False
+    with metrics.DEVICE_TRANSFER.time():
+        inputs = tensor.Tensor(device=model.device, data=img_array, requires_grad=False, stores_grad=False)
+    with metrics.FORWARD.time():
+        y=model(inputs)
+    # on a GPU the kernels run asynchronously, so this also waits for the forward pass to finish
+    with metrics.TO_NUMPY.time():
+        return tensor.to_numpy(y)
+
+def synchronize(model):
+    """ Waits for the kernels queued on the model's device, so that host-side timings include them. """
+    sync = getattr(model.device, 'Sync', None)
+    if sync is not None:
+        sync()
 
 def predict(img, gender, model, args=None):
 
-    assert gender =='female' or gender == 'male', 'please input gender(female or male)'
+    check_gender(gender)
 
-    autograd.training=False
     img_array=image2array(img)
+    y_np=forward(model, img_array)[0]
 
-    inputs = tensor.Tensor(device=dev, data=img_array, requires_grad=False, stores_grad=False)
+    return make_prediction(y_np, gender)
 
-    y=model(inputs)
+def predict_outputs(imgs, model, args=None):
+    """ Returns the raw (N, 2) network output for a list of images. """
+    img_array=images2array(imgs)
+    return forward(model, img_array)
 
-    y_np=tensor.to_numpy(y)[0]
-    
-    for l in range(len(y_np)):
-            if y_np[l] <= 0:
-                y_np[l] = 1
-            
-    prediction={}
-    if gender == 'female':
-        prediction['predicted bone age'] = float(y_np[0])
-    else:
-        prediction['predicted bone age'] = float(y_np[1])
+def predict_batch(imgs, genders, model, args=None):
+
+    for gender in genders:
+        check_gender(gender)
+
+    y_np=predict_outputs(imgs, model, args)
 
-    return prediction
+    return [make_prediction(y_row, gender) for y_row, gender in zip(y_np, genders)]
@@ -0,0 +1,273 @@
+"""
+Latency histograms and gauges for the prediction path, rendered in the Prometheus text format.
+
+Recording is off until enable() is called. While it is off, timing a stage costs one attribute
+lookup and a shared no-op context manager, so the instrumentation can stay in the hot path:
+
+    with metrics.FORWARD.time():
+        y = model(inputs)
+
+With --workers, enable_multiprocess() puts every metric in shared memory before the workers are
+forked, with one row per worker. Each worker records into its own row, and /metrics on any worker
+reports the sum over all of them.
+"""
+import bisect
+import multiprocessing.sharedctypes
+import os
+import threading
+import time
+
+
+enabled = False
+
+# set by enable_multiprocess(): one row of shared_row_size doubles per worker
+shared_values = None
+shared_row_size = 0
+shared_workers = 0
+# set by set_worker() in each forked worker; processes forked from a worker, such as its
+# preprocessing pool, have another pid and record locally instead
+worker_row = None
+worker_pid = None
+# how often each worker copies its gauges into shared memory
+GAUGE_PUBLISH_SECONDS = 1.0
+
+# upper bounds, in seconds, of the stage latency buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+registry = []
+
+
+class NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class Timer(object):
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.histogram.observe(time.time() - self.start)
+        return False
+
+
+class Histogram(object):
+    """
+    Cumulative histogram of observed values. labels is a dict of label names to values; metrics
+    that share a name are rendered as one family.
+    """
+
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS, labels=None):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.labels = labels or {}
+        self.lock = threading.Lock()
+        # the bucket counts, the +Inf bucket, the sum and the count
+        self.size = len(self.buckets) + 3
+        self.local_values = [0.0] * self.size
+        self.offset = 0
+        registry.append(self)
+
+    def time(self):
+        if not enabled:
+            return NULL_TIMER
+        return Timer(self)
+
+    def observe(self, value):
+        if not enabled:
+            return
+        index = bisect.bisect_left(self.buckets, value)
+        values, start = storage(self)
+        with self.lock:
+            values[start + index] += 1
+            values[start + self.size - 2] += value
+            values[start + self.size - 1] += 1
+
+    def samples(self):
+        if shared_values is None:
+            with self.lock:
+                values = list(self.local_values)
+        else:
+            values = sum_worker_rows(self)
+        bucket_counts = [int(bucket_count) for bucket_count in values[:-2]]
+        total = values[-2]
+        count = int(values[-1])
+        lines = []
+        cumulative = 0
+        for upper_bound, bucket_count in zip(self.buckets + (float("inf"),), bucket_counts):
+            cumulative += bucket_count
+            lines.append(format_sample(self.name + "_bucket", self.labels, cumulative,
+                                       le=format_value(upper_bound)))
+        lines.append(format_sample(self.name + "_sum", self.labels, total))
+        lines.append(format_sample(self.name + "_count", self.labels, count))
+        return lines
+
+    def metric_type(self):
+        return "histogram"
+
+
+class Gauge(object):
+    """
+    A value read from read_value() whenever the metrics are rendered; read_value returns None
+    when there is nothing to report.
+    """
+
+    def __init__(self, name, documentation, read_value=None, labels=None):
+        self.name = name
+        self.documentation = documentation
+        self.read_value = read_value
+        self.labels = labels or {}
+        self.size = 1
+        self.local_values = [float("nan")]
+        self.offset = 0
+        registry.append(self)
+
+    def current_value(self):
+        return self.read_value() if self.read_value is not None else None
+
+    def publish(self):
+        """ Copies the current value into this worker's row; NaN stands for None. """
+        value = self.current_value()
+        values, start = storage(self)
+        values[start] = float("nan") if value is None else value
+
+    def samples(self):
+        if shared_values is None:
+            value = self.current_value()
+        else:
+            if worker_row is not None:
+                self.publish()
+            worker_values = [worker_value for worker_value in sum_worker_rows(self, total=False)
+                             if worker_value == worker_value]
+            value = sum(worker_values) if len(worker_values) > 0 else None
+        if value is None:
+            return []
+        return [format_sample(self.name, self.labels, value)]
+
+    def metric_type(self):
+        return "gauge"
+
+
+def stage_histogram(stage):
+    return Histogram("bone_age_stage_seconds", "Time spent in each stage of the prediction path.",
+                     labels={"stage": stage})
+
+
+TOKEN_LOOKUP = stage_histogram("token_lookup")
+QUOTA_UPDATE = stage_histogram("quota_update")
+MULTIPART_PARSING = stage_histogram("multipart_parsing")
+IMAGE2ARRAY = stage_histogram("image2array")
+DEVICE_TRANSFER = stage_histogram("device_transfer")
+FORWARD = stage_histogram("forward")
+TO_NUMPY = stage_histogram("to_numpy")
+BATCH_SIZE = Histogram("bone_age_batch_size", "Images in each forward pass of the batching predictor.",
+                       buckets=BATCH_SIZE_BUCKETS)
+QUEUE_DEPTH = Gauge("bone_age_queue_depth", "Images queued for, or being decoded into, the batching predictor's batches.")
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def enable_multiprocess(workers):
+    """
+    Moves every metric into shared memory with one row for each of workers processes. Call it
+    before the workers are forked, then set_worker(index) in each of them.
+    """
+    global shared_values, shared_row_size, shared_workers
+    offset = 0
+    for metric in registry:
+        metric.offset = offset
+        offset += metric.size
+    shared_row_size = offset
+    shared_workers = workers
+    shared_values = multiprocessing.sharedctypes.RawArray('d', shared_row_size * workers)
+    for metric in registry:
+        if isinstance(metric, Gauge):
+            for row in range(workers):
+                shared_values[row * shared_row_size + metric.offset] = float("nan")
+
+
+def set_worker(index):
+    """
+    Makes this forked worker record into row index. A restarted worker takes over the row of
+    the one it replaces, so counts carry on rather than starting again from zero.
+    """
+    global worker_row, worker_pid
+    if shared_values is None:
+        return
+    worker_row = index
+    worker_pid = os.getpid()
+    publisher = threading.Thread(target=publish_gauges, name="metrics-gauges")
+    publisher.daemon = True
+    publisher.start()
+
+
+def publish_gauges():
+    while True:
+        for metric in registry:
+            if isinstance(metric, Gauge):
+                metric.publish()
+        time.sleep(GAUGE_PUBLISH_SECONDS)
+
+
+def storage(metric):
+    """ Returns (values, start): where this process records metric's values. """
+    if worker_row is not None and os.getpid() == worker_pid:
+        return shared_values, worker_row * shared_row_size + metric.offset
+    return metric.local_values, 0
+
+
+def sum_worker_rows(metric, total=True):
+    """ Returns metric's values summed over the workers' rows, or with total=False one value per row. """
+    rows = [shared_values[row * shared_row_size + metric.offset:row * shared_row_size + metric.offset + metric.size]
+            for row in range(shared_workers)]
+    if not total:
+        return [row_values[0] for row_values in rows]
+    return [sum(row_values[index] for row_values in rows) for index in range(metric.size)]
+
+
+def render():
+    """ Returns every registered metric in the Prometheus text exposition format. """
+    lines = []
+    described = set()
+    for metric in registry:
+        samples = metric.samples()
+        if metric.name not in described:
+            lines.append("# HELP {} {}".format(metric.name, metric.documentation))
+            lines.append("# TYPE {} {}".format(metric.name, metric.metric_type()))
+            described.add(metric.name)
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+
+def format_sample(name, labels, value, le=None):
+    pairs = sorted(labels.items())
+    if le is not None:
+        pairs.append(("le", le))
+    if len(pairs) == 0:
+        return "{} {}".format(name, format_value(value))
+    label_text = ",".join('{}="{}"'.format(key, label_value) for key, label_value in pairs)
+    return "{}{{{}}} {}".format(name, label_text, format_value(value))
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
@@ -0,0 +1,559 @@
+"""
+The bone age Xception network implemented with vectorised numpy, for CPU inference without SINGA.
+
+The classes mirror those of inference_bone_age layer for layer, and give every parameter the same
+name, so both backends read the same pickled params and weights files. Regular convolutions
+run as im2col followed by one GEMM, pointwise convolutions as a GEMM over channels, and the
+depthwise half of each SeparableConv2d as a batched multiply-accumulate over the kernel taps.
+"""
+import pickle
+import sys
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from bone_age import metrics
+from bone_age import weights
+from bone_age.utils import image2array, images2array, check_gender, make_prediction, checked_transform
+
+
+# epsilon used by SINGA's BatchNorm2d kernels, which produced the trained statistics
+BN_EPSILON = 1e-5
+
+
+class Layer(object):
+
+    def param_refs(self):
+        """ Returns (name, owner, attribute) triples locating each parameter array. """
+        return []
+
+
+class ReLU(Layer):
+
+    def __call__(self, x):
+        return np.maximum(x, 0)
+
+
+class Identity(Layer):
+    """ Stands in for a BatchNorm2d layer that has been folded into its convolution. """
+
+    def __call__(self, x):
+        return x
+
+
+class Conv2d(Layer):
+
+    def __init__(self, in_channels, out_channels, kernel_size, stride=1, padding=0, group=1, bias=True):
+        self.in_channels = in_channels
+        self.out_channels = out_channels
+        self.kernel_size = kernel_size
+        self.stride = stride
+        self.padding = padding
+        self.group = group
+        self.bias = bias
+        self.W = np.zeros((out_channels, in_channels // group, kernel_size, kernel_size), dtype=np.float32)
+        self.b = np.zeros((out_channels,), dtype=np.float32) if bias else None
+
+    def param_refs(self):
+        refs = [('W', self, 'W')]
+        if self.bias:
+            refs.append(('b', self, 'b'))
+        return refs
+
+    def __call__(self, x):
+        W = weights.upcast_half(self.W)
+        if self.group == 1:
+            return conv2d(x, W, self.b, self.stride, self.padding)
+        elif self.group == self.in_channels == self.out_channels:
+            return depthwise_conv2d(x, W, self.b, self.stride, self.padding)
+        raise NotImplementedError('grouped convolutions are only supported as depthwise convolutions')
+
+
+class SeparableConv2d(Layer):
+
+    def __init__(self, in_channels, out_channels, kernel_size, stride=1, padding=0, bias=False):
+        self.spacial_conv = Conv2d(in_channels, in_channels, kernel_size, stride, padding,
+                                   group=in_channels, bias=bias)
+        self.depth_conv = Conv2d(in_channels, out_channels, 1, bias=bias)
+
+    def param_refs(self):
+        return (prefixed_refs('spacial_conv', self.spacial_conv.param_refs()) +
+                prefixed_refs('depth_conv', self.depth_conv.param_refs()))
+
+    def __call__(self, x):
+        return self.depth_conv(self.spacial_conv(x))
+
+
+class BatchNorm2d(Layer):
+
+    def __init__(self, num_features):
+        self.channels = num_features
+        self.scale = np.ones((num_features,), dtype=np.float32)
+        self.bias = np.zeros((num_features,), dtype=np.float32)
+        self.running_mean = np.zeros((num_features,), dtype=np.float32)
+        self.running_var = np.ones((num_features,), dtype=np.float32)
+
+    def param_refs(self):
+        return [(name, self, name) for name in ['scale', 'bias', 'running_mean', 'running_var']]
+
+    def __call__(self, x):
+        factor = self.scale / np.sqrt(self.running_var + BN_EPSILON)
+        shift = self.bias - self.running_mean * factor
+        y = x * factor.reshape(1, -1, 1, 1)
+        y += shift.reshape(1, -1, 1, 1)
+        return y
+
+
+class MaxPool2d(Layer):
+
+    def __init__(self, kernel_size, stride=None, padding=0):
+        self.kernel_size = kernel_size
+        self.stride = kernel_size if stride is None else stride
+        self.padding = padding
+
+    def __call__(self, x):
+        return max_pool2d(x, self.kernel_size, self.stride, self.padding)
+
+
+class Linear(Layer):
+
+    def __init__(self, in_features, out_features, bias=True):
+        self.bias = bias
+        self.W = np.zeros((in_features, out_features), dtype=np.float32)
+        self.b = np.zeros((out_features,), dtype=np.float32) if bias else None
+
+    def param_refs(self):
+        refs = [('W', self, 'W')]
+        if self.bias:
+            refs.append(('b', self, 'b'))
+        return refs
+
+    def __call__(self, x):
+        y = np.dot(x, weights.upcast_half(self.W))
+        if self.b is not None:
+            y += self.b
+        return y
+
+
+class Block(Layer):
+
+    def __init__(self, in_filters, out_filters, reps, strides=1, padding=0, start_with_relu=True, grow_first=True):
+        if out_filters != in_filters or strides != 1:
+            self.skip = Conv2d(in_filters, out_filters, 1, stride=strides, padding=padding, bias=False)
+            self.skipbn = BatchNorm2d(out_filters)
+        else:
+            self.skip = None
+
+        self.layers = []
+
+        filters = in_filters
+        if grow_first:
+            self.layers.append(ReLU())
+            self.layers.append(SeparableConv2d(in_filters, out_filters, 3, stride=1, padding=1, bias=False))
+            self.layers.append(BatchNorm2d(out_filters))
+            filters = out_filters
+
+        for i in range(reps - 1):
+            self.layers.append(ReLU())
+            self.layers.append(SeparableConv2d(filters, filters, 3, stride=1, padding=1, bias=False))
+            self.layers.append(BatchNorm2d(filters))
+
+        if not grow_first:
+            self.layers.append(ReLU())
+            self.layers.append(SeparableConv2d(in_filters, out_filters, 3, stride=1, padding=1, bias=False))
+            self.layers.append(BatchNorm2d(out_filters))
+
+        if not start_with_relu:
+            self.layers = self.layers[1:]
+
+        if strides != 1:
+            self.layers.append(MaxPool2d(3, strides, padding + 1))
+
+    def param_refs(self):
+        refs = []
+        for i, layer in enumerate(self.layers):
+            refs.extend(prefixed_refs('layers.{}'.format(i), layer.param_refs()))
+        if self.skip is not None:
+            refs.extend(prefixed_refs('skip', self.skip.param_refs()))
+            refs.extend(prefixed_refs('skipbn', self.skipbn.param_refs()))
+        return refs
+
+    def fold_batchnorm(self):
+        layers = []
+        for layer in self.layers:
+            if isinstance(layer, BatchNorm2d) and isinstance(layers[-1], SeparableConv2d):
+                layers[-1].depth_conv = fold_batchnorm_into_conv(layers[-1].depth_conv, layer)
+            else:
+                layers.append(layer)
+        self.layers = layers
+        if self.skip is not None:
+            self.skip = fold_batchnorm_into_conv(self.skip, self.skipbn)
+            self.skipbn = Identity()
+
+    def __call__(self, x):
+        y = x
+        for layer in self.layers:
+            y = layer(y)
+
+        if self.skip is not None:
+            skip = self.skipbn(self.skip(x))
+        else:
+            skip = x
+        y += skip
+        return y
+
+
+class Xception(Layer):
+    """
+    numpy twin of inference_bone_age.Xception.
+    """
+
+    def __init__(self):
+        num_classes = 1000
+        self.num_classes = num_classes
+
+        self.conv1 = Conv2d(1, 32, 3, 2, 0, bias=False)
+        self.bn1 = BatchNorm2d(32)
+
+        self.conv2 = Conv2d(32, 64, 3, 1, 1, bias=False)
+        self.bn2 = BatchNorm2d(64)
+
+        self.block1 = Block(64, 128, 2, 2, padding=0, start_with_relu=False, grow_first=True)
+        self.block2 = Block(128, 256, 2, 2, padding=0, start_with_relu=True, grow_first=True)
+        self.block3 = Block(256, 728, 2, 2, padding=0, start_with_relu=True, grow_first=True)
+
+        self.block4 = Block(728, 728, 3, 1, start_with_relu=True, grow_first=True)
+        self.block5 = Block(728, 728, 3, 1, start_with_relu=True, grow_first=True)
+        self.block6 = Block(728, 728, 3, 1, start_with_relu=True, grow_first=True)
+        self.block7 = Block(728, 728, 3, 1, start_with_relu=True, grow_first=True)
+
+        self.block8 = Block(728, 1024, 2, 2, start_with_relu=True, grow_first=False)
+
+        self.conv3 = SeparableConv2d(1024, 1536, 3, 1, 1)
+        self.bn3 = BatchNorm2d(1536)
+
+        self.conv4 = SeparableConv2d(1536, 2048, 3, 1, 1)
+        self.bn4 = BatchNorm2d(2048)
+
+        self.globalpooling = MaxPool2d(10, 1)
+        self.fc = Linear(2048, num_classes)
+
+        self.linear1 = Linear(1000, 256)
+        self.linear2 = Linear(256, 2)
+
+        self.layer_names = ['conv1', 'bn1', 'conv2', 'bn2', 'block1', 'block2', 'block3',
+                            'block4', 'block5', 'block6', 'block7', 'block8', 'conv3', 'bn3',
+                            'conv4', 'bn4', 'fc', 'linear1', 'linear2']
+        self.batchnorm_folded = False
+
+    def param_refs(self):
+        refs = []
+        for name in self.layer_names:
+            refs.extend(prefixed_refs(name, getattr(self, name).param_refs()))
+        return refs
+
+    def named_params(self):
+        """ Returns (name, array) pairs for every parameter, named and ordered as in inference_bone_age. """
+        return [(name, getattr(owner, attribute)) for name, owner, attribute in self.param_refs()]
+
+    def load_params(self, pickle_file):
+        with open(pickle_file, 'rb') as file:
+            for name, owner, attribute in self.param_refs():
+                set_param(owner, attribute, name, load_pickled_array(file))
+
+    def load_weights(self, weights_file):
+        self.load_arrays(weights.load_weights(weights_file), weights_file)
+
+    def load_arrays(self, arrays, source):
+        """
+        Sets every parameter from the dict arrays, read from source. int8 weights that come with a
+        '<layer>.W_scale' entry are converted back to float32, so only the float32 copy is kept.
+        """
+        for name, owner, attribute in self.param_refs():
+            if name not in arrays:
+                raise ValueError('{} is missing from {}'.format(name, source))
+            array = arrays[name]
+            if name + '_scale' in arrays:
+                array = dequantize_per_channel(array, arrays[name + '_scale'], output_axis(owner))
+            set_param(owner, attribute, name, array)
+
+    def quantized_params(self):
+        """
+        Returns named_params with the weights of every 1x1 convolution and Linear layer rounded to
+        int8, each followed by its per-output-channel scales as '<layer>.W_scale'.
+        """
+        params = []
+        for name, owner, attribute in self.param_refs():
+            array = getattr(owner, attribute)
+            if attribute == 'W' and is_pointwise(owner):
+                W_q, scale = quantize_per_channel(weights.upcast_half(array), output_axis(owner))
+                params.extend([(name, W_q), (name + '_scale', scale)])
+            else:
+                params.append((name, array))
+        return params
+
+    def fold_batchnorm(self):
+        """
+        Folds every BatchNorm2d into the convolution in front of it.
+        """
+        self.conv1 = fold_batchnorm_into_conv(self.conv1, self.bn1)
+        self.bn1 = Identity()
+        self.conv2 = fold_batchnorm_into_conv(self.conv2, self.bn2)
+        self.bn2 = Identity()
+        for block in [self.block1, self.block2, self.block3, self.block4,
+                      self.block5, self.block6, self.block7, self.block8]:
+            block.fold_batchnorm()
+        self.conv3.depth_conv = fold_batchnorm_into_conv(self.conv3.depth_conv, self.bn3)
+        self.bn3 = Identity()
+        self.conv4.depth_conv = fold_batchnorm_into_conv(self.conv4.depth_conv, self.bn4)
+        self.bn4 = Identity()
+        self.batchnorm_folded = True
+
+    def set_precision(self, precision):
+        """
+        Stores every convolution and Linear weight in precision (fp32, fp16 or bf16). Half-precision
+        weights are widened to float32 one layer at a time as the layers run, since numpy has no
+        fast half-precision GEMM.
+        """
+        for name, owner, attribute in self.param_refs():
+            if attribute == 'W' and isinstance(owner, (Conv2d, Linear)):
+                setattr(owner, attribute, weights.to_precision(getattr(owner, attribute), precision))
+
+    def features(self, input):
+        x = self.conv1(input)
+
+        x = self.bn1(x)
+        x = relu(x)
+
+        x = self.conv2(x)
+        x = self.bn2(x)
+        x = relu(x)
+
+        x = self.block1(x)
+        x = self.block2(x)
+        x = self.block3(x)
+        x = self.block4(x)
+        x = self.block5(x)
+        x = self.block6(x)
+        x = self.block7(x)
+        x = self.block8(x)
+
+        x = self.conv3(x)
+        x = self.bn3(x)
+        x = relu(x)
+
+        x = self.conv4(x)
+        x = self.bn4(x)
+        return x
+
+    def logits(self, features):
+        x = relu(features)
+        x = self.globalpooling(x)
+        x = x.reshape(x.shape[0], -1)
+        x = self.fc(x)
+        return x
+
+    def __call__(self, input):
+        x = self.features(input)
+        x = self.logits(x)
+
+        x = relu(x)
+        x = self.linear1(x)
+        x = relu(x)
+        x = self.linear2(x)
+
+        return x
+
+
+def relu(x):
+    return np.maximum(x, 0, out=x)
+
+def prefixed_refs(prefix, refs):
+    return [(prefix + '.' + name, owner, attribute) for name, owner, attribute in refs]
+
+def set_param(owner, attribute, name, array):
+    expected = getattr(owner, attribute)
+    if array.shape != expected.shape:
+        raise ValueError('{} has shape {}, expected {}'.format(name, array.shape, expected.shape))
+    if attribute == 'W' and isinstance(owner, (Conv2d, Linear)) and weights.is_half(array):
+        # kept as stored, so weights mapped from a half-precision file are neither copied nor widened
+        setattr(owner, attribute, array)
+        return
+    array = weights.upcast_half(array)
+    setattr(owner, attribute, np.ascontiguousarray(array, dtype=expected.dtype))
+
+def load_pickled_array(file):
+    # params files are written by python 2, whose numpy pickles need latin1 to load on python 3
+    if sys.version_info[0] >= 3:
+        return pickle.load(file, encoding='latin1')
+    return pickle.load(file)
+
+def fold_batchnorm_into_conv(conv, bn):
+    """ Returns a biased Conv2d that computes conv followed by bn in inference mode. """
+    factor = bn.scale / np.sqrt(bn.running_var + BN_EPSILON)
+    b = conv.b if conv.b is not None else np.zeros(conv.out_channels, dtype=np.float32)
+
+    fused = Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, conv.stride, conv.padding,
+                   group=conv.group, bias=True)
+    fused.W = (weights.upcast_half(conv.W) * factor.reshape(-1, 1, 1, 1)).astype(np.float32)
+    fused.b = ((b - bn.running_mean) * factor + bn.bias).astype(np.float32)
+    return fused
+
+def is_pointwise(layer):
+    return isinstance(layer, Linear) or (isinstance(layer, Conv2d) and layer.kernel_size == 1 and layer.group == 1)
+
+def output_axis(layer):
+    """ The axis of layer.W that indexes output channels: Linear weights are stored (in, out). """
+    return 1 if isinstance(layer, Linear) else 0
+
+def quantize_per_channel(W, axis):
+    """ Returns W rounded to int8 with one symmetric scale per index of axis, and those scales. """
+    reduce_axes = tuple(i for i in range(W.ndim) if i != axis)
+    scale = (np.abs(W).max(axis=reduce_axes) / 127.0).astype(np.float32)
+    scale[scale == 0] = 1.0
+    shape = [1] * W.ndim
+    shape[axis] = -1
+    W_q = np.clip(np.rint(W / scale.reshape(shape)), -127, 127).astype(np.int8)
+    return W_q, scale
+
+def dequantize_per_channel(W_q, scale, axis):
+    """ Returns the float32 weights that quantize_per_channel rounded to W_q and scale. """
+    shape = [1] * W_q.ndim
+    shape[axis] = -1
+    return W_q.astype(np.float32) * scale.reshape(shape)
+
+def is_quantized_weights(weights_file):
+    return any(name.endswith('.W_scale') for name in weights.load_weights(weights_file))
+
+def output_size(size, kernel_size, stride, padding):
+    return (size + 2 * padding - kernel_size) // stride + 1
+
+def pad2d(x, padding, value=0):
+    if padding == 0:
+        return x
+    return np.pad(x, ((0, 0), (0, 0), (padding, padding), (padding, padding)),
+                  mode='constant', constant_values=value)
+
+def conv2d(x, W, b, stride, padding):
+    """ Dense NCHW convolution as im2col followed by a single batched GEMM. """
+    n, c, h, w = x.shape
+    out_channels, _, kh, kw = W.shape
+    ho = output_size(h, kh, stride, padding)
+    wo = output_size(w, kw, stride, padding)
+
+    x = np.ascontiguousarray(pad2d(x, padding))
+    if kh == 1 and kw == 1:
+        cols = x[:, :, ::stride, ::stride][:, :, :ho, :wo].reshape(n, c, ho * wo)
+    else:
+        sn, sc, sh, sw = x.strides
+        windows = as_strided(x, shape=(n, c, kh, kw, ho, wo),
+                             strides=(sn, sc, sh, sw, sh * stride, sw * stride))
+        cols = windows.reshape(n, c * kh * kw, ho * wo)
+
+    y = np.matmul(W.reshape(out_channels, -1), cols)
+    if b is not None:
+        y += b.reshape(1, -1, 1)
+    return y.reshape(n, out_channels, ho, wo)
+
+def depthwise_conv2d(x, W, b, stride, padding):
+    """ Depthwise NCHW convolution, accumulated one kernel tap at a time over the whole batch. """
+    n, c, h, w = x.shape
+    kh, kw = W.shape[2:]
+    ho = output_size(h, kh, stride, padding)
+    wo = output_size(w, kw, stride, padding)
+
+    x = pad2d(x, padding)
+    y = np.zeros((n, c, ho, wo), dtype=np.float32)
+    product = np.empty_like(y)
+    for i in range(kh):
+        for j in range(kw):
+            window = x[:, :, i:i + stride * (ho - 1) + 1:stride, j:j + stride * (wo - 1) + 1:stride]
+            np.multiply(window, W[:, 0, i, j].reshape(1, c, 1, 1), out=product)
+            y += product
+    if b is not None:
+        y += b.reshape(1, -1, 1, 1)
+    return y
+
+def max_pool2d(x, kernel_size, stride, padding):
+    n, c, h, w = x.shape
+    ho = output_size(h, kernel_size, stride, padding)
+    wo = output_size(w, kernel_size, stride, padding)
+
+    x = pad2d(x, padding, value=-np.inf)
+    y = None
+    for i in range(kernel_size):
+        for j in range(kernel_size):
+            window = x[:, :, i:i + stride * (ho - 1) + 1:stride, j:j + stride * (wo - 1) + 1:stride]
+            if y is None:
+                y = window.copy()
+            else:
+                np.maximum(y, window, out=y)
+    return y
+
+
+def load_model(params_file, device_spec='cpu', fold_bn=False, precision=None, plan_batch_size=None):
+    if device_spec.strip().lower() != 'cpu':
+        raise ValueError('the numpy backend only runs on the cpu, got device {}'.format(device_spec))
+    model = Xception()
+    if weights.is_weights_file(params_file):
+        if is_quantized_weights(params_file):
+            # quantized files hold the folded network, so give the model that shape first
+            model.fold_batchnorm()
+            fold_bn = False
+        model.load_weights(params_file)
+    else:
+        model.load_params(params_file)
+    if fold_bn:
+        fold_batchnorm(model)
+    if precision is not None:
+        model.set_precision(precision)
+    if plan_batch_size is not None:
+        compile_plan(model, plan_batch_size)
+    return model
+
+def fold_batchnorm(model, check_input=None, tolerance=1e-3):
+    """
+    Folds the model's BatchNorm layers into their convolutions and checks that the output
+    still matches the unfolded model. Returns the largest absolute difference.
+    """
+    return checked_transform(model, forward, Xception.fold_batchnorm, check_input, tolerance)
+
+def compile_plan(model, max_batch_size=8, check_input=None, tolerance=1e-3):
+    """
+    Compiles the model into a static execution plan with buffers for max_batch_size images, which
+    forward() runs from then on, and checks that the output still matches the layer-by-layer model.
+    Returns the largest absolute difference.
+    """
+    from bone_age import execution_plan
+
+    def attach_plan(model):
+        model.plan = execution_plan.compile_plan(model, max_batch_size)
+    return checked_transform(model, forward, attach_plan, check_input, tolerance)
+
+def forward(model, img_array):
+    """ Runs an NCHW float32 batch through the network and returns its (N, 2) output. """
+    with metrics.DEVICE_TRANSFER.time():
+        img_array = np.ascontiguousarray(img_array, dtype=np.float32)
+    with metrics.FORWARD.time():
+        if getattr(model, 'plan', None) is not None:
+            return model.plan.run(img_array)
+        return model(img_array)
+
+def synchronize(model):
+    """ numpy runs synchronously, so there is nothing to wait for. """
+    return
+
+def predict(img, gender, model, args=None):
+    check_gender(gender)
+    y_np = forward(model, image2array(img))[0]
+    return make_prediction(y_np, gender)
+
+def predict_outputs(imgs, model, args=None):
+    """ Returns the raw (N, 2) network output for a list of images. """
+    return forward(model, images2array(imgs))
+
+def predict_batch(imgs, genders, model, args=None):
+    for gender in genders:
+        check_gender(gender)
+    y_np = predict_outputs(imgs, model, args)
+    return [make_prediction(y_row, gender) for y_row, gender in zip(y_np, genders)]
@@ -0,0 +1,237 @@
+"""
+Per-layer profiling of the Xception network, for either backend.
+
+While a LayerProfiler is attached, each layer that Xception.features, Xception.logits,
+Xception.__call__ and Block.__call__ call is wrapped, as are features and logits themselves.
+Every call records its wall time and the shape and size of its output. Times are inclusive,
+so a block's time covers its layers, and the ReLU functions called between layers count only
+towards their caller. Detaching restores the original layers.
+
+    python -m bone_age.profiler --backend numpy -p PARAMS_FILE --runs 20 --json profile.json
+"""
+import argparse
+import collections
+import json
+import sys
+import time
+
+import numpy as np
+
+
+class LayerStats(object):
+
+    def __init__(self, name, kind, depth):
+        self.name = name
+        self.kind = kind
+        self.depth = depth
+        self.calls = 0
+        self.total = 0.0
+        self.shortest = None
+        self.longest = 0.0
+        self.output_shape = None
+        self.output_bytes = 0
+
+    def record(self, seconds, output):
+        self.calls += 1
+        self.total += seconds
+        self.shortest = seconds if self.shortest is None else min(self.shortest, seconds)
+        self.longest = max(self.longest, seconds)
+        self.output_shape, self.output_bytes = describe_output(output)
+
+
+class ProfiledLayer(object):
+    """ Stands in for a layer while the profiler is attached, timing every call to it. """
+
+    def __init__(self, profiler, name, kind, layer):
+        self.profiler = profiler
+        self.name = name
+        self.kind = kind
+        self.layer = layer
+
+    def __call__(self, *args):
+        return self.profiler.call(self.name, self.kind, self.layer, args)
+
+
+class LayerProfiler(object):
+    """
+    Records per-layer wall times of an Xception model over several runs. synchronize(), if
+    given, is called after every layer so that asynchronous devices have finished its kernels
+    before the clock is read.
+    """
+
+    def __init__(self, synchronize=None):
+        self.synchronize = synchronize
+        self.stats = collections.OrderedDict()
+        self.run_times = []
+        self.depth = 0
+        self.restore_actions = []
+
+    def attach(self, model):
+        if len(self.restore_actions) > 0:
+            raise ValueError("the profiler is already attached to a model.")
+        if getattr(model, "plan", None) is not None:
+            raise ValueError("the model runs a static execution plan, which bypasses its layers.")
+        for method_name in ["features", "logits"]:
+            self.wrap_attribute(model, method_name, method_name, getattr(model, method_name), method=True)
+        for name in model.layer_names + ["globalpooling"]:
+            layer = getattr(model, name)
+            if hasattr(layer, "layers"):
+                self.attach_block(name, layer)
+            self.wrap_attribute(model, name, name, layer)
+
+    def attach_block(self, block_name, block):
+        original_layers = block.layers
+        block.layers = [ProfiledLayer(self, "{}.layers.{}".format(block_name, index), type(layer).__name__, layer)
+                        for index, layer in enumerate(original_layers)]
+        self.restore_actions.append(lambda: setattr(block, "layers", original_layers))
+        for name in ["skip", "skipbn"]:
+            if getattr(block, name, None) is not None:
+                self.wrap_attribute(block, name, "{}.{}".format(block_name, name), getattr(block, name))
+
+    def wrap_attribute(self, owner, attribute, name, layer, method=False):
+        if method:
+            # the wrapper shadows the class's method until it is deleted again
+            self.restore_actions.append(lambda: delattr(owner, attribute))
+            kind = "Xception." + attribute
+        else:
+            self.restore_actions.append(lambda: setattr(owner, attribute, layer))
+            kind = type(layer).__name__
+        setattr(owner, attribute, ProfiledLayer(self, name, kind, layer))
+
+    def detach(self):
+        while len(self.restore_actions) > 0:
+            self.restore_actions.pop()()
+
+    def call(self, name, kind, layer, args):
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = LayerStats(name, kind, self.depth)
+            self.stats[name] = stats
+        self.depth += 1
+        try:
+            start = time.time()
+            output = layer(*args)
+            if self.synchronize is not None:
+                self.synchronize()
+            stats.record(time.time() - start, output)
+        finally:
+            self.depth -= 1
+        return output
+
+    def profile(self, model, forward, img_array, runs=10, warmup=1):
+        """
+        Runs forward(model, img_array) warmup times unprofiled, then runs times with the
+        profiler attached, and returns report().
+        """
+        for _ in range(warmup):
+            forward(model, img_array)
+        self.attach(model)
+        try:
+            for _ in range(runs):
+                start = time.time()
+                forward(model, img_array)
+                if self.synchronize is not None:
+                    self.synchronize()
+                self.run_times.append(time.time() - start)
+        finally:
+            self.detach()
+        return self.report()
+
+    def report(self):
+        runs = len(self.run_times)
+        mean_run = sum(self.run_times) / runs if runs > 0 else 0.0
+        layers = []
+        for stats in self.stats.values():
+            mean_seconds = stats.total / runs if runs > 0 else 0.0
+            layers.append({
+                "name": stats.name,
+                "kind": stats.kind,
+                "depth": stats.depth,
+                "calls": stats.calls,
+                "mean_seconds": mean_seconds,
+                "min_seconds": stats.shortest,
+                "max_seconds": stats.longest,
+                "share": mean_seconds / mean_run if mean_run > 0 else 0.0,
+                "output_shape": stats.output_shape,
+                "output_bytes": stats.output_bytes
+            })
+        return {
+            "runs": runs,
+            "mean_seconds": mean_run,
+            "min_seconds": min(self.run_times) if runs > 0 else None,
+            "max_seconds": max(self.run_times) if runs > 0 else None,
+            "layers": layers
+        }
+
+
+def format_report(report):
+    """ Renders a report() as a text table, with each layer indented under its caller. """
+    header = "{:<28} {:<16} {:>20} {:>10} {:>10} {:>10} {:>10} {:>7}".format(
+        "layer", "kind", "output shape", "output MB", "mean ms", "min ms", "max ms", "share")
+    lines = [header, "-" * len(header)]
+    for layer in report["layers"]:
+        lines.append("{:<28} {:<16} {:>20} {:>10.2f} {:>10.3f} {:>10.3f} {:>10.3f} {:>6.1f}%".format(
+            "  " * layer["depth"] + layer["name"],
+            layer["kind"],
+            "x".join(str(size) for size in layer["output_shape"] or []),
+            layer["output_bytes"] / 1e6,
+            layer["mean_seconds"] * 1e3,
+            (layer["min_seconds"] or 0.0) * 1e3,
+            layer["max_seconds"] * 1e3,
+            layer["share"] * 100))
+    lines.append("-" * len(header))
+    lines.append("forward pass over {} runs: mean {:.3f} ms, min {:.3f} ms, max {:.3f} ms".format(
+        report["runs"], report["mean_seconds"] * 1e3, (report["min_seconds"] or 0.0) * 1e3,
+        (report["max_seconds"] or 0.0) * 1e3))
+    return "\n".join(lines)
+
+
+def describe_output(output):
+    if isinstance(output, tuple):
+        output = output[0]
+    shape = [int(size) for size in output.shape]
+    # SINGA tensors do not expose an item size, and the network runs in float32
+    itemsize = getattr(output, "itemsize", 4)
+    return shape, int(np.prod(shape)) * itemsize
+
+
+def profile_model(backend, model, batch_size=1, size=299, runs=10, warmup=1):
+    img_array = np.random.RandomState(0).rand(batch_size, 1, size, size).astype(np.float32)
+    profiler = LayerProfiler(synchronize=lambda: backend.synchronize(model))
+    return profiler.profile(model, backend.forward, img_array, runs=runs, warmup=warmup)
+
+
+if __name__ == "__main__":
+    from model_bone_age import load_backend
+
+    parser = argparse.ArgumentParser(description='profile the time spent in each layer of the network')
+    parser.add_argument('--params', '-p', type=str, required=True,
+                        help='path to the file which stores network parameters.')
+    parser.add_argument('--backend', type=str, default='singa', choices=['singa', 'numpy'],
+                        help='inference engine to profile.')
+    parser.add_argument('--device', type=str, default=None,
+                        help='device to run inference on: cpu, cuda or cuda:N.')
+    parser.add_argument('--fold-bn', action='store_true',
+                        help='fold BatchNorm layers into the preceding convolutions first.')
+    parser.add_argument('--batch-size', type=int, default=1, help='images in each forward pass.')
+    parser.add_argument('--runs', type=int, default=10, help='profiled forward passes.')
+    parser.add_argument('--warmup', type=int, default=1, help='unprofiled forward passes run first.')
+    parser.add_argument('--json', type=str, default=None,
+                        help='also write the report as JSON to this file, or to stdout with -.')
+    args = parser.parse_args()
+
+    backend = load_backend(args.backend)
+    load_kwargs = {'fold_bn': args.fold_bn}
+    if args.device is not None:
+        load_kwargs['device_spec'] = args.device
+    model = backend.load_model(args.params, **load_kwargs)
+
+    report = profile_model(backend, model, batch_size=args.batch_size, runs=args.runs, warmup=args.warmup)
+    if args.json == '-':
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        print(format_report(report))
+        if args.json is not None:
+            with open(args.json, 'w') as json_file:
+                json.dump(report, json_file, indent=2)
@@ -0,0 +1,115 @@
+"""
+int8 storage of the numpy backend's Xception weights.
+
+The BatchNorm layers are folded, and the weights of every 1x1 convolution and Linear layer, which
+hold most of the parameters, are rounded to int8 with one scale per output channel. The result is
+written as a weights file that numpy_xception.load_model recognises and converts back to float32
+when it loads it, so int8 only makes the file smaller: the loaded model and its forward passes are
+the same size and speed as float32. A report shows how far the rounding moves the predictions on a
+folder of sample radiographs.
+
+    python -m bone_age.quantization -p PARAMS_FILE --images samples/ --output quantized.weights
+"""
+import argparse
+import io
+import json
+import os
+
+import numpy as np
+
+from bone_age import numpy_xception
+from bone_age import weights
+from bone_age.utils import images2array
+
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff")
+
+
+def quantize_model(model):
+    """
+    Rounds a loaded float32 model's pointwise weights to int8 in place, folding its BatchNorm layers
+    first unless it was loaded folded, and returns the (name, array) pairs to save.
+    """
+    if not model.batchnorm_folded:
+        numpy_xception.fold_batchnorm(model)
+    params = model.quantized_params()
+    model.load_arrays(dict(params), 'the quantized parameters')
+    return params
+
+
+def drift_report(float_outputs, quantized_outputs, float_bytes, quantized_bytes):
+    """ Compares the (N, 2) outputs of the float32 and int8 networks on the same images. """
+    drift = np.abs(quantized_outputs - float_outputs)
+    relative = drift / np.maximum(np.abs(float_outputs), 1e-6)
+    return {
+        "images": int(len(float_outputs)),
+        "mean_abs_drift": float(drift.mean()),
+        "p95_abs_drift": float(np.percentile(drift, 95)),
+        "max_abs_drift": float(drift.max()),
+        "mean_relative_drift": float(relative.mean()),
+        "max_relative_drift": float(relative.max()),
+        "float32_param_bytes": float_bytes,
+        "int8_param_bytes": quantized_bytes
+    }
+
+
+def format_report(report):
+    return "\n".join([
+        "prediction drift over {images} sample images, in months of bone age:".format(**report),
+        "  mean {mean_abs_drift:.3f}  p95 {p95_abs_drift:.3f}  max {max_abs_drift:.3f}".format(**report),
+        "  relative: mean {:.3%}  max {:.3%}".format(report["mean_relative_drift"], report["max_relative_drift"]),
+        "parameters on disk: float32 {:.1f} MB, int8 {:.1f} MB".format(report["float32_param_bytes"] / 1e6,
+                                                               report["int8_param_bytes"] / 1e6)
+    ])
+
+
+def param_bytes(params):
+    return sum(array.nbytes for _, array in params)
+
+
+def list_images(folder):
+    names = sorted(name for name in os.listdir(folder) if name.lower().endswith(IMAGE_EXTENSIONS))
+    if len(names) == 0:
+        raise ValueError("no images found in {}".format(folder))
+    return [os.path.join(folder, name) for name in names]
+
+
+def load_batches(paths, batch_size):
+    batches = []
+    for start in range(0, len(paths), batch_size):
+        images = []
+        for path in paths[start:start + batch_size]:
+            with open(path, "rb") as image_file:
+                images.append(io.BytesIO(image_file.read()))
+        batches.append(images2array(images))
+    return batches
+
+
+def run_all(model, img_arrays):
+    return np.concatenate([numpy_xception.forward(model, img_array) for img_array in img_arrays])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='store the network\'s pointwise weights as int8')
+    parser.add_argument('--params', '-p', type=str, required=True,
+                        help='path to the float32 params or weights file.')
+    parser.add_argument('--images', type=str, required=True,
+                        help='folder of sample radiographs to measure the prediction drift on.')
+    parser.add_argument('--output', '-o', type=str, required=True, help='path of the int8 weights file to write.')
+    parser.add_argument('--batch-size', type=int, default=8, help='images in each forward pass.')
+    parser.add_argument('--report', type=str, default=None, help='also write the drift report as JSON to this file.')
+    args = parser.parse_args()
+
+    img_arrays = load_batches(list_images(args.images), args.batch_size)
+    model = numpy_xception.load_model(args.params)
+    float_bytes = param_bytes(model.named_params())
+    float_outputs = run_all(model, img_arrays)
+
+    params = quantize_model(model)
+    weights.save_weights(args.output, params)
+
+    report = drift_report(float_outputs, run_all(model, img_arrays), float_bytes, param_bytes(params))
+    print(format_report(report))
+    if args.report is not None:
+        with open(args.report, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
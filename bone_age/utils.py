@@ -0,0 +1,91 @@
+from PIL import Image
+import numpy as np
+
+from bone_age import metrics
+
+
+def load_image(file, size=299):
+    """
+    Opens an image as size x size greyscale. JPEGs are decoded straight to greyscale at the
+    smallest DCT scale that is still at least size pixels wide, and every image is converted
+    to greyscale before it is resized, so large colour radiographs are never resized in full.
+    """
+    im=Image.open(file)
+    im.draft('L', (size, size))
+    if im.mode != 'L':
+        im=im.convert('L')
+    if im.size != (size, size):
+        im=im.resize((size, size), Image.BILINEAR)
+    return im
+
+def image2array(file, size=299, out=None):
+    """
+    Returns the image as a (1, 1, size, size) float32 array scaled to [0, 1]. If out is given,
+    a C-contiguous float32 array of size * size elements such as one row of a batch, the
+    pixels are written into it and it is returned instead.
+    """
+    with metrics.IMAGE2ARRAY.time():
+        if out is None:
+            out = np.empty((1, 1, size, size), dtype=np.float32)
+        im=load_image(file, size)
+        np.divide(np.asarray(im), np.float32(255), out=out.reshape(size, size))
+    return out
+
+def images2array(files, size=299, out=None):
+    """
+    Preprocesses a list of images into one (N, 1, size, size) float32 batch. out may be a
+    preallocated buffer with room for at least N images; the batch is then a view of it.
+    """
+    if out is None:
+        out = np.empty((len(files), 1, size, size), dtype=np.float32)
+    for i, file in enumerate(files):
+        image2array(file, size, out=out[i])
+    return out[:len(files)]
+
+def read_image_bytes(img):
+    """
+    Returns the raw bytes of an uploaded image. File-like uploads are rewound afterwards
+    so that they can still be decoded; anything else is treated as a path on disk.
+    """
+    if hasattr(img, 'read'):
+        img.seek(0)
+        data = img.read()
+        img.seek(0)
+        return data
+    with open(img, 'rb') as opened_file:
+        return opened_file.read()
+
+def check_gender(gender):
+    assert gender =='female' or gender == 'male', 'please input gender(female or male)'
+
+def make_prediction(y_np, gender):
+    """ Turns one row of network output (female, male) into the prediction for the given gender. """
+    y_np=np.array(y_np)
+    for l in range(len(y_np)):
+        if y_np[l] <= 0:
+            y_np[l] = 1
+
+    prediction={}
+    if gender == 'female':
+        prediction['predicted bone age'] = float(y_np[0])
+    else:
+        prediction['predicted bone age'] = float(y_np[1])
+
+    return prediction
+
+def checked_transform(model, forward, transform, check_input=None, tolerance=1e-3):
+    """
+    Applies transform to model in place, then checks that forward(model, check_input) is unchanged
+    (check_input defaults to a fixed random batch). Returns the largest absolute difference, or
+    raises ValueError if it exceeds tolerance relative to the output's magnitude.
+    """
+    if check_input is None:
+        check_input = np.random.RandomState(0).rand(2, 1, 299, 299).astype(np.float32)
+    expected = forward(model, check_input)
+    transform(model)
+    actual = forward(model, check_input)
+
+    error = float(np.abs(actual - expected).max())
+    if error > tolerance * max(1.0, float(np.abs(expected).max())):
+        raise ValueError('transforming the model changed its output by up to {}'.format(error))
+    return error
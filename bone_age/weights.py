@@ -0,0 +1,193 @@
+"""
+A single-file, memory-mappable container for named network weights.
+
+Layout of a weights file:
+    magic (8 bytes) | version (uint32) | reserved (uint32) | header length (uint64)
+    JSON header listing every tensor's name, dtype, shape and byte offset
+    raw little-endian arrays, each starting on a ALIGNMENT-byte boundary
+
+Tensors are looked up by name, so the file does not depend on the order in which the
+network visits its layers. Loading maps the file read-only and returns numpy views into
+the mapping, so nothing is copied until the arrays are used, and processes that load
+the same file share its pages.
+
+Convolution and Linear weights may be stored in half precision: float16, or bfloat16 held
+as uint16 bit patterns, since numpy has no bfloat16 dtype. Other tensors stay float32.
+"""
+import argparse
+import collections
+import json
+import mmap
+import struct
+
+import numpy as np
+
+
+MAGIC = b"BAWEIGHT"
+VERSION = 1
+ALIGNMENT = 64
+PREAMBLE = struct.Struct("<8sIIQ")
+
+PRECISIONS = ["fp32", "fp16", "bf16"]
+PRECISION_DTYPES = {"fp32": np.dtype(np.float32), "fp16": np.dtype(np.float16), "bf16": np.dtype(np.uint16)}
+
+
+def save_weights(weights_file, named_arrays):
+    """
+    Writes (name, numpy array) pairs to weights_file.
+    """
+    entries = []
+    arrays = []
+    offset = 0
+    for name, array in named_arrays:
+        array = np.ascontiguousarray(array)
+        array = array.astype(array.dtype.newbyteorder("<"), copy=False)
+        offset = align(offset)
+        entries.append({
+            "name": name,
+            "dtype": array.dtype.str,
+            "shape": list(array.shape),
+            "offset": offset,
+            "nbytes": array.nbytes
+        })
+        arrays.append(array)
+        offset += array.nbytes
+
+    header = json.dumps({"tensors": entries}, sort_keys=True).encode("utf-8")
+    data_start = align(PREAMBLE.size + len(header))
+
+    with open(weights_file, "wb") as opened_file:
+        opened_file.write(PREAMBLE.pack(MAGIC, VERSION, 0, len(header)))
+        opened_file.write(header)
+        opened_file.write(b"\0" * (data_start - PREAMBLE.size - len(header)))
+        for entry, array in zip(entries, arrays):
+            opened_file.seek(data_start + entry["offset"])
+            opened_file.write(array.tobytes())
+
+
+def load_weights(weights_file):
+    """
+    Maps weights_file into memory and returns an OrderedDict of name -> read-only numpy array.
+    The arrays are views into the mapping, which stays open for as long as any of them is alive.
+    """
+    with open(weights_file, "rb") as opened_file:
+        mapping = mmap.mmap(opened_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version, _, header_length = PREAMBLE.unpack_from(mapping, 0)
+    if magic != MAGIC:
+        raise ValueError("{} is not a weights file.".format(weights_file))
+    if version != VERSION:
+        raise ValueError("{} has unsupported weights format version {}.".format(weights_file, version))
+
+    header = json.loads(mapping[PREAMBLE.size:PREAMBLE.size + header_length].decode("utf-8"))
+    data_start = align(PREAMBLE.size + header_length)
+
+    arrays = collections.OrderedDict()
+    for entry in header["tensors"]:
+        dtype = np.dtype(entry["dtype"])
+        count = entry["nbytes"] // dtype.itemsize
+        array = np.frombuffer(mapping, dtype=dtype, count=count, offset=data_start + entry["offset"])
+        arrays[entry["name"]] = array.reshape(entry["shape"])
+    return arrays
+
+
+def is_weights_file(path):
+    with open(path, "rb") as opened_file:
+        return opened_file.read(len(MAGIC)) == MAGIC
+
+
+def align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def is_half(array):
+    return array.dtype in (PRECISION_DTYPES["fp16"], PRECISION_DTYPES["bf16"])
+
+
+def upcast_half(array):
+    """ Returns a float32 copy of a float16 or bfloat16 array, and any other array unchanged. """
+    if array.dtype == PRECISION_DTYPES["bf16"]:
+        return (array.astype(np.uint32) << 16).view(np.float32)
+    if array.dtype == PRECISION_DTYPES["fp16"]:
+        return array.astype(np.float32)
+    return array
+
+
+def to_precision(array, precision):
+    """ Returns a float array in precision, rounding to nearest even when narrowing to bfloat16. """
+    if array.dtype == PRECISION_DTYPES[precision]:
+        return array
+    array = np.ascontiguousarray(upcast_half(array), dtype=np.float32)
+    if precision == "bf16":
+        bits = array.view(np.uint32)
+        return ((bits + (0x7FFF + ((bits >> 16) & 1))) >> 16).astype(np.uint16)
+    narrowed = array.astype(PRECISION_DTYPES[precision])
+    if not np.isfinite(narrowed).all() and np.isfinite(array).all():
+        raise ValueError("weights exceed the float16 range; use bf16 instead.")
+    return narrowed
+
+
+def is_matmul_weight(name, array):
+    """ True for the weights of convolution and Linear layers, the tensors that may be stored in half precision. """
+    return name.endswith(".W") and (array.dtype == np.float32 or is_half(array))
+
+
+def with_precision(named_arrays, precision):
+    return [(name, to_precision(array, precision) if is_matmul_weight(name, array) else array)
+            for name, array in named_arrays]
+
+
+def convert_precision(input_file, weights_file, precision):
+    """
+    Writes a copy of a weights file with every convolution and Linear weight stored in precision.
+    """
+    save_weights(weights_file, with_precision(load_weights(input_file).items(), precision))
+
+
+def convert_pickle_params(pickle_file, weights_file, precision="fp32"):
+    """
+    Converts a --params file written by Xception.dump_params into the named weights format.
+    The params are read with the numpy network, so converting does not need SINGA.
+    """
+    from bone_age import numpy_xception
+
+    model = numpy_xception.Xception()
+    model.load_params(pickle_file)
+    save_weights(weights_file, with_precision(model.named_params(), precision))
+
+
+def save_random_weights(weights_file, seed=0):
+    """
+    Writes a weights file with the names and shapes of the real network but random values,
+    scaled so that activations neither vanish nor overflow, for benchmarking without a params file.
+    """
+    from bone_age import numpy_xception
+
+    random_state = np.random.RandomState(seed)
+    named_arrays = []
+    for name, array in numpy_xception.Xception().named_params():
+        if name.endswith("running_var") or name.endswith("scale"):
+            values = random_state.uniform(0.5, 1.5, array.shape)
+        elif name.endswith("running_mean") or name.endswith("bias") or name.endswith(".b"):
+            values = random_state.normal(0.0, 0.01, array.shape)
+        else:
+            # He initialisation; Linear weights are (in, out), convolution weights (out, in, k, k)
+            fan_in = array.shape[0] if array.ndim == 2 else int(np.prod(array.shape[1:]))
+            values = random_state.normal(0.0, np.sqrt(2.0 / fan_in), array.shape)
+        named_arrays.append((name, values.astype(np.float32)))
+    save_weights(weights_file, named_arrays)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='convert a pickled params file into a memory-mappable weights file')
+    parser.add_argument('params', type=str,
+                        help='pickled params file written by Xception.dump_params, or a weights file.')
+    parser.add_argument('output', type=str, help='path of the weights file to write.')
+    parser.add_argument('--precision', type=str, default='fp32', choices=PRECISIONS,
+                        help='precision to store convolution and Linear weights in.')
+    args = parser.parse_args()
+
+    if is_weights_file(args.params):
+        convert_precision(args.params, args.output, args.precision)
+    else:
+        convert_pickle_params(args.params, args.output, precision=args.precision)
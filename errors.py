@@ -51,8 +51,20 @@ class UserQuotaLeftError(UserInfoError):
         super(UserQuotaLeftError, self).__init__(message)
 
 
-def bad_request_response(message=None):
-    return make_error_response(code=400, code_phrase="Bad Request", message=message)
+class UserBatchError(ValueError):
+    """
+    Raised by the bulk user operations when one or more rows are rejected. row_errors lists
+    {"index", "message"} for every rejected row; conflict is True when all of them are
+    name or token conflicts rather than invalid values.
+    """
+    def __init__(self, message, row_errors, conflict=False):
+        super(UserBatchError, self).__init__(message)
+        self.row_errors = row_errors
+        self.conflict = conflict
+
+
+def bad_request_response(message=None, dict=None):
+    return make_error_response(code=400, code_phrase="Bad Request", message=message, dict=dict)
 
 
 def unauthorized_response(message=None, dict=None):
@@ -73,16 +85,19 @@ def method_not_allowed_response(message=None):
     return make_error_response(code=405, code_phrase="Method Not Allowed", message=message)
 
 
-def conflict_response(message=None):
-    return make_error_response(code=409, code_phrase="Conflict", message=message)
+def conflict_response(message=None, dict=None):
+    return make_error_response(code=409, code_phrase="Conflict", message=message, dict=dict)
 
 
 def internal_server_error_response(message=None):
     return make_error_response(code=500, code_phrase="Internal Server Error", message=message)
 
 
-def make_error_response(code, code_phrase, message=None):
+def make_error_response(code, code_phrase, message=None, dict=None):
     body = {"status": "error", "code": code_phrase}
     if message is not None:
         body["message"] = message
+    if dict is not None:
+        for key in dict:
+            body[key] = dict[key]
     return make_response(jsonify(body), code)
@@ -0,0 +1,288 @@
+"""
+HTTP load test for the whole service: auth, quota, database and routes, not only the model.
+
+Start a server on a fresh SQLite database seeded with --users users. Without -p the server uses
+StubPredictor, which preprocesses images for real but replaces the forward pass with a fixed
+delay. Any other app.py argument, such as --write-behind, --workers or --max-batch-size, can be
+added, though --write-behind and --workers cannot be combined. The clients upload the same few
+images over and over, so pass --cache-size 0 to measure predictions rather than cache hits:
+
+    python loadtest.py serve --users 10000 --stub-delay-ms 20 --cache-size 0
+
+Then drive it from another shell, with the same --users:
+
+    python loadtest.py run --users 10000 --concurrency 32 --duration 30 --mix model=1,check-quota=4,echo=1
+
+run reports throughput, latency percentiles and errors per route, and can write them as JSON.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+try:
+    from http.client import HTTPConnection
+    from urllib.parse import urlparse
+except ImportError:
+    from httplib import HTTPConnection
+    from urlparse import urlparse
+
+import numpy as np
+
+from model_bone_age import Predictor
+
+
+DEFAULT_DATABASE = "/tmp/bone_age_loadtest.db"
+ROUTES = ["model", "check-quota", "echo"]
+MULTIPART_BOUNDARY = "bone-age-loadtest-boundary"
+
+
+def make_token(index):
+    return "loadtest-token-{}".format(index)
+
+
+class StubPredictor(Predictor):
+    """
+    Stands in for BoneAgePredictor. Images are decoded and resized as in production, and the
+    forward pass sleeps for delay seconds per batch, so the rest of the service is what is measured.
+    """
+
+    def __init__(self, delay=0.02):
+        from bone_age import utils
+
+        self.utils = utils
+        self.delay = delay
+
+    def predict_outputs(self, imgs):
+        return self.forward(self.utils.images2array(imgs))
+
+    def check_gender(self, gender):
+        self.utils.check_gender(gender)
+
+    def preprocess(self, img, out=None):
+        return self.utils.image2array(img, out=out)
+
+    def forward(self, img_array):
+        time.sleep(self.delay)
+        return np.full((len(img_array), 2), 120.0, dtype=np.float32)
+
+    def make_prediction(self, y_np, gender):
+        return self.utils.make_prediction(y_np, gender)
+
+
+def serve(argv):
+    # the database URI is read when app is imported, so it has to be set first
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--database', type=str, default=DEFAULT_DATABASE)
+    known, _ = parser.parse_known_args(argv)
+    database = os.path.abspath(known.database)
+    for suffix in ["", "-wal", "-shm"]:
+        if os.path.exists(database + suffix):
+            os.remove(database + suffix)
+    os.environ["BONE_AGE_DATABASE_URI"] = "sqlite:///" + database
+
+    import users
+    import app
+    from model_bone_age import BoneAgePredictor
+
+    parser = app.make_argument_parser()
+    parser.description = 'run the app on a seeded database for load testing'
+    parser.add_argument('--database', type=str, default=DEFAULT_DATABASE,
+                        help='SQLite file to create; it is deleted and reseeded on every start.')
+    parser.add_argument('--users', type=int, default=1000, help='users to seed the database with.')
+    parser.add_argument('--quota', type=int, default=10 ** 9, help='total_quota of every seeded user.')
+    parser.add_argument('--stub-delay-ms', type=float, default=20.0,
+                        help='time the stub predictor spends on each forward pass when -p is not given.')
+    parser.add_argument('--port', type=int, default=5000, help='port to listen on.')
+    args = parser.parse_args(argv)
+    app.check_worker_arguments(parser, args)
+
+    with app.app.app_context():
+        users.initialize()
+        users.add_users_from_info([{"name": "loadtest-user-{}".format(index), "token": make_token(index),
+                                    "total_quota": args.quota} for index in range(args.users)])
+        users.rebuild_token_index()
+    print('seeded {} users into {}'.format(args.users, database))
+
+    if args.params:
+        device_spec = args.device or ('cuda:0' if args.backend == 'singa' else 'cpu')
+        if args.workers > 1 and device_spec.startswith('cuda'):
+            parser.error("--workers needs --device cpu.")
+        predictor = BoneAgePredictor(args)
+    else:
+        predictor = StubPredictor(delay=args.stub_delay_ms / 1000.0)
+    app.app.config["CACHE_HITS_USE_QUOTA"] = not args.free_cache_hits
+    app.run_server(args, predictor, port=args.port)
+
+
+class RouteRequests(object):
+    """ Builds the request for each route; the images are encoded once and reused. """
+
+    def __init__(self, images):
+        self.images = images
+        self.model_bodies = [make_model_body(image) for image in images]
+
+    def build(self, route, token, image_index):
+        """ Returns (method, path, body, headers). """
+        headers = {"Authorization": token}
+        if route == "model":
+            headers["Content-Type"] = "multipart/form-data; boundary={}".format(MULTIPART_BOUNDARY)
+            return "POST", "/model", self.model_bodies[image_index], headers
+        elif route == "echo":
+            headers["Content-Type"] = "application/octet-stream"
+            return "POST", "/echo", self.images[image_index], headers
+        elif route == "check-quota":
+            return "GET", "/check-quota", None, headers
+        raise ValueError("unknown route {}".format(route))
+
+
+def make_model_body(image):
+    return b"".join([
+        "--{}\r\n".format(MULTIPART_BOUNDARY).encode("ascii"),
+        b'Content-Disposition: form-data; name="image"; filename="radiograph.png"\r\n',
+        b"Content-Type: image/png\r\n\r\n",
+        image,
+        "\r\n--{}\r\n".format(MULTIPART_BOUNDARY).encode("ascii"),
+        b'Content-Disposition: form-data; name="gender"\r\n\r\n',
+        b"female",
+        "\r\n--{}--\r\n".format(MULTIPART_BOUNDARY).encode("ascii")
+    ])
+
+
+def run_client(index, args, requests, deadline, results):
+    """ Sends requests on one keep-alive connection until deadline, appending (route, seconds, status). """
+    chooser = random.Random(args.seed + index)
+    routes = [route for route, weight in args.mix for _ in range(weight)]
+    connection = HTTPConnection(args.host, args.port, timeout=args.timeout)
+    while time.time() < deadline:
+        route = chooser.choice(routes)
+        method, path, body, headers = requests.build(route, make_token(chooser.randrange(args.users)),
+                                                     chooser.randrange(args.images))
+        start = time.time()
+        try:
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            response.read()
+            status = response.status
+        except Exception as request_error:
+            status = type(request_error).__name__
+            connection.close()
+            connection = HTTPConnection(args.host, args.port, timeout=args.timeout)
+        results.append((route, time.time() - start, status))
+    connection.close()
+
+
+def summarize(results, seconds):
+    summary = {}
+    for route in ROUTES + ["all"]:
+        route_results = [result for result in results if route == "all" or result[0] == route]
+        if len(route_results) == 0:
+            continue
+        latencies_ms = np.array([result[1] for result in route_results]) * 1e3
+        statuses = {}
+        for result in route_results:
+            statuses[str(result[2])] = statuses.get(str(result[2]), 0) + 1
+        errors = sum(count for status, count in statuses.items() if not status.startswith("2"))
+        summary[route] = {
+            "requests": len(route_results),
+            "errors": errors,
+            "error_rate": errors / float(len(route_results)),
+            "requests_per_second": len(route_results) / seconds,
+            "p50_ms": float(np.percentile(latencies_ms, 50)),
+            "p95_ms": float(np.percentile(latencies_ms, 95)),
+            "p99_ms": float(np.percentile(latencies_ms, 99)),
+            "max_ms": float(latencies_ms.max()),
+            "statuses": statuses
+        }
+    return summary
+
+
+def format_summary(summary):
+    header = "{:<12} {:>9} {:>9} {:>8} {:>10} {:>10} {:>10} {:>10}".format(
+        "route", "requests", "req/s", "errors", "p50 ms", "p95 ms", "p99 ms", "max ms")
+    lines = [header, "-" * len(header)]
+    for route in ROUTES + ["all"]:
+        if route not in summary:
+            continue
+        stats = summary[route]
+        lines.append("{:<12} {:>9} {:>9.1f} {:>7.2f}% {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+            route, stats["requests"], stats["requests_per_second"], stats["error_rate"] * 100,
+            stats["p50_ms"], stats["p95_ms"], stats["p99_ms"], stats["max_ms"]))
+    return "\n".join(lines)
+
+
+def parse_mix(text):
+    mix = []
+    for part in text.split(","):
+        route, _, weight = part.partition("=")
+        route = route.strip()
+        if route not in ROUTES:
+            raise argparse.ArgumentTypeError("routes in --mix must be among {}".format(", ".join(ROUTES)))
+        mix.append((route, int(weight or 1)))
+    return mix
+
+
+def run(argv):
+    from bone_age.benchmark import synthetic_radiograph
+
+    parser = argparse.ArgumentParser(description='drive a load-test server and report latency and errors')
+    parser.add_argument('--url', type=str, default='http://127.0.0.1:5000', help='address of the server.')
+    parser.add_argument('--users', type=int, default=1000,
+                        help='number of seeded users to spread requests over; must match serve.')
+    parser.add_argument('--concurrency', type=int, default=16, help='clients sending requests at once.')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds to send requests for.')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('model=1,check-quota=4,echo=1'),
+                        help='relative weights of the routes, such as model=1,check-quota=4,echo=1.')
+    parser.add_argument('--image-size', type=int, default=1024,
+                        help='side length in pixels of the synthetic radiograph that is uploaded.')
+    parser.add_argument('--images', type=int, default=8,
+                        help='distinct synthetic radiographs to upload in turn.')
+    parser.add_argument('--timeout', type=float, default=60.0, help='seconds before a request fails.')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the choice of routes and users.')
+    parser.add_argument('--output', '-o', type=str, default=None, help='write the results as JSON to this file.')
+    args = parser.parse_args(argv)
+    address = urlparse(args.url)
+    args.host = address.hostname
+    args.port = address.port or 80
+
+    requests = RouteRequests([synthetic_radiograph(args.image_size, args.seed + index)
+                              for index in range(args.images)])
+    per_client_results = [[] for _ in range(args.concurrency)]
+    start = time.time()
+    deadline = start + args.duration
+    clients = [threading.Thread(target=run_client, args=(index, args, requests, deadline, per_client_results[index]))
+               for index in range(args.concurrency)]
+    for client in clients:
+        client.daemon = True
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.time() - start
+
+    summary = summarize([result for results in per_client_results for result in results], elapsed)
+    print(format_summary(summary))
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            json.dump({
+                "url": args.url,
+                "users": args.users,
+                "concurrency": args.concurrency,
+                "duration_seconds": elapsed,
+                "mix": dict(args.mix),
+                "image_size": args.image_size,
+                "images": args.images,
+                "routes": summary
+            }, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ("serve", "run"):
+        print("usage: python loadtest.py serve|run [arguments]; add --help after serve or run for details")
+        sys.exit(2)
+    if sys.argv[1] == "serve":
+        serve(sys.argv[2:])
+    else:
+        run(sys.argv[2:])
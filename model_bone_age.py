@@ -1,5 +1,3 @@
-from bone_age import inference_bone_age
-
 import argparse
 
 
@@ -12,11 +10,92 @@ class Model(object):
         pass
 
 
+class Predictor(Model):
+    """
+    Implements predict and predict_batch from check_gender, predict_outputs and make_prediction,
+    which subclasses provide. Keyword options, such as the keys a CachingPredictor takes, are
+    passed on to predict_outputs.
+    """
+
+    def predict(self, img, gender, **options):
+        return self.predict_batch([img], [gender], **options)[0]
+
+    def predict_batch(self, imgs, genders, **options):
+        for gender in genders:
+            self.check_gender(gender)
+        y_np = self.predict_outputs(imgs, **options)
+        return [self.make_prediction(y_row, gender) for y_row, gender in zip(y_np, genders)]
+
+
+class DelegatingPredictor(Predictor):
+    """
+    Wraps another predictor and passes every call on to it. Subclasses override the calls they
+    change, usually predict_outputs.
+    """
+
+    def __init__(self, predictor):
+        self.predictor = predictor
+
+    def predict_outputs(self, imgs):
+        return self.predictor.predict_outputs(imgs)
+
+    def check_gender(self, gender):
+        self.predictor.check_gender(gender)
+
+    def preprocess(self, img, out=None):
+        return self.predictor.preprocess(img, out)
+
+    def forward(self, img_array):
+        return self.predictor.forward(img_array)
+
+    def make_prediction(self, y_np, gender):
+        return self.predictor.make_prediction(y_np, gender)
+
+
 class BoneAgePredictor(Model):
 
     def __init__(self, args):
         self.args = None
-        self.model= inference_bone_age.load_model(args.params)
+        self.backend = load_backend(getattr(args, 'backend', 'singa'))
+        load_kwargs = {'fold_bn': getattr(args, 'fold_bn', False)}
+        if getattr(args, 'device', None) is not None:
+            load_kwargs['device_spec'] = args.device
+        if getattr(args, 'precision', None) is not None:
+            load_kwargs['precision'] = args.precision
+        if getattr(args, 'static_plan', False):
+            load_kwargs['plan_batch_size'] = args.max_batch_size
+        self.model= self.backend.load_model(args.params, **load_kwargs)
     def predict(self, img, gender):
-        return inference_bone_age.predict(img, gender, self.model, self.args)
+        return self.backend.predict(img, gender, self.model, self.args)
+
+    def predict_batch(self, imgs, genders):
+        return self.backend.predict_batch(imgs, genders, self.model, self.args)
+
+    def predict_outputs(self, imgs):
+        return self.backend.predict_outputs(imgs, self.model, self.args)
+
+    def check_gender(self, gender):
+        self.backend.check_gender(gender)
+
+    def preprocess(self, img, out=None):
+        return self.backend.image2array(img, out=out)
+
+    def forward(self, img_array):
+        return self.backend.forward(self.model, img_array)
+
+    def make_prediction(self, y_np, gender):
+        return self.backend.make_prediction(y_np, gender)
+
 
+def load_backend(name):
+    """
+    Imports the inference module for a backend name. Backends are imported on demand,
+    so the numpy backend runs on machines where SINGA is not installed.
+    """
+    if name == 'singa':
+        from bone_age import inference_bone_age
+        return inference_bone_age
+    elif name == 'numpy':
+        from bone_age import numpy_xception
+        return numpy_xception
+    raise ValueError("backend must be singa or numpy, got {}".format(name))
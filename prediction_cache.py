@@ -0,0 +1,112 @@
+import collections
+import hashlib
+import threading
+import time
+
+from bone_age.utils import read_image_bytes
+from model_bone_age import DelegatingPredictor
+
+
+class PredictionCache(object):
+    """
+    Bounded LRU cache of raw network outputs, keyed by the SHA-256 of the uploaded image bytes.
+    Each entry holds the full (female, male) output row, so a repeat upload is answered for
+    either gender without touching the model. Entries expire ttl seconds after they are stored.
+    """
+
+    def __init__(self, max_entries=4096, ttl=3600.0):
+        if max_entries < 1:
+            raise ValueError("max_entries must be at least 1.")
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(img):
+        return hashlib.sha256(read_image_bytes(img)).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.live_entry(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            y_np = self.entries.pop(key)[0]
+            self.entries[key] = entry
+            return y_np
+
+    def contains(self, key):
+        """ Whether get(key) would hit, without counting a hit or a miss or refreshing the entry. """
+        with self.lock:
+            return self.live_entry(key) is not None
+
+    def live_entry(self, key):
+        """ Returns key's entry unless it has expired, in which case it is dropped; call holding lock. """
+        entry = self.entries.get(key)
+        if entry is not None and entry[1] < time.time():
+            del self.entries[key]
+            entry = None
+        return entry
+
+    def put(self, key, y_np):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (y_np, time.time() + self.ttl)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+
+class CachingPredictor(DelegatingPredictor):
+    """
+    Wraps a predictor so that images already seen are answered from a PredictionCache.
+    Only the images that miss the cache are sent to the wrapped predictor, in one batch,
+    and an image that appears more than once is predicted once. Callers that have already
+    hashed the images with make_keys pass the keys in, so each image is hashed only once.
+    """
+
+    def __init__(self, predictor, cache):
+        super(CachingPredictor, self).__init__(predictor)
+        self.cache = cache
+
+    def make_keys(self, imgs):
+        return [self.cache.make_key(img) for img in imgs]
+
+    def predict_outputs(self, imgs, keys=None):
+        if keys is None:
+            keys = self.make_keys(imgs)
+        y_np = [self.cache.get(key) for key in keys]
+
+        missing = collections.OrderedDict()
+        for key, img, y_row in zip(keys, imgs, y_np):
+            if y_row is None:
+                missing.setdefault(key, img)
+        if len(missing) > 0:
+            new_y_np = self.predictor.predict_outputs(list(missing.values()))
+            computed = dict(zip(missing.keys(), new_y_np))
+            for key, y_row in computed.items():
+                self.cache.put(key, y_row)
+            y_np = [computed[key] if y_row is None else y_row for key, y_row in zip(keys, y_np)]
+        return y_np
+
+    def count_uncached(self, keys):
+        """ The number of distinct images among keys that predict_outputs would send to the model. """
+        return len(set(key for key in keys if not self.cache.contains(key)))
+
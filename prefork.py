@@ -0,0 +1,159 @@
+import errno
+import gc
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+
+from werkzeug.serving import make_server
+
+
+# environment variables read by the BLAS and OpenMP runtimes that numpy and SINGA link against
+THREAD_ENV_VARS = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"]
+# a worker that dies sooner than this after being forked is restarted only after a pause
+RESTART_BACKOFF_SECONDS = 1.0
+
+
+class PreforkServer(object):
+    """
+    Serves a WSGI app from several forked worker processes that accept connections on one
+    shared listening socket.
+
+    Everything loaded before serve_forever() is called, in particular the model's weights, is
+    shared between the workers copy-on-write, so N workers do not need N copies of it.
+    Threads and database connections do not survive a fork, so setup_worker(index) is called
+    in each worker before it starts serving, to start the worker's own threads.
+
+    Each worker's BLAS thread pool is limited to threads_per_worker threads, and with pin_cpus
+    each worker is bound to its own threads_per_worker CPUs. Workers that die are restarted.
+    """
+
+    def __init__(self, app, host, port, workers, setup_worker=None, threads_per_worker=0, pin_cpus=False):
+        if workers < 1:
+            raise ValueError("workers must be at least 1.")
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.setup_worker = setup_worker
+        available_cpus = get_available_cpus()
+        if threads_per_worker < 1:
+            threads_per_worker = max(len(available_cpus) // workers, 1)
+        self.threads_per_worker = threads_per_worker
+        self.cpu_sets = plan_cpu_sets(available_cpus, workers, threads_per_worker) if pin_cpus else None
+        self.listener = None
+        self.children = {}
+        self.stopping = False
+
+    def serve_forever(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((self.host, self.port))
+        self.listener.listen(128)
+
+        # keep the collector from writing to every inherited object, which would unshare their pages
+        if hasattr(gc, "freeze"):
+            gc.freeze()
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for index in range(self.workers):
+            self.spawn(index)
+        self.supervise()
+
+    def spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            self.run_worker(index)
+            sys.exit(0)
+        self.children[pid] = (index, time.time())
+        print('started worker {} (pid {})'.format(index, pid))
+
+    def run_worker(self, index):
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        # exit through SystemExit, so that atexit handlers such as the quota flush still run
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        if self.cpu_sets is not None:
+            set_cpu_affinity(self.cpu_sets[index])
+        limit_intra_op_threads(self.threads_per_worker)
+        if self.setup_worker is not None:
+            self.setup_worker(index)
+
+        server = make_server(self.host, self.port, self.app, threaded=True, fd=self.listener.fileno())
+        server.serve_forever()
+
+    def supervise(self):
+        while len(self.children) > 0:
+            try:
+                pid, status = os.wait()
+            except OSError as wait_error:
+                if wait_error.errno == errno.EINTR:
+                    continue
+                raise
+            index, started_at = self.children.pop(pid, (None, None))
+            if index is None or self.stopping:
+                continue
+            print('worker {} (pid {}) exited with status {}; restarting it'.format(index, pid, status))
+            if time.time() - started_at < RESTART_BACKOFF_SECONDS:
+                time.sleep(RESTART_BACKOFF_SECONDS)
+            if not self.stopping:
+                self.spawn(index)
+        self.listener.close()
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+
+def get_available_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(multiprocessing.cpu_count()))
+
+
+def plan_cpu_sets(available_cpus, workers, threads_per_worker):
+    """
+    Gives each worker threads_per_worker consecutive CPUs, wrapping around when there are
+    more workers than CPUs to go round.
+    """
+    cpu_sets = []
+    for index in range(workers):
+        start = index * threads_per_worker
+        cpu_sets.append([available_cpus[(start + offset) % len(available_cpus)]
+                         for offset in range(threads_per_worker)])
+    return cpu_sets
+
+
+def set_cpu_affinity(cpus):
+    if not hasattr(os, "sched_setaffinity"):
+        print('CPU pinning needs Python 3 on Linux; worker {} is not pinned'.format(os.getpid()))
+        return
+    os.sched_setaffinity(0, cpus)
+
+
+def limit_intra_op_threads(threads):
+    """
+    Limits the BLAS and OpenMP thread pools of this process to threads threads. The pools are
+    resized through threadpoolctl when it is installed; otherwise only libraries loaded after
+    this call see the limit, and the ones already loaded keep the size set by THREAD_ENV_VARS
+    when the launcher started.
+    """
+    for name in THREAD_ENV_VARS:
+        os.environ[name] = str(threads)
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return None
+    try:
+        return threadpool_limits(limits=threads)
+    except Exception:
+        print('error limiting intra-op threads')
+        traceback.print_exc()
+        return None
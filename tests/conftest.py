@@ -0,0 +1,55 @@
+import io
+import os
+import sys
+import tempfile
+
+import pytest
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+# the database URI is read when app is imported, so it has to be set before any test imports it
+DATABASE_DIR = tempfile.mkdtemp(prefix="bone_age_tests_")
+os.environ["BONE_AGE_DATABASE_URI"] = "sqlite:///" + os.path.join(DATABASE_DIR, "test.db")
+
+# users has to be imported before app, as when app.py is run
+import users  # noqa: E402
+import app  # noqa: E402
+
+
+@pytest.fixture
+def user_db():
+    """ An empty User table, with the token index and write-behind ledger reset. """
+    with app.app.app_context():
+        # a background rebuild of the index must not read the tables while they are recreated
+        with users.token_index_refreshing:
+            app.db.drop_all()
+            app.db.create_all()
+            users.quota_ledger = None
+            users.rebuild_token_index()
+        yield app.db
+        if users.quota_ledger is not None:
+            users.quota_ledger.stopped.set()
+            users.quota_ledger.flusher.join()
+            users.quota_ledger = None
+        app.db.session.remove()
+
+
+@pytest.fixture(scope="session")
+def random_weights(tmp_path_factory):
+    """ A weights file with the real network's names and shapes and random values. """
+    from bone_age import weights
+
+    weights_file = str(tmp_path_factory.mktemp("weights") / "random.weights")
+    weights.save_random_weights(weights_file, seed=0)
+    return weights_file
+
+
+@pytest.fixture(scope="session")
+def img_array():
+    """ Two preprocessed synthetic radiographs. """
+    from bone_age.benchmark import synthetic_radiograph
+    from bone_age.utils import images2array
+
+    return images2array([io.BytesIO(synthetic_radiograph(512, seed)) for seed in range(2)])
@@ -0,0 +1,16 @@
+import pytest
+
+import app
+
+
+def test_write_behind_is_refused_with_workers():
+    parser = app.make_argument_parser()
+    args = parser.parse_args(["--workers", "4", "--write-behind"])
+    with pytest.raises(SystemExit):
+        app.check_worker_arguments(parser, args)
+
+
+def test_write_behind_is_allowed_in_one_process():
+    parser = app.make_argument_parser()
+    app.check_worker_arguments(parser, parser.parse_args(["--write-behind"]))
+    app.check_worker_arguments(parser, parser.parse_args(["--workers", "4"]))
@@ -0,0 +1,111 @@
+import io
+import os
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import batching
+from bone_age.benchmark import synthetic_radiograph
+from bone_age.utils import image2array
+from loadtest import StubPredictor
+
+
+def die(data, index, ticket):
+    os._exit(1)
+
+
+class EchoPredictor(StubPredictor):
+    """ Returns each image's mean pixel, and remembers the arrays it was given. """
+
+    def __init__(self):
+        super(EchoPredictor, self).__init__(delay=0.0)
+        self.inputs = []
+
+    def forward(self, img_array):
+        self.inputs.append(img_array)
+        means = img_array.reshape(len(img_array), -1).mean(axis=1)
+        return np.stack([means, means], axis=1)
+
+
+def predict_concurrently(batching_predictor, images):
+    results = [None] * len(images)
+
+    def predict(i):
+        results[i] = batching_predictor.predict_outputs([io.BytesIO(images[i])])[0]
+
+    threads = [threading.Thread(target=predict, args=(i,)) for i in range(len(images))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_batch_shares_forward_passes():
+    predictor = StubPredictor(delay=0.05)
+    batching_predictor = batching.BatchingPredictor(predictor, max_batch_size=4, max_wait=0.2)
+    image = synthetic_radiograph(64, 0)
+    results = []
+
+    def predict():
+        results.append(batching_predictor.predict(io.BytesIO(image), "female"))
+
+    threads = [threading.Thread(target=predict) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    batching_predictor.close()
+    assert len(results) == 4
+    assert batching_predictor.stats.as_dict()["batch_sizes"] == {4: 1}
+
+
+@pytest.mark.parametrize("preprocess_workers", [0, 2])
+def test_images_are_decoded_into_the_batch_buffer(preprocess_workers):
+    predictor = EchoPredictor()
+    batching_predictor = batching.BatchingPredictor(predictor, max_batch_size=3, max_wait=0.2,
+                                                    preprocess_workers=preprocess_workers, queue_depth=6)
+    images = [synthetic_radiograph(64, seed) for seed in range(6)]
+    try:
+        results = predict_concurrently(batching_predictor, images)
+    finally:
+        batching_predictor.close()
+    for image, result in zip(images, results):
+        assert result[0] == pytest.approx(image2array(io.BytesIO(image)).mean(), rel=1e-5)
+    for img_array in predictor.inputs:
+        assert any(np.shares_memory(img_array, buffer) for buffer in batching_predictor.buffers)
+
+
+def test_dead_preprocessing_process_fails_the_request(monkeypatch):
+    # the pool's processes are forked with the patched function
+    monkeypatch.setattr(batching, "preprocess_into_row", die)
+    batching_predictor = batching.BatchingPredictor(StubPredictor(delay=0.0), preprocess_workers=1,
+                                                    preprocess_timeout=1.0)
+    start = time.time()
+    try:
+        with pytest.raises(batching.PreprocessTimeoutError):
+            batching_predictor.predict_outputs([io.BytesIO(synthetic_radiograph(64, 0))])
+    finally:
+        batching_predictor.pool.terminate()
+        batching_predictor.close()
+    assert time.time() - start < 10
+
+
+def test_late_row_is_not_written_after_its_ticket_is_cleared():
+    batching_predictor = batching.BatchingPredictor(StubPredictor(delay=0.0), preprocess_workers=1)
+    try:
+        shared = batching_predictor.shared
+        row = shared.row(0)
+        row[...] = -1
+        shared.set_ticket(0, 7)
+        shared.set_ticket(0, 0)
+        seconds, error = batching.preprocess_into_row(synthetic_radiograph(64, 0), 0, 7)
+        assert error is None
+        assert (row == -1).all()
+        shared.set_ticket(0, 8)
+        batching.preprocess_into_row(synthetic_radiograph(64, 0), 0, 8)
+        assert (row >= 0).all()
+    finally:
+        batching_predictor.close()
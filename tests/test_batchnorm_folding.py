@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+
+from bone_age import numpy_xception
+
+
+def test_numpy_folding_matches_unfolded_network(random_weights, img_array):
+    model = numpy_xception.load_model(random_weights)
+    expected = numpy_xception.forward(model, img_array)
+    numpy_xception.fold_batchnorm(model)
+    np.testing.assert_allclose(numpy_xception.forward(model, img_array), expected, rtol=1e-4, atol=1e-3)
+    assert not any(name.endswith("running_var") for name, _ in model.named_params())
+
+
+def test_singa_folded_params_match_numpy_names(random_weights):
+    pytest.importorskip("singa")
+    from bone_age import inference_bone_age
+
+    model = inference_bone_age.load_model(random_weights, device_spec="cpu", fold_bn=True)
+    numpy_model = numpy_xception.load_model(random_weights, fold_bn=True)
+    assert [name for name, _ in model.named_params()] == [name for name, _ in numpy_model.named_params()]
+    assert len(model.params()) == len(numpy_model.named_params())
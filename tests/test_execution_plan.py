@@ -0,0 +1,110 @@
+import numpy as np
+import pytest
+
+from bone_age import execution_plan
+from bone_age import numpy_xception
+
+
+def assert_close(actual, expected):
+    np.testing.assert_allclose(actual, expected, rtol=1e-4, atol=1e-5 * np.abs(expected).max())
+
+
+def make_model(random_weights, variant):
+    model = numpy_xception.load_model(random_weights, fold_bn=variant in ("folded", "bf16"))
+    if variant == "bf16":
+        model.set_precision("bf16")
+    return model
+
+
+@pytest.mark.parametrize("variant", ["float32", "folded", "bf16"])
+def test_plan_matches_layer_model(random_weights, img_array, variant):
+    model = make_model(random_weights, variant)
+    expected = model(img_array)
+    plan = execution_plan.compile_plan(model, max_batch_size=2)
+    assert_close(plan.run(img_array), expected)
+
+
+def test_partial_and_oversized_batches(random_weights, img_array):
+    model = numpy_xception.load_model(random_weights, fold_bn=True)
+    expected = model(img_array)
+    plan = execution_plan.compile_plan(model, max_batch_size=2)
+    assert_close(plan.run(img_array[:1]), expected[:1])
+    three = np.concatenate([img_array, img_array[:1]])
+    assert_close(plan.run(three), np.concatenate([expected, expected[:1]]))
+
+
+def test_forward_uses_the_attached_plan(random_weights, img_array):
+    model = numpy_xception.load_model(random_weights, fold_bn=True, plan_batch_size=2)
+    assert model.plan is not None
+    assert_close(numpy_xception.forward(model, img_array), model(img_array))
+
+
+def test_allocator_reuses_and_merges_free_blocks():
+    allocator = execution_plan.ArenaAllocator()
+    a = allocator.allocate(16)
+    b = allocator.allocate(32)
+    c = allocator.allocate(16)
+    allocator.release(a, 16)
+    allocator.release(b, 32)
+    assert allocator.free_blocks == [(0, 48)]
+    # best fit takes the front of the merged block, and the arena does not grow
+    assert allocator.allocate(40) == 0
+    assert allocator.size == c + 16
+
+
+def memory_lifetimes(plan):
+    """ Returns (slot, first step, last step, start, end) for every slot with its own memory. """
+    slots, steps = plan.slots, plan.steps
+    first = {}
+    last = {}
+    for index, step in enumerate(steps):
+        for slot in [step.output] + step.scratch:
+            first.setdefault(slot, index)
+            last[slot] = max(last.get(slot, index), index)
+        for slot in step.inputs:
+            owner = execution_plan.memory_owner(slots, slot)
+            last[owner] = index
+    last[execution_plan.memory_owner(slots, plan.output_slot)] = len(steps)
+    size = plan.max_batch_size
+    return [(slot, first[slot], last[slot], offset, offset + execution_plan.align(slots[slot].size(size)))
+            for slot, offset in enumerate(plan.offsets) if offset is not None]
+
+
+def test_live_slots_never_share_memory(random_weights):
+    model = numpy_xception.load_model(random_weights, fold_bn=True)
+    plan = execution_plan.compile_plan(model, max_batch_size=2)
+    lifetimes = memory_lifetimes(plan)
+    for i, (slot_a, first_a, last_a, start_a, end_a) in enumerate(lifetimes):
+        for slot_b, first_b, last_b, start_b, end_b in lifetimes[i + 1:]:
+            if first_a > last_b or first_b > last_a or start_a >= end_b or start_b >= end_a:
+                continue
+            # the only overlap allowed is an in-place step writing over its dying input
+            donor, output = (slot_a, slot_b) if first_a < first_b else (slot_b, slot_a)
+            step = plan.steps[max(first_a, first_b)]
+            assert step.inplace and step.output == output and donor in [
+                execution_plan.memory_owner(plan.slots, slot) for slot in step.inputs], (slot_a, slot_b)
+    assert plan.arena_bytes() < plan.unshared_bytes() / 4
+
+
+def test_arena_reuse_keeps_runs_independent(random_weights, img_array):
+    import threading
+
+    model = numpy_xception.load_model(random_weights, fold_bn=True)
+    plan = execution_plan.compile_plan(model, max_batch_size=2)
+    expected = [plan.run(img_array[:1]), plan.run(img_array[1:])]
+    expected_pair = plan.run(img_array)
+    results = []
+
+    def run(index):
+        for _ in range(3):
+            results.append((index, plan.run(img_array[index:index + 1])))
+
+    threads = [threading.Thread(target=run, args=(index % 2,)) for index in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 12
+    for index, output in results:
+        np.testing.assert_array_equal(output, expected[index])
+    np.testing.assert_array_equal(plan.run(img_array), expected_pair)
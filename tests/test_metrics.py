@@ -0,0 +1,59 @@
+import multiprocessing
+
+import pytest
+
+from bone_age import metrics
+
+
+@pytest.fixture
+def fresh_metrics(monkeypatch):
+    """ Restores the module's recording state, and every metric's values, after the test. """
+    for name in ("enabled", "shared_values", "shared_row_size", "shared_workers", "worker_row", "worker_pid"):
+        monkeypatch.setattr(metrics, name, getattr(metrics, name))
+    for metric in metrics.registry:
+        monkeypatch.setattr(metric, "offset", metric.offset)
+        monkeypatch.setattr(metric, "local_values", list(metric.local_values))
+    monkeypatch.setattr(metrics.QUEUE_DEPTH, "read_value", None)
+    metrics.enable()
+
+
+def sample_value(text, sample):
+    for line in text.splitlines():
+        if line.startswith(sample + " "):
+            return float(line.split(" ")[-1])
+    return None
+
+
+def record_in_worker(index, batch_sizes, queue_depth):
+    metrics.set_worker(index)
+    metrics.QUEUE_DEPTH.read_value = lambda: queue_depth
+    for batch_size in batch_sizes:
+        metrics.BATCH_SIZE.observe(batch_size)
+    metrics.QUEUE_DEPTH.publish()
+
+
+def test_single_process_histogram(fresh_metrics):
+    metrics.BATCH_SIZE.observe(3)
+    metrics.BATCH_SIZE.observe(8)
+    text = metrics.render()
+    assert sample_value(text, 'bone_age_batch_size_bucket{le="4"}') == 1
+    assert sample_value(text, "bone_age_batch_size_count") == 2
+    assert sample_value(text, "bone_age_batch_size_sum") == 11
+
+
+def test_workers_are_summed(fresh_metrics):
+    metrics.enable_multiprocess(2)
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=record_in_worker, args=(0, [1, 2, 8], 3)),
+               context.Process(target=record_in_worker, args=(1, [8, 64], 5))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+        assert worker.exitcode == 0
+
+    text = metrics.render()
+    assert sample_value(text, "bone_age_batch_size_count") == 5
+    assert sample_value(text, "bone_age_batch_size_sum") == 83
+    assert sample_value(text, 'bone_age_batch_size_bucket{le="8"}') == 4
+    assert sample_value(text, "bone_age_queue_depth") == 8
@@ -0,0 +1,80 @@
+import io
+
+import pytest
+
+import app
+import errors
+import users
+from bone_age.benchmark import synthetic_radiograph
+from loadtest import StubPredictor
+from prediction_cache import PredictionCache, CachingPredictor
+
+
+@pytest.fixture
+def free_cache_hits(user_db, monkeypatch):
+    cache = PredictionCache(max_entries=16)
+    monkeypatch.setattr(app, "prediction_cache", cache)
+    monkeypatch.setattr(app, "classifier", CachingPredictor(StubPredictor(delay=0.0), cache))
+    monkeypatch.setitem(app.app.config, "CACHE_HITS_USE_QUOTA", False)
+    users.add_user_from_info({"name": "carol", "token": "carol-token", "total_quota": 1})
+    return app.app.test_client()
+
+
+def post_model(client, path, images):
+    data = {"image": [(io.BytesIO(image), "radiograph.png") for image in images],
+            "gender": ["female"] * len(images)}
+    return client.post(path, data=data, headers={"Authorization": "carol-token"},
+                       content_type="multipart/form-data")
+
+
+def test_cached_images_are_answered_without_quota(free_cache_hits):
+    image = synthetic_radiograph(64, 0)
+    assert post_model(free_cache_hits, "/model", [image]).get_json()["quotas"]["quota_left"] == 0
+
+    response = post_model(free_cache_hits, "/model", [image])
+    assert response.status_code == 200
+    response = post_model(free_cache_hits, "/model/batch", [image, image])
+    assert response.status_code == 200
+    assert response.get_json()["quotas"]["quota_left"] == 0
+
+
+def test_uncached_images_still_need_quota(free_cache_hits):
+    post_model(free_cache_hits, "/model", [synthetic_radiograph(64, 0)])
+    assert post_model(free_cache_hits, "/model", [synthetic_radiograph(64, 1)]).status_code == 401
+    assert post_model(free_cache_hits, "/model/batch",
+                      [synthetic_radiograph(64, 0), synthetic_radiograph(64, 2)]).status_code == 401
+
+
+def test_repeated_uncached_image_is_charged_once(free_cache_hits):
+    image = synthetic_radiograph(64, 0)
+    response = post_model(free_cache_hits, "/model/batch", [image, image])
+    assert response.status_code == 200
+    assert response.get_json()["quotas"]["quota_left"] == 0
+
+
+@pytest.mark.parametrize("path, count", [("/model", 1), ("/model/batch", 3)])
+def test_each_image_is_hashed_once(free_cache_hits, monkeypatch, path, count):
+    hashed = []
+    make_key = PredictionCache.make_key
+    monkeypatch.setattr(PredictionCache, "make_key", staticmethod(lambda img: hashed.append(img) or make_key(img)))
+    post_model(free_cache_hits, path, [synthetic_radiograph(64, 0)] * count)
+    assert len(hashed) == count
+
+
+def test_contains_does_not_count_or_refresh():
+    cache = PredictionCache(max_entries=16)
+    cache.put("a", 1)
+    assert cache.contains("a") and not cache.contains("b")
+    assert (cache.hits, cache.misses) == (0, 0)
+
+
+def delete_then_refuse(token, amount=1):
+    users.delete_user_by_name("carol")
+    raise errors.UserAuthenticationError("No more request quota.")
+
+
+@pytest.mark.parametrize("path", ["/model", "/model/batch"])
+def test_user_deleted_while_quota_is_refused(free_cache_hits, monkeypatch, path):
+    monkeypatch.setattr(users, "reserve_user_quota", delete_then_refuse)
+    response = post_model(free_cache_hits, path, [synthetic_radiograph(64, 0)])
+    assert response.status_code == 404
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from bone_age import numpy_xception
+from bone_age import weights
+
+
+def param_bytes(model):
+    return sum(array.nbytes for _, array in model.named_params())
+
+
+@pytest.mark.parametrize("precision, tolerance", [("fp16", 0.01), ("bf16", 0.05)])
+def test_half_precision_stays_close_to_float32(random_weights, img_array, precision, tolerance):
+    model = numpy_xception.load_model(random_weights)
+    expected = numpy_xception.forward(model, img_array)
+    float_bytes = param_bytes(model)
+
+    model.set_precision(precision)
+    outputs = numpy_xception.forward(model, img_array)
+    assert np.abs(outputs - expected).max() <= tolerance * np.abs(expected).max()
+    assert param_bytes(model) < 0.55 * float_bytes
+    assert all(array.dtype == weights.PRECISION_DTYPES[precision]
+               for name, array in model.named_params() if name.endswith(".W"))
+
+
+def test_half_precision_weights_file_loads_the_same_network(random_weights, img_array, tmp_path):
+    half_file = str(tmp_path / "model.bf16")
+    weights.convert_precision(random_weights, half_file, "bf16")
+    from_file = numpy_xception.load_model(half_file)
+    converted = numpy_xception.load_model(random_weights, precision="bf16")
+    np.testing.assert_array_equal(numpy_xception.forward(from_file, img_array),
+                                  numpy_xception.forward(converted, img_array))
+
+
+def test_bf16_rounds_to_nearest_even():
+    values = np.array([1.0, 1.0 + 2 ** -8, 1.0 + 3 * 2 ** -8, -2.5, 3e38], dtype=np.float32)
+    rounded = weights.upcast_half(weights.to_precision(values, "bf16"))
+    np.testing.assert_array_equal(rounded[:4], np.array([1.0, 1.0, 1.0 + 2 ** -6, -2.5], dtype=np.float32))
+    assert abs(rounded[4] - 3e38) / 3e38 < 2 ** -8
+
+
+@pytest.mark.filterwarnings("ignore:overflow encountered")
+def test_fp16_overflow_is_refused():
+    with pytest.raises(ValueError):
+        weights.to_precision(np.array([1e5], dtype=np.float32), "fp16")
@@ -0,0 +1,36 @@
+import numpy as np
+
+from bone_age import numpy_xception
+from bone_age import quantization
+from bone_age import weights
+
+
+def test_int8_model_stays_close_to_float32(random_weights, img_array):
+    model = numpy_xception.load_model(random_weights)
+    expected = numpy_xception.forward(model, img_array)
+    quantization.quantize_model(model)
+    outputs = numpy_xception.forward(model, img_array)
+    # random weights amplify rounding error far more than trained ones, so this only checks that
+    # the rounded network tracks the float32 one
+    assert np.abs(outputs - expected).max() <= 0.2 * np.abs(expected).max()
+
+
+def test_quantizes_a_model_loaded_folded(random_weights):
+    model = numpy_xception.load_model(random_weights, fold_bn=True)
+    params = dict(quantization.quantize_model(model))
+    assert params["conv1.b"] is model.conv1.b
+    assert params["fc.W"].dtype == np.int8
+
+
+def test_int8_file_loads_as_float32_only(random_weights, img_array, tmp_path):
+    model = numpy_xception.load_model(random_weights)
+    params = quantization.quantize_model(model)
+    quantized_file = str(tmp_path / "model.int8")
+    weights.save_weights(quantized_file, params)
+    assert quantization.param_bytes(params) < 0.3 * quantization.param_bytes(model.named_params())
+
+    reloaded = numpy_xception.load_model(quantized_file, fold_bn=True)
+    assert all(array.dtype == np.float32 for _, array in reloaded.named_params())
+    assert all(not name.endswith(".W_scale") for name, _ in reloaded.named_params())
+    np.testing.assert_array_equal(numpy_xception.forward(reloaded, img_array),
+                                  numpy_xception.forward(model, img_array))
@@ -0,0 +1,36 @@
+import threading
+
+import app
+import errors
+import users
+
+
+def test_concurrent_database_reservations_never_overspend(user_db):
+    users.add_user_from_info({"name": "busy", "token": "busy-token", "total_quota": 100})
+    reserved = []
+
+    def reserve_many():
+        with app.app.app_context():
+            for _ in range(30):
+                try:
+                    users.reserve_user_quota("busy-token")
+                    reserved.append(1)
+                except errors.UserAuthenticationError:
+                    pass
+
+    threads = [threading.Thread(target=reserve_many) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(reserved) == 100
+    user_db.session.expire_all()
+    assert users.read_user_quotas("busy-token")["quota_left"] == 0
+
+
+def test_refund_never_exceeds_total_quota(user_db):
+    users.add_user_from_info({"name": "solo", "token": "solo-token", "total_quota": 3})
+    users.reserve_user_quota("solo-token", amount=2)
+    assert users.refund_user_quota("solo-token", amount=2)["quota_left"] == 3
+    assert users.refund_user_quota("solo-token", amount=1)["quota_left"] == 3
+    assert users.get_user_quotas("solo-token")["quota_left"] == 3
@@ -0,0 +1,111 @@
+import threading
+
+import pytest
+
+import app
+import errors
+import users
+
+
+def make_ledger(flush_interval=0.05, flush_every=7):
+    users.quota_ledger = users.QuotaLedger(flush_interval=flush_interval, flush_every=flush_every)
+    return users.quota_ledger
+
+
+def stored_quota_left(token):
+    return users.read_user_quotas(token)["quota_left"]
+
+
+def test_concurrent_reservations_never_overspend(user_db):
+    users.add_user_from_info({"name": "busy", "token": "busy-token", "total_quota": 1000})
+    ledger = make_ledger()
+    reserved = []
+
+    def reserve_many():
+        with app.app.app_context():
+            for _ in range(200):
+                try:
+                    users.reserve_user_quota("busy-token")
+                    reserved.append(1)
+                except errors.UserAuthenticationError:
+                    pass
+
+    threads = [threading.Thread(target=reserve_many) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    ledger.close()
+
+    assert len(reserved) == 1000
+    user_db.session.expire_all()
+    assert stored_quota_left("busy-token") == 0
+
+
+def test_rebuild_during_flushes_keeps_pending_amounts(user_db):
+    users.add_user_from_info({"name": "busy", "token": "busy-token", "total_quota": 500})
+    ledger = make_ledger(flush_interval=0.01, flush_every=3)
+    stop = threading.Event()
+
+    def rebuild():
+        with app.app.app_context():
+            while not stop.is_set():
+                users.rebuild_token_index()
+
+    rebuilder = threading.Thread(target=rebuild)
+    rebuilder.start()
+    reserved = 0
+    try:
+        for _ in range(600):
+            try:
+                users.reserve_user_quota("busy-token")
+                reserved += 1
+            except errors.UserAuthenticationError:
+                pass
+    finally:
+        stop.set()
+        rebuilder.join()
+    ledger.close()
+    assert reserved == 500
+
+
+def test_failed_flush_keeps_the_reservation_pending(user_db, monkeypatch):
+    users.add_user_from_info({"name": "solo", "token": "solo-token", "total_quota": 10})
+    ledger = make_ledger(flush_interval=60.0, flush_every=1)
+
+    def fail(token, amount):
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(users, "write_quota_change", fail)
+    new_quotas = users.reserve_user_quota("solo-token", amount=3)
+    assert new_quotas["quota_left"] == 7
+    assert ledger.pending_for("solo-token") == 3
+
+    monkeypatch.undo()
+    ledger.flush()
+    assert ledger.pending_for("solo-token") == 0
+    user_db.session.expire_all()
+    assert stored_quota_left("solo-token") == 7
+    assert users.get_user_quotas("solo-token")["quota_left"] == 7
+
+
+def test_flush_raises_to_explicit_callers(user_db, monkeypatch):
+    users.add_user_from_info({"name": "solo", "token": "solo-token", "total_quota": 10})
+    ledger = make_ledger(flush_interval=60.0, flush_every=100)
+    users.reserve_user_quota("solo-token")
+    monkeypatch.setattr(users, "write_quota_change", lambda token, amount: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        ledger.flush()
+    assert ledger.pending_for("solo-token") == 1
+
+
+@pytest.mark.parametrize("write_behind", [False, True])
+def test_refund_is_capped_at_total_quota(user_db, write_behind):
+    users.add_user_from_info({"name": "capped", "token": "capped-token", "total_quota": 3})
+    users.reserve_user_quota("capped-token", amount=1)
+    if write_behind:
+        make_ledger(flush_interval=60)
+    assert users.refund_user_quota("capped-token", amount=2) == {"total_quota": 3, "quota_left": 3}
+    users.flush_quotas()
+    assert stored_quota_left("capped-token") == 3
+    assert users.get_user_quotas("capped-token")["quota_left"] == 3
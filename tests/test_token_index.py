@@ -0,0 +1,116 @@
+import threading
+import time
+
+import pytest
+
+import app
+import errors
+import users
+
+
+def seed_users(count, quota=10):
+    users.add_users_from_info([{"name": "user-{}".format(index), "token": "token-{}".format(index),
+                                "total_quota": quota} for index in range(count)])
+
+
+def test_lookups_never_miss_during_rebuild(user_db):
+    seed_users(2000)
+    users.rebuild_token_index()
+    stop = threading.Event()
+    misses = []
+
+    def look_up():
+        while not stop.is_set():
+            for index in range(0, 2000, 7):
+                try:
+                    users.look_up_indexed_user_info("token-{}".format(index))
+                except errors.UserNotFoundError:
+                    misses.append(index)
+
+    readers = [threading.Thread(target=look_up) for _ in range(4)]
+    for reader in readers:
+        reader.start()
+    try:
+        for _ in range(30):
+            users.rebuild_token_index()
+    finally:
+        stop.set()
+        for reader in readers:
+            reader.join()
+    assert misses == []
+
+
+def test_rebuild_picks_up_changes_made_elsewhere(user_db, monkeypatch):
+    monkeypatch.setattr(users, "TOKEN_INDEX_CHECK_SECONDS", 3600.0)
+    seed_users(3)
+    user_db.session.query(users.User).filter(users.User.token == "token-1").update({users.User.quota_left: 4})
+    user_db.session.commit()
+    assert users.get_user_quotas("token-1")["quota_left"] == 10
+    users.rebuild_token_index()
+    assert users.get_user_quotas("token-1")["quota_left"] == 4
+
+
+def wait_for_refresh():
+    with users.token_index_refreshing:
+        pass
+
+
+def test_readers_do_not_wait_for_a_rebuild(user_db, monkeypatch):
+    seed_users(10)
+    rebuilds = []
+    read_all = users.get_all_users_info
+
+    def slow_read_all():
+        rebuilds.append(1)
+        time.sleep(0.5)
+        return read_all()
+
+    monkeypatch.setattr(users, "get_all_users_info", slow_read_all)
+    monkeypatch.setattr(users, "token_index_built_at", time.time() - 2 * users.TOKEN_INDEX_REFRESH_SECONDS)
+    monkeypatch.setattr(users, "token_index_checked_at", None)
+    seconds = []
+
+    def look_up(index):
+        with app.app.app_context():
+            start = time.time()
+            users.get_indexed_user_info("token-{}".format(index))
+            seconds.append(time.time() - start)
+
+    threads = [threading.Thread(target=look_up, args=(index,)) for index in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wait_for_refresh()
+    assert max(seconds) < 0.3
+    assert rebuilds == [1]
+    assert not users.token_index_is_stale()
+
+
+def test_changes_from_another_process_show_after_a_check(user_db, monkeypatch):
+    monkeypatch.setattr(users, "TOKEN_INDEX_CHECK_SECONDS", 3600.0)
+    seed_users(3)
+    users.rebuild_token_index()
+    # what another process's delete and token change commit
+    user_db.session.query(users.User).filter(users.User.token == "token-1").delete()
+    user_db.session.query(users.User).filter(users.User.token == "token-2").update({users.User.token: "moved"})
+    users.bump_users_version()
+    user_db.session.commit()
+    assert users.get_indexed_user_info("token-1")["name"] == "user-1"
+
+    monkeypatch.setattr(users, "TOKEN_INDEX_CHECK_SECONDS", 0.0)
+    users.get_indexed_user_info("token-0")
+    wait_for_refresh()
+    for token in ["token-1", "token-2"]:
+        with pytest.raises(errors.UserNotFoundError):
+            users.get_indexed_user_info(token)
+    assert users.get_indexed_user_info("moved")["name"] == "user-2"
+
+
+def test_unknown_token_is_looked_up_in_the_database(user_db, monkeypatch):
+    monkeypatch.setattr(users, "TOKEN_INDEX_CHECK_SECONDS", 3600.0)
+    user_db.session.add(users.User(name="elsewhere", token="new-token", total_quota=5, quota_left=5))
+    user_db.session.commit()
+    assert users.get_user_quotas("new-token") == {"total_quota": 5, "quota_left": 5}
+    with pytest.raises(errors.UserNotFoundError):
+        users.get_user_quotas("no-such-token")
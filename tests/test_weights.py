@@ -0,0 +1,41 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from bone_age import numpy_xception
+from bone_age import weights
+
+
+def test_weights_file_round_trips(random_weights, tmp_path):
+    model = numpy_xception.load_model(random_weights)
+    copy_file = str(tmp_path / "copy.weights")
+    weights.save_weights(copy_file, model.named_params())
+    copy = numpy_xception.load_model(copy_file)
+    for (name, array), (copy_name, copy_array) in zip(model.named_params(), copy.named_params()):
+        assert name == copy_name
+        np.testing.assert_array_equal(array, copy_array)
+
+
+def test_pickled_params_convert_without_singa(random_weights, tmp_path):
+    model = numpy_xception.load_model(random_weights)
+    pickle_file = str(tmp_path / "params.pickle")
+    with open(pickle_file, "wb") as opened_file:
+        for _, array in model.named_params():
+            pickle.dump(np.asarray(array), opened_file)
+    converted_file = str(tmp_path / "converted.weights")
+    weights.convert_pickle_params(pickle_file, converted_file)
+    converted = weights.load_weights(converted_file)
+    assert list(converted) == [name for name, _ in model.named_params()]
+    for name, array in model.named_params():
+        np.testing.assert_array_equal(converted[name], array)
+
+
+def test_transposed_weights_are_rejected(random_weights, tmp_path):
+    arrays = dict(weights.load_weights(random_weights))
+    # same size as the real (in, out) matrix, but the wrong way round
+    arrays["linear1.W"] = np.ascontiguousarray(arrays["linear1.W"].T)
+    bad_file = str(tmp_path / "transposed.weights")
+    weights.save_weights(bad_file, sorted(arrays.items()))
+    with pytest.raises(ValueError, match="linear1.W has shape"):
+        numpy_xception.load_model(bad_file)
@@ -1,10 +1,15 @@
+import atexit
 import random
 import string
+import threading
+import time
+import traceback
 
 import app
 import errors
 
 
+# name and token are looked up on every request; their unique constraints give both a unique index
 class User(app.db.Model):
     id = app.db.Column(app.db.Integer, primary_key=True)
     name = app.db.Column(app.db.String(80), unique=True, nullable=False)
@@ -50,25 +55,417 @@ class User(app.db.Model):
         )
 
 
+# a single row whose version is bumped in the same transaction as every change made to users
+# through this module, so that other processes can tell that their token index is out of date
+class UsersVersion(app.db.Model):
+    id = app.db.Column(app.db.Integer, primary_key=True)
+    version = app.db.Column(app.db.Integer, nullable=False)
+
+
+# token -> user info, so that authentication and quota checks do not query the database.
+# Writes through this module keep it in sync. Every TOKEN_INDEX_CHECK_SECONDS one request reads
+# UsersVersion, and the index is rebuilt in the background when another process has changed
+# users or the index is TOKEN_INDEX_REFRESH_SECONDS old.
+TOKEN_INDEX_CHECK_SECONDS = 1.0
+TOKEN_INDEX_REFRESH_SECONDS = 30.0
+token_index = {}
+token_index_lock = threading.Lock()
+token_index_built_at = None
+token_index_checked_at = None
+token_index_version = None
+# held while the index is being checked or rebuilt, so that only one refresh runs at a time
+token_index_refreshing = threading.Lock()
+
+
+# set by enable_write_behind(); when set, quota is reserved in memory and flushed in batches
+quota_ledger = None
+# guards the ledger's pending amounts; taken before token_index_lock whenever both are needed
+quota_lock = threading.RLock()
+# held for the whole of a flush or an index rebuild, so that neither sees amounts another flush
+# has taken out of pending but not yet committed; taken before quota_lock
+quota_flush_lock = threading.Lock()
+
+
+class QuotaLedger(object):
+    """
+    Write-behind quota accounting. Reservations and refunds are checked and applied against
+    the token index straight away, and the net amount per token is kept as pending. Pending
+    amounts are written to the User table in one transaction every flush_interval seconds,
+    after flush_every changes, and when the process exits. A crash therefore loses at most
+    flush_every reservations, or flush_interval seconds of them, whichever comes first.
+    """
+
+    def __init__(self, flush_interval=1.0, flush_every=100):
+        self.flush_interval = flush_interval
+        self.flush_every = flush_every
+        self.lock = quota_lock
+        self.flush_lock = quota_flush_lock
+        self.pending = {}
+        self.changes = 0
+        self.stopped = threading.Event()
+        self.flusher = threading.Thread(target=self.run_flusher, name="quota-flusher")
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def reserve(self, token, amount):
+        refresh_token_index(token)
+        with self.lock:
+            user_info = look_up_indexed_user_info(token)
+            if user_info["quota_left"] < amount:
+                raise errors.UserAuthenticationError("No more request quota.")
+            new_quotas = {
+                "total_quota": user_info["total_quota"],
+                "quota_left": user_info["quota_left"] - amount
+            }
+            flush_now = self.record(token, amount, new_quotas)
+        if flush_now:
+            self.try_flush()
+        return new_quotas
+
+    def refund(self, token, amount):
+        refresh_token_index(token)
+        with self.lock:
+            user_info = look_up_indexed_user_info(token)
+            new_quotas = {
+                "total_quota": user_info["total_quota"],
+                "quota_left": min(user_info["quota_left"] + amount, user_info["total_quota"])
+            }
+            flush_now = self.record(token, user_info["quota_left"] - new_quotas["quota_left"], new_quotas)
+        if flush_now:
+            self.try_flush()
+        return new_quotas
+
+    def record(self, token, amount, new_quotas):
+        self.pending[token] = self.pending.get(token, 0) + amount
+        self.changes += 1
+        update_indexed_quotas(token, new_quotas)
+        return self.changes >= self.flush_every
+
+    def pending_for(self, token):
+        with self.lock:
+            return self.pending.get(token, 0)
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+                self.changes = 0
+            pending = dict((token, amount) for token, amount in pending.items() if amount != 0)
+            if len(pending) == 0:
+                return
+
+            with app.app.app_context():
+                try:
+                    for token, amount in pending.items():
+                        write_quota_change(token, amount)
+                    flushed_quotas = dict((token, read_user_quotas(token)) for token in pending)
+                    app.db.session.commit()
+                except Exception:
+                    app.db.session.rollback()
+                    with self.lock:
+                        for token, amount in pending.items():
+                            self.pending[token] = self.pending.get(token, 0) + amount
+                            self.changes += 1
+                    raise
+
+            with self.lock:
+                for token, quotas in flushed_quotas.items():
+                    if quotas is not None:
+                        quotas["quota_left"] -= self.pending.get(token, 0)
+                        update_indexed_quotas(token, quotas)
+        return
+
+    def try_flush(self):
+        """
+        Flushes, and on a database error logs it and leaves the amounts pending for the next
+        flush, so that the reservation that triggered the flush still stands.
+        """
+        try:
+            self.flush()
+        except Exception:
+            print('error flushing quotas')
+            traceback.print_exc()
+
+    def run_flusher(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.try_flush()
+
+    def close(self):
+        self.stopped.set()
+        self.flusher.join()
+        self.flush()
+
+
+def enable_write_behind(flush_interval=1.0, flush_every=100):
+    global quota_ledger
+    quota_ledger = QuotaLedger(flush_interval=flush_interval, flush_every=flush_every)
+    atexit.register(quota_ledger.close)
+    return quota_ledger
+
+
+def flush_quotas():
+    if quota_ledger is not None:
+        quota_ledger.flush()
+    return
+
+
 def initialize():
     app.db.create_all()
+    if UsersVersion.query.filter(UsersVersion.id == 1).first() is None:
+        app.db.session.add(UsersVersion(id=1, version=0))
+        app.db.session.commit()
+    rebuild_token_index()
+    return
+
+
+def dispose_connections():
+    """
+    Closes the pooled database connections, so that processes forked afterwards open their own
+    rather than sharing this process's sockets.
+    """
+    app.db.session.remove()
+    app.db.engine.dispose()
+    return
+
+
+def rebuild_token_index():
+    """
+    Builds a new index from the User table and swaps it in with one assignment, so that readers
+    see either the old index or the new one and never a half-filled dict.
+    """
+    global token_index, token_index_built_at, token_index_checked_at, token_index_version
+    with quota_flush_lock:
+        # read first, so that a change committed during the rebuild still triggers the next one
+        version = read_users_version()
+        all_users_info = get_all_users_info()
+        with quota_lock:
+            new_index = {}
+            for user_info in all_users_info:
+                if quota_ledger is not None:
+                    pending = quota_ledger.pending.get(user_info["token"], 0)
+                    user_info["quota_left"] = max(user_info["quota_left"] - pending, 0)
+                new_index[user_info["token"]] = user_info
+            with token_index_lock:
+                token_index = new_index
+                token_index_built_at = time.time()
+                token_index_checked_at = token_index_built_at
+                token_index_version = version
+    return
+
+
+def rebuild_token_index_in_background():
+    """ Runs on its own thread, holding token_index_refreshing, which it releases when done. """
+    try:
+        with app.app.app_context():
+            rebuild_token_index()
+    except Exception:
+        print('error rebuilding the token index')
+        traceback.print_exc()
+    finally:
+        token_index_refreshing.release()
+
+
+
+def index_user(user_info, old_token=None):
+    with token_index_lock:
+        if old_token is not None:
+            token_index.pop(old_token, None)
+        token_index[user_info["token"]] = user_info
+    return
+
+
+def unindex_user(token):
+    with token_index_lock:
+        token_index.pop(token, None)
+    return
+
+
+def token_index_is_stale():
+    return token_index_built_at is None or time.time() - token_index_built_at > TOKEN_INDEX_REFRESH_SECONDS
+
+
+def token_index_check_is_due():
+    return token_index_checked_at is None or time.time() - token_index_checked_at >= TOKEN_INDEX_CHECK_SECONDS
+
+
+def token_index_needs_database(token):
+    """ Whether refresh_token_index(token) may query the database. """
+    return token_index_built_at is None or token_index_check_is_due() or token not in token_index
+
+
+def refresh_token_index(token=None):
+    """
+    Builds the index on first use. After that, when a check is due and no other refresh is
+    running, reads UsersVersion and, if the index is out of date, starts rebuilding it on a
+    background thread; until the new index is swapped in, every caller keeps reading the old one.
+    A token the index does not know is looked up in the database straight away, so that users
+    added or given new tokens by other processes are served at once.
+    """
+    if token_index_built_at is None:
+        rebuild_token_index()
+    elif token_index_check_is_due() and token_index_refreshing.acquire(False):
+        check_token_index()
+    if token is not None and token not in token_index:
+        index_stored_user(token)
+    return
+
+
+def check_token_index():
+    """ Called holding token_index_refreshing; releases it, or hands it on to a rebuild thread. """
+    global token_index_checked_at
+    token_index_checked_at = time.time()
+    try:
+        out_of_date = token_index_is_stale() or read_users_version() != token_index_version
+    except Exception:
+        app.db.session.rollback()
+        print('error checking the token index')
+        traceback.print_exc()
+        out_of_date = False
+    if not out_of_date:
+        token_index_refreshing.release()
+        return
+    rebuilder = threading.Thread(target=rebuild_token_index_in_background, name="token-index-rebuild")
+    rebuilder.daemon = True
+    rebuilder.start()
+    return
+
+
+def index_stored_user(token):
+    user = User.query.filter_by(token=token).first()
+    if user is None:
+        return
+    user_info = user.as_dict()
+    with quota_lock:
+        if quota_ledger is not None:
+            user_info["quota_left"] = max(user_info["quota_left"] - quota_ledger.pending.get(token, 0), 0)
+        index_user(user_info)
+    return
+
+
+def get_indexed_user_info(token):
+    refresh_token_index(token)
+    return look_up_indexed_user_info(token)
+
+
+def look_up_indexed_user_info(token):
+    """ Reads the index without refreshing it, for callers that hold quota_lock. """
+    user_info = token_index.get(token)
+    if user_info is None:
+        raise errors.UserNotFoundError("No user associated with your token.")
+    return dict(user_info)
+
+
+def check_token(token):
+    get_indexed_user_info(token)
     return
 
 
 def get_user_quotas(token):
-    return get_user_by_token(token).make_quotas_dict()
+    user_info = get_indexed_user_info(token)
+    return {
+        "total_quota": user_info["total_quota"],
+        "quota_left": user_info["quota_left"]
+    }
 
 
-def decrement_user_quota(token):
-    user = get_user_by_token(token=token)
+def decrement_user_quota(token, amount=1):
+    return reserve_user_quota(token=token, amount=amount)
 
-    if user.quota_left > 0:
-        user.quota_left = user.quota_left - 1
-        commit_database()
-        return user.make_quotas_dict()
-    else:
+
+def reserve_user_quota(token, amount=1):
+    """
+    Takes amount units of quota from the user in one conditional UPDATE, so that concurrent
+    workers can never overspend, and returns the user's new quotas.
+    """
+    if quota_ledger is not None:
+        return quota_ledger.reserve(token=token, amount=amount)
+    try:
+        reserved = User.query.filter(User.token == token, User.quota_left >= amount).update(
+            {User.quota_left: User.quota_left - amount}, synchronize_session=False)
+        new_quotas = read_user_quotas(token)
+        app.db.session.commit()
+    except Exception:
+        app.db.session.rollback()
+        raise
+
+    if new_quotas is None:
+        raise errors.UserNotFoundError("No user associated with your token.")
+    update_indexed_quotas(token, new_quotas)
+    if reserved == 0:
         raise errors.UserAuthenticationError("No more request quota.")
+    return new_quotas
+
+
+def refund_user_quota(token, amount=1):
+    """
+    Gives back quota taken by reserve_user_quota, capped at total_quota in case an admin has
+    since lowered the user's quotas.
+    """
+    if quota_ledger is not None:
+        return quota_ledger.refund(token=token, amount=amount)
+    try:
+        write_quota_change(token, -amount)
+        new_quotas = read_user_quotas(token)
+        app.db.session.commit()
+    except Exception:
+        app.db.session.rollback()
+        raise
 
+    if new_quotas is not None:
+        update_indexed_quotas(token, new_quotas)
+    return new_quotas
+
+
+def write_quota_change(token, amount):
+    """
+    Applies a net quota change flushed by the QuotaLedger; spending never takes quota_left below
+    zero and refunding never takes it above total_quota. Does not commit.
+    """
+    if amount > 0:
+        spent = User.query.filter(User.token == token, User.quota_left >= amount).update(
+            {User.quota_left: User.quota_left - amount}, synchronize_session=False)
+        if spent == 0:
+            User.query.filter(User.token == token).update({User.quota_left: 0}, synchronize_session=False)
+    else:
+        refunded = User.query.filter(User.token == token, User.quota_left - amount <= User.total_quota).update(
+            {User.quota_left: User.quota_left - amount}, synchronize_session=False)
+        if refunded == 0:
+            User.query.filter(User.token == token).update({User.quota_left: User.total_quota},
+                                                          synchronize_session=False)
+    return
+
+
+def read_users_version():
+    row = UsersVersion.query.with_entities(UsersVersion.version).filter(UsersVersion.id == 1).first()
+    return 0 if row is None else row[0]
+
+
+def bump_users_version():
+    """ Marks every process's token index out of date. Does not commit. """
+    bumped = UsersVersion.query.filter(UsersVersion.id == 1).update(
+        {UsersVersion.version: UsersVersion.version + 1}, synchronize_session=False)
+    if bumped == 0:
+        app.db.session.add(UsersVersion(id=1, version=1))
+    return
+
+
+def read_user_quotas(token):
+    row = User.query.with_entities(User.total_quota, User.quota_left).filter(User.token == token).first()
+    if row is None:
+        return None
+    return {
+        "total_quota": row[0],
+        "quota_left": row[1]
+    }
+
+
+def update_indexed_quotas(token, quotas):
+    with token_index_lock:
+        user_info = token_index.get(token)
+        if user_info is not None:
+            user_info = dict(user_info)
+            user_info.update(quotas)
+            token_index[token] = user_info
     return
 
 
@@ -80,6 +477,27 @@ def get_all_users_info():
     return users_info
 
 
+def iter_users_info(after_id=None, limit=None, chunk_size=500):
+    """
+    Yields (id, user info) in id order for the users after after_id, at most limit of them.
+    Rows are fetched chunk_size at a time, so the whole table is never held in memory.
+    """
+    remaining = limit
+    while remaining is None or remaining > 0:
+        fetch_size = chunk_size if remaining is None else min(chunk_size, remaining)
+        query = User.query.order_by(User.id)
+        if after_id is not None:
+            query = query.filter(User.id > after_id)
+        users = query.limit(fetch_size).all()
+        for user in users:
+            yield user.id, user.as_dict()
+        if len(users) < fetch_size:
+            return
+        after_id = users[-1].id
+        if remaining is not None:
+            remaining -= len(users)
+
+
 def get_user_info(name):
     return get_user_by_name(name).as_dict()
 
@@ -89,14 +507,17 @@ def add_user_from_info(info):
     user = User.construct_from_info(valid_info)
     app.db.session.add(user)
     commit_database()
+    index_user(user.as_dict())
     return user.as_dict()
 
 
 def update_user_from_info(name, info):
     user = get_user_by_name(name)
+    old_token = user.token
     valid_partial_info = value_check_info_against_user(info, user)
     user.edit_from_info(valid_partial_info)
     commit_database()
+    index_user(user.as_dict(), old_token=old_token)
     return user.as_dict()
 
 
@@ -104,11 +525,180 @@ def delete_user_by_name(name):
     user = get_user_by_name(name=name)
     app.db.session.delete(user)
     commit_database()
+    unindex_user(user.token)
     return user.as_dict()
 
 
-def commit_database():
+# IN (...) lookups are split into chunks of this size to stay under SQLite's bound parameter limit
+BULK_LOOKUP_CHUNK_SIZE = 500
+
+
+def add_users_from_info(infos):
+    """
+    Creates a user for every info dict in one transaction. If any row is invalid or conflicts
+    with another row or an existing user, nothing is written and a UserBatchError lists
+    every rejected row.
+    """
+    invalid_rows = []
+    valid_infos = []
+    for index, info in enumerate(infos):
+        try:
+            valid_infos.append(value_check_all_info(info))
+        except errors.UserInfoError as user_info_error:
+            invalid_rows.append(make_row_error(index, user_info_error))
+            valid_infos.append(None)
+    conflicting_rows = find_conflicting_rows(valid_infos, [None] * len(valid_infos))
+    raise_row_errors(invalid_rows, conflicting_rows, len(infos))
+
+    commit_database(lambda: app.db.session.bulk_insert_mappings(User, valid_infos))
+    for valid_info in valid_infos:
+        index_user(dict(valid_info))
+    return valid_infos
+
+
+def update_users_from_info(updates):
+    """
+    Applies (name, info) updates in one transaction, each validated the same way as
+    update_user_from_info. Returns (updated users' info, their info before the update).
+    If any row is rejected, nothing is written and a UserBatchError lists every rejected row.
+    """
+    users_by_name = get_users_by_names([name for name, _ in updates])
+    invalid_rows = []
+    valid_infos = []
+    updated_users = []
+    seen_names = set()
+    for index, (name, info) in enumerate(updates):
+        user = users_by_name.get(name)
+        valid_infos.append(None)
+        updated_users.append(user)
+        try:
+            if user is None:
+                raise errors.UserNotFoundError("No user associated with that name.")
+            if name in seen_names:
+                raise errors.UserInfoError("The user {} is updated by more than one row.".format(name))
+            seen_names.add(name)
+            valid_infos[index] = value_check_info_against_user(info, user)
+        except (errors.UserInfoError, errors.UserNotFoundError) as row_error:
+            invalid_rows.append(make_row_error(index, row_error))
+    user_ids = [None if user is None else user.id for user in updated_users]
+    conflicting_rows = find_conflicting_rows(valid_infos, user_ids)
+    raise_row_errors(invalid_rows, conflicting_rows, len(updates))
+
+    old_infos = [user.as_dict() for user in updated_users]
+    new_infos = []
+    mappings = []
+    for user, old_info, valid_info in zip(updated_users, old_infos, valid_infos):
+        new_info = dict(old_info)
+        new_info.update(valid_info)
+        new_infos.append(new_info)
+        mapping = dict(valid_info)
+        mapping["id"] = user.id
+        mappings.append(mapping)
+    app.db.session.expunge_all()
+    commit_database(lambda: app.db.session.bulk_update_mappings(User, mappings))
+    for new_info, old_info in zip(new_infos, old_infos):
+        index_user(dict(new_info), old_token=old_info["token"])
+    return new_infos, old_infos
+
+
+def delete_users_by_name(names):
+    """
+    Deletes the named users in one transaction and returns their info. If any name is unknown,
+    nothing is deleted and a UserBatchError lists every rejected row.
+    """
+    users_by_name = get_users_by_names(names)
+    invalid_rows = []
+    seen_names = set()
+    for index, name in enumerate(names):
+        if name not in users_by_name:
+            invalid_rows.append(make_row_error(index, "No user associated with that name."))
+        elif name in seen_names:
+            invalid_rows.append(make_row_error(index, "The user {} is deleted by more than one row.".format(name)))
+        seen_names.add(name)
+    raise_row_errors(invalid_rows, [], len(names))
+
+    deleted_infos = [users_by_name[name].as_dict() for name in names]
+    user_ids = [users_by_name[name].id for name in names]
+    try:
+        for chunk in iter_chunks(user_ids):
+            User.query.filter(User.id.in_(chunk)).delete(synchronize_session=False)
+    except Exception:
+        app.db.session.rollback()
+        raise
+    commit_database()
+    for deleted_info in deleted_infos:
+        unindex_user(deleted_info["token"])
+    return deleted_infos
+
+
+def get_users_by_names(names):
+    users_by_name = {}
+    for chunk in iter_chunks(list(set(names))):
+        for user in User.query.filter(User.name.in_(chunk)).all():
+            users_by_name[user.name] = user
+    return users_by_name
+
+
+def find_conflicting_rows(infos, user_ids):
+    """
+    Checks the names and tokens set by a batch of rows against each other and against the
+    users already stored. user_ids[i] is the id of the user that row i updates, or None for a
+    new user. A stored value only conflicts if its owner is not itself being given a new value
+    for that field by the batch.
+    """
+    conflicting_rows = []
+    for field, column in (("name", User.name), ("token", User.token)):
+        rows_by_value = {}
+        vacating_ids = set()
+        for index, info in enumerate(infos):
+            if info is None or info.get(field) is None:
+                continue
+            if user_ids[index] is not None:
+                vacating_ids.add(user_ids[index])
+            if info[field] in rows_by_value:
+                conflicting_rows.append(make_row_error(index, "{} conflict with row {} of the request."
+                                                       .format(field.capitalize(), rows_by_value[info[field]])))
+            else:
+                rows_by_value[info[field]] = index
+
+        for chunk in iter_chunks(list(rows_by_value)):
+            stored = User.query.with_entities(User.id, column).filter(column.in_(chunk)).all()
+            for user_id, value in stored:
+                if user_id not in vacating_ids:
+                    conflicting_rows.append(make_row_error(rows_by_value[value],
+                                                           "{} conflict with an existing user in the database."
+                                                           .format(field.capitalize())))
+    return conflicting_rows
+
+
+def make_row_error(index, error):
+    return {
+        "index": index,
+        "message": str(error)
+    }
+
+
+def raise_row_errors(invalid_rows, conflicting_rows, row_count):
+    row_errors = sorted(invalid_rows + conflicting_rows, key=lambda row_error: row_error["index"])
+    if len(row_errors) == 0:
+        return
+    rejected_count = len(set(row_error["index"] for row_error in row_errors))
+    raise errors.UserBatchError(message="{} of {} rows were rejected; no changes were made."
+                                .format(rejected_count, row_count),
+                                row_errors=row_errors,
+                                conflict=len(invalid_rows) == 0)
+
+
+def iter_chunks(values, chunk_size=BULK_LOOKUP_CHUNK_SIZE):
+    for start in range(0, len(values), chunk_size):
+        yield values[start:start + chunk_size]
+
+
+def commit_database(write_changes=None):
     try:
+        if write_changes is not None:
+            write_changes()
+        bump_users_version()
         app.db.session.commit()
     except Exception as user_conflict_error:
         if user_conflict_error.args[0][-4:] == "name":